@@ -1,54 +1,220 @@
 #!/usr/bin/env python3
 
-"""
-Benchmarking script
+"""Benchmarking script
 
 Process to the benchmarking if needed and then generate nice plots and other
 interesting information about the results of the benchmarking
+
+The pairs of the dataset are aligned concurrently (several main.py running at
+the same time), and the pairs already written in bench.csv are skipped, so
+that an interrupted benchmarking can be resumed
+
+Usage:
+  bench.py [-c <cpuBudget>] [-n <cpuPerPair>] [-t <nbTries>] [-w <scratchDir>]
+
+Options:
+  -h --help                   help
+  -c --cpuBudget = budget     Number of CPUs used by the whole benchmarking, all the CPUs if not given
+  -n --cpuPerPair = nb_cpu    Number of CPUs shared by the stages of each pair [default: 1]
+  -t --nbTries = nb_tries     Number of tries of a pair before giving up [default: 2]
+  -w --scratchDir = scratch   Directory where the workspaces of the runs are created (e.g. /dev/shm), the system temporary directory if not given
 """
 
 
 import sys
 import os
 import re
+import time
 import numpy as np
 import pandas as pd
 import subprocess as sub
+import multiprocessing as mp
+import concurrent.futures as cf
+from docopt import docopt
 import src.external as ext
 import src.plotting as plot
 
 
+def check_int_type(rep, name):
+    """
+    Check if the answer is a positive integer.
+    Args:
+        rep: answer given by the user (str)
+        name: name (str) of the parameter, for the error message
+    Returns:
+        The answer casted into an integer
+    """
+    if not rep.isdigit() or int(rep) < 1:
+        print("ERROR! " + name + " must be a positive integer !")
+        sys.exit(2)
+    return int(rep)
+
+
+def is_done(done_pairs, dom1_sid, dom2_sid):
+    """
+    Check if a pair has already been written in bench.csv (the ids written by
+    main.py being the SCOP ids followed by the chain ID)
+    Args:
+        done_pairs: List of the "peel_pdb_id-ref_pdb_id" (str) of bench.csv
+        dom1_sid: SCOP id (str) of the peeled domain
+        dom2_sid: SCOP id (str) of the reference domain
+    Returns:
+        A boolean telling if the pair is in bench.csv
+    """
+    pattern = re.compile(re.escape(dom1_sid) + r"\w?-" + re.escape(dom2_sid) +
+                         r"\w?$")
+    return any(pattern.match(pair) for pair in done_pairs)
+
+
+def find_pdb(dom_sid):
+    """
+    Find the pdb of a domain in the data/ folder, plain or compressed (read
+    as such by main.py)
+    Args:
+        dom_sid: SCOP id (str) of the domain
+    Returns:
+        The path (str) of the pdb, None if it is absent
+    """
+    for extension in ('.pdb', '.pdb.gz', '.ent.gz', '.pdb.bz2', '.ent.bz2'):
+        if os.path.isfile("data/" + dom_sid + extension):
+            return "data/" + dom_sid + extension
+    return None
+
+
+def get_done_pairs():
+    """
+    Returns:
+        The list of the "peel_pdb_id-ref_pdb_id" (str) written in bench.csv
+    """
+    with open('bench.csv') as bench_file:
+        next(bench_file) # Header
+        return [line.split(';')[0] for line in bench_file if line.strip()]
+
+
+def run_pair(dom1_sid, dom2_sid, cmd_main, nb_tries):
+    """
+    Run main.py on a pair, until its results are written in bench.csv (the
+    output of a failed try is kept in bench_logs/)
+    Args:
+        dom1_sid: SCOP id (str) of the peeled domain
+        dom2_sid: SCOP id (str) of the reference domain
+        cmd_main: Command line (list of str) of main.py
+        nb_tries: Maximal number (int) of tries
+    Returns:
+        The number (int) of tries done and a boolean telling if the pair
+        succeeded
+    """
+    log_path = "bench_logs/" + dom1_sid + '-' + dom2_sid + '.log'
+
+    for nb_try in range(1, nb_tries+1):
+        run = sub.run(cmd_main, stdout=sub.PIPE, stderr=sub.STDOUT)
+        if run.returncode == 0 and is_done(get_done_pairs(), dom1_sid,
+                                           dom2_sid):
+            if os.path.isfile(log_path):
+                os.remove(log_path)
+            return (nb_try, True)
+
+        os.makedirs("bench_logs", exist_ok=True)
+        with open(log_path, 'wb') as log_file:
+            log_file.write(run.stdout)
+
+    return (nb_tries, False)
+
+
+def format_time(seconds):
+    """
+    Returns:
+        The duration (str) as h:mm:ss
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    return "{}:{:02d}:{:02d}".format(minutes // 60, minutes % 60, seconds)
+
+
 
 # MAIN:
 if __name__ == "__main__":
-    if not os.path.isfile('bench.csv'):
-        # Get dataset table:
-        RIPC_txt = pd.read_csv('data/RIPC_dataset.txt', sep='\t')
+    ARGS = docopt(__doc__)
+    CPU_BUDGET = mp.cpu_count()
+    if ARGS["--cpuBudget"] is not None:
+        CPU_BUDGET = check_int_type(ARGS["--cpuBudget"], "The CPU budget")
+    CPU_PER_PAIR = check_int_type(ARGS["--cpuPerPair"],
+                                  "The number of CPUs per pair")
+    NB_TRIES = check_int_type(ARGS["--nbTries"], "The number of tries")
+    # Each pair uses its main process and its pool of aligning processes,
+    # the main process being mainly idle during the alignments:
+    NB_JOBS = max(CPU_BUDGET // CPU_PER_PAIR, 1)
 
+    # Get dataset table:
+    RIPC_txt = pd.read_csv('data/RIPC_dataset.txt', sep='\t')
+
+    if not os.path.isfile('bench.csv'):
         # Write header of the file containing the results of the bench:
         with open('bench.csv', 'w') as bench_file:
             bench_file.write("peel_pdb_id-ref_pdb_id;TMscore_ref;TM_parMATT;" +
                        "best_peel_TM_rev;best_peel_TM;max_peel_TM;best_peel_gdt;" +
                        "best_peel_gdt_rev;max_peel_gdt\n")
 
+    # Pairs not processed yet (or failed during a previous benchmarking):
+    DONE_PAIRS = get_done_pairs()
+    TODO_PAIRS = []
+    for idx, row in RIPC_txt.iterrows():
+        len_dom1, len_dom2 = row['Length1'],row['Length2']
+        dom1_sid, dom2_sid = row['Domain1'], row['Domain2']
+        pdb_id_dom1, pdb_id_dom2 = dom1_sid[1:5], dom2_sid[1:5]
+        chainID_sid1, chainID_sid2 = dom1_sid[5], dom2_sid[5]
+
+        # If the PDB is absent from the data/ folder, it is downloaded:
+        if find_pdb(dom1_sid) is None:
+            url_dom1 = ext.get_url_dom(dom1_sid)
+            ext.dl_pdb(url_dom1, pdb_id_dom1, dom1_sid)
+        if find_pdb(dom2_sid) is None:
+            url_dom2 = ext.get_url_dom(dom2_sid)
+            ext.dl_pdb(url_dom2, pdb_id_dom2, dom2_sid)
+
+        if not is_done(DONE_PAIRS, dom1_sid, dom2_sid):
+            TODO_PAIRS.append((dom1_sid, dom2_sid))
+
+    if TODO_PAIRS:
+        print(str(len(RIPC_txt) - len(TODO_PAIRS)) + " pairs already done, " +
+              str(len(TODO_PAIRS)) + " pairs to align (" + str(NB_JOBS) +
+              " at the same time)")
+        START = time.time()
+        FAILED_PAIRS = []
+
+        # Each pair is run by its own main.py process (whose pool of
+        # aligning processes is shared by both senses of the pair):
+        with cf.ThreadPoolExecutor(NB_JOBS) as executor:
+            futures = {}
+            for dom1_sid, dom2_sid in TODO_PAIRS:
+                # The domains appear in several pairs, so their chains and
+                # their DSSP and peeling outputs are cached:
+                cmd_main = ["./main.py", "-p", find_pdb(dom1_sid),
+                            "-r", find_pdb(dom2_sid), "-b", "t",
+                            "-n", str(CPU_PER_PAIR), "-k", "data/cache"]
+                if ARGS["--scratchDir"] is not None:
+                    cmd_main += ["-w", ARGS["--scratchDir"]]
+                futures[executor.submit(run_pair, dom1_sid, dom2_sid,
+                                        cmd_main, NB_TRIES)] = (dom1_sid,
+                                                                dom2_sid)
 
-        for idx, row in RIPC_txt.iterrows():
-            len_dom1, len_dom2 = row['Length1'],row['Length2']
-            dom1_sid, dom2_sid = row['Domain1'], row['Domain2']
-            pdb_id_dom1, pdb_id_dom2 = dom1_sid[1:5], dom2_sid[1:5]
-            chainID_sid1, chainID_sid2 = dom1_sid[5], dom2_sid[5]
+            for nb_finished, future in enumerate(cf.as_completed(futures), 1):
+                dom1_sid, dom2_sid = futures[future]
+                nb_try, success = future.result()
+                if not success:
+                    FAILED_PAIRS.append(dom1_sid + '-' + dom2_sid)
 
-            # If the PDB is absent from the data/ folder, it is downloaded:
-            if not os.path.isfile("data/" + dom1_sid + '.pdb'):
-                url_dom1 = ext.get_url_dom(dom1_sid)
-                ext.dl_pdb(url_dom1, pdb_id_dom1, dom1_sid)
-            if not os.path.isfile("data/" + dom2_sid + '.pdb'):
-                url_dom2 = ext.get_url_dom(dom2_sid)
-                ext.dl_pdb(url_dom2, pdb_id_dom2, dom2_sid)
+                # Remaining time, from the mean time spent per pair:
+                elapsed = time.time() - START
+                eta = elapsed / nb_finished * (len(TODO_PAIRS) - nb_finished)
+                print("[{}/{}] {}-{} {} ({} tries) - elapsed {} - ETA {}".format(
+                      nb_finished, len(TODO_PAIRS), dom1_sid, dom2_sid,
+                      "done" if success else "FAILED", nb_try,
+                      format_time(elapsed), format_time(eta)))
 
-            cmd_main = ("./main.py -p data/" + dom1_sid + '.pdb -r data/' +
-                        dom2_sid + ".pdb -b t")
-            os.system(cmd_main)
+        if FAILED_PAIRS:
+            print("\nFailed pairs (see bench_logs/, relaunch bench.py to " +
+                  "retry them):", ", ".join(FAILED_PAIRS))
+            sys.exit(1)
 
 
     else: # Display plots and information about results:
@@ -62,6 +62,14 @@ double H_PU3;
 int start_pu;
 int end_pu;
 
+/* Library mode (see peel_arrays): the levels are stored instead of printed */
+int lib_mode=0;
+int nb_levels=0;
+float *lib_CI;
+float *lib_R;
+int *lib_nb_pu;
+int *lib_bounds;
+
 int main (int argc, char *argv[])
 {
 	/* Protype des fonctions */
@@ -73,6 +81,7 @@ int main (int argc, char *argv[])
 	void save_pu(void);
 	void mutual_information(void);
 	void test(void);
+	int peeling_loop(void);
 
 	char NAME_PDB_FILE[1024];
 	char NAME_DSSP_FILE[1024];
@@ -151,6 +160,28 @@ int main (int argc, char *argv[])
 
 
 
+	if (peeling_loop() != 0) {exit(1);}
+
+	//printf ("END PU PARSING\n");
+}
+
+/****************************************************************************/
+/*                                                                          */
+/*  FONCTION BOUCLE DE PEELING (niveaux successifs de decoupe)              */
+/*                                                                          */
+/****************************************************************************/
+/* Returns 1 if the peeling stopped before the last iteration */
+int peeling_loop(void)
+{
+	void simple_cutting(void);
+	void double_cutting(void);
+	double homogeneity(int ,int);
+	void save_pu(void);
+	void mutual_information(void);
+
+	int continuation;
+	int x;
+
 	while (iteration < 32)
 	  {
 		/* Affectation */
@@ -178,7 +209,7 @@ int main (int argc, char *argv[])
 				double_cutting();
 			  }
 		  }
-		if (best_pu == -1) {exit(1);}
+		if (best_pu == -1) {return 1;}
 
 
 		/*Sauvegarde des unites coupees*/
@@ -205,7 +236,7 @@ int main (int argc, char *argv[])
 					continuation=1;
 				}
 			}
-			if (continuation == 0 ) {exit(1);}
+			if (continuation == 0 ) {return 1;}
 		}
 
 		/* Verification de la valeur du CI/HI (homogenity idx) des PUs crees et elegage le cas echeant */
@@ -240,21 +271,19 @@ int main (int argc, char *argv[])
 					continuation=1;
 				}
 			}
-			if (continuation == 0 ) {exit(1);}
+			if (continuation == 0 ) {return 1;}
 		}
 
 
 
 		/*mutual_information();*/
 		mutual_information();
+		if (CI > MAXR2){return 1;}
 		max_coeff_matthews=0.;
 		iteration++;
 
 	  }
-
-
-
-	//printf ("END PU PARSING\n");
+	return 0;
 }
 /*
    1--------10-------20--------30--------40--------50--------60
@@ -269,6 +298,7 @@ int main (int argc, char *argv[])
 /****************************************************************************/
 void parse_pdb (char *p_code_pdb, char *p_name_pdb_file, char *p_name_dssp_file)
 {
+	void contact_matrix(int *, int *, int *, FILE *);
 
 	/* Variables lecture fichier */
 	char line[85];
@@ -285,33 +315,8 @@ void parse_pdb (char *p_code_pdb, char *p_name_pdb_file, char *p_name_dssp_file)
 	int tab_x[1024],tab_y[1024],tab_z[1024];
 	char tab_chain[1024];
 
-	/* Variable calcul des distances */
-	int i;
-	int j;
-
-	int dx2,dy2,dz2;
-	float p;
-	double dt,dt2;
-	float tmp;
-
-	/* Varaibles calculs des probabilite de contacts */
-	float mean_pcontact;
-	float co;
-	float pcontactaa;
-
-	float pccoaa,plcoaa;
-
-	int tab_contact[1024][1024];
-
-	int delta_ij;
-	int nb_p;
-
 	idx = 0;
 
-	int n;
-	int L;
-	int L2;
-
 	/* Varables decriture de fichier */
 	char *file_dist_contact_mtx ="file_dist_contact.mtx";
 	char *file_proba_contact_mtx   ="file_proba_contact.mtx";
@@ -388,6 +393,40 @@ void parse_pdb (char *p_code_pdb, char *p_name_pdb_file, char *p_name_dssp_file)
 	idx--; // elimination de la derniere incremetation car elle est vide
 	fclose(pdb_file); /*Fermer le fichier */
 	fclose(pfile_ca_coo);
+	/* Calcul distance intercalpha et probabilites de contact */
+	FILE* pfile_proba_contact_mat = fopen(file_proba_contact_mat, "w");
+	contact_matrix(tab_x, tab_y, tab_z, pfile_proba_contact_mat);
+	fclose(pfile_proba_contact_mat);
+}
+
+/****************************************************************************/
+/*                                                                          */
+/*  FONCTION CALCUL MATRICE DE CONTACT (coordonnees des idx+1 Calpha)       */
+/*                                                                          */
+/****************************************************************************/
+void contact_matrix(int *tab_x, int *tab_y, int *tab_z, FILE *pfile_proba_contact_mat)
+{
+	/* Variable calcul des distances */
+	int i;
+	int j;
+
+	int dx2,dy2,dz2;
+	float p;
+	double dt,dt2;
+	float tmp;
+
+	/* Varaibles calculs des probabilite de contacts */
+	float pcontactaa;
+
+	float pccoaa,plcoaa;
+
+	static int tab_contact[1024][1024];
+
+	int nb_p;
+
+	int L;
+	int L2;
+
 	/* Calcul distance intercalpha dans un tableau*/
 	pcontact=0;
 	pccoaa=0.;
@@ -402,7 +441,6 @@ void parse_pdb (char *p_code_pdb, char *p_name_pdb_file, char *p_name_dssp_file)
 	//FILE* pfile_dist_contact_mtx = fopen(file_dist_contact_mtx, "w");
 	//FILE* pfile_proba_contact_mtx   = fopen(file_proba_contact_mtx,   "w");
 	//FILE* pfile_dist_contact_mat = fopen(file_dist_contact_mat, "w");
-	FILE* pfile_proba_contact_mat = fopen(file_proba_contact_mat, "w");
 
 
 	//FILE* pfile_position_contactorder=fopen(file_position_contactorder,"w");
@@ -434,7 +472,7 @@ void parse_pdb (char *p_code_pdb, char *p_name_pdb_file, char *p_name_dssp_file)
 			tmp=tmp/DELTA;
 			p=1/(1+exp(tmp));
 			/*Ecriture dans les fichiers de sortie*/
-			fprintf(pfile_proba_contact_mat,"%5.3f ",p);
+			if (pfile_proba_contact_mat != NULL) {fprintf(pfile_proba_contact_mat,"%5.3f ",p);}
 			//fprintf (pfile_proba_contact_mtx,"%3d %3d %5.3f\n",i+1,j+1,p);
 
 			/*Calcul du p contact total*/
@@ -458,7 +496,7 @@ void parse_pdb (char *p_code_pdb, char *p_name_pdb_file, char *p_name_dssp_file)
 			pcontactaa=pcontactaa+p;
 		}
 		//fprintf (pfile_dist_contact_mat,"\n ");
-		fprintf (pfile_proba_contact_mat,"\n ");
+		if (pfile_proba_contact_mat != NULL) {fprintf (pfile_proba_contact_mat,"\n ");}
 
 		//fprintf (pfile_position_dist_contact,"\n");
 
@@ -479,7 +517,6 @@ void parse_pdb (char *p_code_pdb, char *p_name_pdb_file, char *p_name_dssp_file)
 
 	/*Fermeture des fichiers de sortie*/
 	//fclose (pfile_dist_contact_mat);
-	fclose(pfile_proba_contact_mat);
 	//fclose (pfile_dist_contact_mtx);
 	//fclose (pfile_proba_contact_mtx);
 
@@ -494,7 +531,6 @@ void parse_pdb (char *p_code_pdb, char *p_name_pdb_file, char *p_name_dssp_file)
 	iteration++;
 	best_pu=0;
 }
-
 /****************************************************************************/
 /*                                                                          */
 /*  FONCTION OUVERTURE ET TRAITEMENT DU FICHIER DSSP                        */
@@ -516,13 +552,9 @@ void parse_dssp (char *p_name_dssp_file)
 	char aaname[1];
 	char ss2[2];
 	int idx2=0;
-	int i,j,k;
+	int i;
 
-	int start1=0;
-	int sizess2;
-	//int LIMITSIZESS2 = 8;
-	int startss2,endss2;
-	int tab_u_ss2[128];
+	void cutting_zones(int);
 
 	for (i=0 ; i <= 199 ; i++){line[i]='X'; }
 	for (i=0 ; i <= 1024; i++){tab_ss2[i]=0;}
@@ -565,6 +597,31 @@ void parse_dssp (char *p_name_dssp_file)
 	//printf("idx2:%i\n",idx2);
 	fclose(dssp_file); /*Fermer le fichier */
 
+	cutting_zones(idx2);
+
+	//for (i=0 ; i <= idx2 ; i++)
+	// {
+	//	printf("%d %d\n",i, tab_decoupe[i]);
+	// }
+	//printf("dssp ok !\n");
+}
+
+
+/****************************************************************************/
+/*                                                                          */
+/*  FONCTION ZONES DE DECOUPE (structures secondaires des idx2+1 residus)   */
+/*                                                                          */
+/****************************************************************************/
+void cutting_zones(int idx2)
+{
+	int i,j,k;
+
+	int start1=0;
+	int sizess2;
+	//int LIMITSIZESS2 = 8;
+	int startss2,endss2;
+	int tab_u_ss2[128];
+
 	j=0;
 	for (i=0 ; i <= idx2 ; i++)
 	{
@@ -639,14 +696,8 @@ void parse_dssp (char *p_name_dssp_file)
 		}
 	}
 
-	//for (i=0 ; i <= idx2 ; i++)
-	// {
-	//	printf("%d %d\n",i, tab_decoupe[i]);
-	// }
-	//printf("dssp ok !\n");
 }
 
-
 /******************************************************************/
 /*                                                                */
 /*              Fonction Simple decoupage                         */
@@ -1133,9 +1184,107 @@ void mutual_information()
 	//CI=100*sqrt((1-exp(-2*entropie)));
 	CI=100*sqrt(1-exp(-2*entropie));
 	R=100*(1-exp(-2*entropie));
-	printf("X.XX X.XX %f %f N ",CI,R);
-	for (x=0 ; x <= new_nbre_pu ; x++){printf("%d %d ",pu[iteration][x][0]+1,pu[iteration][x][1]+1);}
-	printf("\n");
-	if (CI > MAXR2){exit (1);}
+	if (lib_mode)
+	{
+		lib_CI[nb_levels]=CI;
+		lib_R[nb_levels]=R;
+		lib_nb_pu[nb_levels]=new_nbre_pu+1;
+		for (x=0 ; x <= new_nbre_pu ; x++)
+		{
+			lib_bounds[(nb_levels*128+x)*2]=pu[iteration][x][0]+1;
+			lib_bounds[(nb_levels*128+x)*2+1]=pu[iteration][x][1]+1;
+		}
+		nb_levels++;
+	}
+	else
+	{
+		printf("X.XX X.XX %f %f N ",CI,R);
+		for (x=0 ; x <= new_nbre_pu ; x++){printf("%d %d ",pu[iteration][x][0]+1,pu[iteration][x][1]+1);}
+		printf("\n");
+	}
+
+}
+
+/****************************************************************************/
+/*                                                                          */
+/*  FONCTION POINT D'ENTREE BIBLIOTHEQUE (libpeel.so, sans fichiers)        */
+/*                                                                          */
+/****************************************************************************/
+/* coords: nb_ca*3 coordonnees (x y z) des Calpha, ss: nb_ss types de       */
+/* structure secondaire (0: aucune, 1: helice, 2: brin), les autres         */
+/* arguments etant ceux du programme. Les niveaux sont ecrits dans out_CI,  */
+/* out_R et out_nb_pu (32 valeurs) et out_bounds (32*128*2 bornes, a partir */
+/* de 1). Retourne le nombre de niveaux, -1 si la proteine est trop grande */
+int peel_arrays(int nb_ca, const int *coords, int nb_ss, const int *ss,
+		int r2_max, int limit_size_ss2, int min_size_pu, int max_size_pu,
+		float d0, float delta, int only_ss2, int pruning,
+		float cutoff_pruning, float *out_CI, float *out_R,
+		int *out_nb_pu, int *out_bounds)
+{
+	void contact_matrix(int *, int *, int *, FILE *);
+	void cutting_zones(int);
+	int peeling_loop(void);
+
+	int tab_x[1024],tab_y[1024],tab_z[1024];
+	int i;
+
+	if (nb_ca < 1 || nb_ca > 1024 || nb_ss > 1024) {return -1;}
+
+	/* Remise a zero de l'etat laisse par un appel precedent */
+	memset(tab_pcontact, 0, sizeof(tab_pcontact));
+	memset(tab_decoupe, 0, sizeof(tab_decoupe));
+	memset(tab_ss2, 0, sizeof(tab_ss2));
+	iteration=1;
+	nbre_de_coupe=0;
+	max_i1=0;
+	max_i2=0;
+	max_j1=0;
+	max_j2=0;
+	max_start=0;
+	max_end=0;
+	max_coeff_matthews=0.;
+	nbre_pu=0;
+	new_nbre_pu=0;
+	best_pu=-1;
+	start=0;
+	end=0;
+
+	MAXR2=r2_max;
+	LIMITSIZESS2=limit_size_ss2;
+	LIMITSIZEPU=min_size_pu;
+	MAXSIZEPU=max_size_pu;
+	MIN_SIZE_PU=min_size_pu;
+	MAX_SIZE_PU=max_size_pu;
+	D0=d0;
+	DELTA=delta;
+	ONLYSS2=only_ss2;
+	PRUNING=pruning;
+	CUTOFF_PRUNING=cutoff_pruning;
+
+	tab_decoupe[0]=1;
+
+	for (i=0 ; i < nb_ca ; i++)
+	{
+		tab_x[i]=coords[3*i];
+		tab_y[i]=coords[3*i+1];
+		tab_z[i]=coords[3*i+2];
+	}
+	idx=nb_ca-1;
+	contact_matrix(tab_x, tab_y, tab_z, NULL);
+
+	for (i=0 ; i < nb_ss ; i++){tab_ss2[i]=ss[i];}
+	cutting_zones(nb_ss-1);
+
+	lib_mode=1;
+	nb_levels=0;
+	lib_CI=out_CI;
+	lib_R=out_R;
+	lib_nb_pu=out_nb_pu;
+	lib_bounds=out_bounds;
+	nbre_pu=0;
+	iteration=1;
+	peeling_loop();
+	lib_mode=0;
 
+	return nb_levels;
 }
@@ -2,7 +2,7 @@
 
 """PeelAlign script
 Usage:
-  main.py -p <peelPdb> -r <refPdb> [-b <benchMode>] [-c <peelChain>] [-s <refChain>]
+  main.py -p <peelPdb> -r <refPdb> [-b <benchMode>] [-c <peelChain>] [-s <refChain>] [-e <engine>] [-i <incrMode>] [-d <debugFiles>] [-w <scratchDir>] [-n <nbCpu>] [-k <cacheDir>]
 
 Options:
   -h --help                  help
@@ -12,16 +12,25 @@ Options:
   -b --benchMode = benching  Mode benchmarking (bool) [default: False]
   -c --peelChain = pl_chain  Chain ID of the peeled PDB [default: first]
   -s --refChain = ref_chain  Chain ID of the reference PDB [default: first]
+  -e --engine = backend     Backend of the TM computations and of the peeling (binary or numpy, a slower in-process fallback that needs no executable) [default: binary]
+  -i --incrMode = incr_mode  Incremental selection of the PUs (off, fast or strict) [default: off]
+  -d --debugFiles = debug   Write the intermediate files of the alignments with the numpy engine (bool) [default: False]
+  -w --scratchDir = scratch  Directory where the workspace of the run is created (e.g. /dev/shm), the system temporary directory if not given
+  -n --nbCpu = nb_cpu        Number of CPUs shared by the concurrent stages of the run, all the CPUs but one if not given
+  -k --cacheDir = cache_dir   Directory of the caches of the chains and of the DSSP and peeling outputs, kept across the runs (e.g. data/cache), none to disable them [default: none]
 """
 
 
 import sys, os
+import asyncio
 import numpy as np
+import multiprocessing as mp
 from docopt import docopt
 import src.manage_io as mio
+import src.structure as strc
 import src.peeling as peel
 import src.external as ext
-import src.plotting as plot
+import src.task_graph as tg
 
 
 def check_bool_type(rep):
@@ -42,38 +51,158 @@ def check_bool_type(rep):
         sys.exit(2)
 
 
+def read_chain(pdb_path, chain_id_arg):
+    """
+    Read a chain of a pdb towards the results/ folder (see mio.parse_chain
+    and mio.write_chain), its Structure being loaded from the "chains" cache
+    (memory-mapped, see strc.Structure.from_file) if the same file was
+    already read
+
+    Args:
+        pdb_path: Path (str) to the pdb file
+        chain_id_arg: The ID (str) of the chain to extract ("first" for the
+        1st chain)
+
+    Returns:
+        The name of the file of the chain, its pdb id, its size and its
+        Structure
+    """
+    key = ext.file_key(pdb_path, "chain " + chain_id_arg + " " +
+                       str(strc.FILE_VERSION))
+    cached_path = ext.cache_lookup("chains", key)
+
+    structure = None
+    if cached_path is not None:
+        try:
+            structure = strc.Structure.from_file(cached_path)
+        except FileNotFoundError: # Removed by another run in the meantime
+            pass
+    if structure is None:
+        structure = mio.parse_chain(pdb_path, chain_id_arg)
+        ext.cache_put("chains", key, structure.to_bytes())
+
+    return mio.write_chain(pdb_path, structure)
+
+
+async def simple_TMalign(ref_pdb_id, peeled_pdb_id, peel_longer):
+    """
+    Simple TMalignment between both pdb (the reference one being moved),
+    whose superposition files are removed
+
+    Args:
+        ref_pdb_id: Name (str) of the reference pdb
+        peeled_pdb_id: Name (str) of the peeled pdb
+        peel_longer: Boolean telling if the peeled protein is longer (or not)
+        than the reference protein
+
+    Returns:
+        The TMscore of the alignment
+    """
+    TMscore = await ext.TM_align_async(ref_pdb_id, peeled_pdb_id, peel_longer)
+    # Cleaning files from TMalign:
+    for extension in ('.sup_atm', '.sup_all_atm'):
+        os.remove("results/" + ref_pdb_id + extension)
+
+    return TMscore
+
+
+def whole_alignments(peeled_pdb_path, ref_pdb_path, peeled_pdb_id,
+                     ref_pdb_id, peel_longer, nb_cpu):
+    """
+    Alignments of the whole chains (parMATT and simple TMalignment), whose
+    programs are run concurrently by a single event loop
+
+    Args:
+        peeled_pdb_path: Path (str) to the peeled pdb
+        ref_pdb_path: Path (str) to the reference pdb
+        peeled_pdb_id: Name (str) of the peeled pdb
+        ref_pdb_id: Name (str) of the reference pdb
+        peel_longer: Boolean telling if the peeled protein is longer (or not)
+        than the reference protein
+        nb_cpu: Number (int) of programs run at the same time
+
+    Returns:
+        The TMscores of parMATT and of the simple TMalignment
+    """
+    async def run_both():
+        return await asyncio.gather(
+            ext.parMATT_async(peeled_pdb_path, ref_pdb_path, peel_longer),
+            simple_TMalign(ref_pdb_id, peeled_pdb_id, peel_longer))
+
+    ext.set_max_children(nb_cpu)
+    return tuple(asyncio.run(run_both()))
+
+
+def peeled_TMalign_both(direction, direction_rev, nb_cpu, out_peel,
+                        out_peel_rev):
+    """
+    Peeled-TMalignments in both senses, sharing the pool of the aligning
+    processes (see peeling.peeled_TMaligns)
+
+    Args:
+        direction: Tuple of the arguments of a direction of
+        peeling.peeled_TMaligns (from ref_pdb_path to in_memory)
+        direction_rev: Same tuple, in the other sense
+        nb_cpu: Number (int) of processes aligning the PUs
+        out_peel: Output of the peeling of the peeled pdb
+        out_peel_rev: Output of the peeling of the reference pdb
+
+    Returns:
+        The results of both senses (see peeling.peeled_TMaligns)
+    """
+    return peel.peeled_TMaligns([direction + (out_peel,),
+                                 direction_rev + (out_peel_rev,)], nb_cpu)
+
+
 
 # MAIN:
 if __name__ == "__main__":
     # Get the different arguments:
     ARGS = docopt(__doc__, version='0.1')
-    TO_PEELED_PDB = ARGS["--peelPdb"]
-    TO_REF_PDB = ARGS["--refPdb"]
+    TO_PEELED_PDB = os.path.abspath(ARGS["--peelPdb"])
+    TO_REF_PDB = os.path.abspath(ARGS["--refPdb"])
     BENCH_MODE = check_bool_type(ARGS["--benchMode"])
     PEEL_CHAIN_ID = ARGS["--peelChain"]
     REF_CHAIN_ID = ARGS["--refChain"]
+    ext.set_backend(ARGS["--engine"])
+    INCR_MODE = ARGS["--incrMode"]
+    if INCR_MODE not in ("off", "strict", "fast"):
+        print("ERROR! Unknown incremental mode: " + INCR_MODE +
+              " (off, fast or strict)")
+        sys.exit(2)
+    # With the numpy engine, the PUs are aligned in memory (the files needed
+    # by TMalign are only written for debugging):
+    IN_MEMORY = (ARGS["--engine"] == "numpy" and
+                 not check_bool_type(ARGS["--debugFiles"]))
+    NB_CPU = ARGS["--nbCpu"]
+    if NB_CPU is not None:
+        if not NB_CPU.isdigit() or int(NB_CPU) < 1:
+            print("ERROR! The number of processes must be a positive integer")
+            sys.exit(2)
+        NB_CPU = int(NB_CPU)
 
-    # Creation of the results/ directory:
-    if not os.path.isdir("results"):
-        os.mkdir("results")
+    # The chains and the outputs of DSSP and of the peeling are cached across
+    # the runs if a directory is given (path taken from the launching
+    # directory):
+    if ARGS["--cacheDir"].lower() == "none":
+        ext.set_cache(None)
+    else:
+        ext.set_cache(os.path.abspath(ARGS["--cacheDir"]))
+
+    # The run is processed in its own workspace (with its results/ folder),
+    # so that several runs can be launched from the same directory:
+    LAUNCH_DIR = mio.open_workspace(ARGS["--scratchDir"])
+    WORK_DIR = os.getcwd()
 
-    # Extract first chain towards the results/ folder:
-    PEELED_PDB, PEELED_PDB_ID = mio.extract_chain(TO_PEELED_PDB, PEEL_CHAIN_ID)
-    REF_PDB, REF_PDB_ID = mio.extract_chain(TO_REF_PDB, REF_CHAIN_ID)
+    # Extract the chains (reindexed) towards the results/ folder, and parse
+    # them in the same pass:
+    PEELED_PDB, PEELED_PDB_ID, SIZE_PEELED, STRUCT_PEELED = read_chain(
+        TO_PEELED_PDB, PEEL_CHAIN_ID)
+    REF_PDB, REF_PDB_ID, SIZE_REF, STRUCT_REF = read_chain(TO_REF_PDB,
+                                                           REF_CHAIN_ID)
     PEELED_PDB_PATH = "results/" + PEELED_PDB
     REF_PDB_PATH = "results/" + REF_PDB
 
-    # Reindexing:
-    os.system("bin/reindex_pdb.py 1 " + PEELED_PDB_PATH + " " +
-              PEELED_PDB_PATH)
-    os.system("bin/reindex_pdb.py 1 " + REF_PDB_PATH + " " + REF_PDB_PATH)
-
-    # Get lines from the pdb (avoid several open):
-    with open(PEELED_PDB_PATH) as pdbFile_peeled, \
-         open(REF_PDB_PATH) as pdbFile_ref:
-        SIZE_PEELED, DICT_COORD_PEELED = mio.parse_pdb(pdbFile_peeled)
-        SIZE_REF, DICT_COORD_REF = mio.parse_pdb(pdbFile_ref)
-
     # Get which protein is longer than the other:
     PEEL_LONGER = False
     if SIZE_PEELED > SIZE_REF:
@@ -81,34 +210,51 @@ if __name__ == "__main__":
     print("SIZ_PEEL (" + PEELED_PDB_ID + "):", SIZE_PEELED)
     print("SIZ_REF (" + REF_PDB_ID + "):", SIZE_REF)
 
-    # With parMATT:
-    TM_parMATT = ext.parMATT(PEELED_PDB_PATH, REF_PDB_PATH, PEEL_LONGER)
+    # The stages of the run only depend on both chains, so they are run
+    # concurrently, sharing the CPUs of the run (the peeled-TMalignments of
+    # both senses share a pool, and wait for the peelings of both chains):
+    if NB_CPU is None:
+        NB_CPU = max(mp.cpu_count() - 1, 1)
+    PEEL_ARGS = (INCR_MODE, IN_MEMORY)
+    TASKS = {
+        "peeling": {"func": peel.peeling,
+                    "args": (PEELED_PDB_PATH, PEELED_PDB_ID)},
+        "peeling_rev": {"func": peel.peeling,
+                        "args": (REF_PDB_PATH, REF_PDB_ID)},
+        # parMATT and simple TMalignment between both pdb (started before the
+        # peeled-TMalignments, which would take all the free CPUs):
+        "whole_align": {"func": whole_alignments,
+                        "args": (PEELED_PDB_PATH, REF_PDB_PATH, PEELED_PDB_ID,
+                                 REF_PDB_ID, PEEL_LONGER),
+                        "nb_cpu": 2},
+        # Peeled-TMalignments (both senses), started with the CPUs left by
+        # whole_align if it is still running (the share of a task being set
+        # at launch, see tg.run_tasks):
+        "peeled_TMalign": {"func": peeled_TMalign_both,
+                           "args": ((REF_PDB_PATH, REF_PDB_ID, STRUCT_REF,
+                                     PEELED_PDB_PATH, PEELED_PDB_ID,
+                                     STRUCT_PEELED, PEEL_LONGER) + PEEL_ARGS,
+                                    (PEELED_PDB_PATH, PEELED_PDB_ID,
+                                     STRUCT_PEELED, REF_PDB_PATH, REF_PDB_ID,
+                                     STRUCT_REF, not PEEL_LONGER) + PEEL_ARGS),
+                           "inputs": {"out_peel": "peeling",
+                                      "out_peel_rev": "peeling_rev"},
+                           "nb_cpu": NB_CPU},
+    }
+    # The peeling executable writes its files in the working directory (as
+    # well for both chains if they have the same name):
+    if peel.peeling_writes_files() or PEELED_PDB_ID == REF_PDB_ID:
+        TASKS["peeling_rev"]["deps"] = ["peeling"]
+    RESULTS = tg.run_tasks(TASKS, NB_CPU)
 
-    # Peeled-TMalignment:
-    tuple_res = peel.peeled_TMalign(REF_PDB_PATH, REF_PDB_ID,
-                                    DICT_COORD_REF,
-                                    PEELED_PDB_PATH, PEELED_PDB_ID,
-                                    DICT_COORD_PEELED, PEEL_LONGER)
-    res_peel, list_nb_PU, res_gdt = tuple_res
+    TM_parMATT, TMscore_ref = RESULTS["whole_align"]
+    ((res_peel, list_nb_PU, res_gdt),
+     (res_peel_rev, list_nb_PU_rev, res_gdt_rev)) = RESULTS["peeled_TMalign"]
     idx_best_level = peel.get_best_level(res_peel, list_nb_PU)
     idx_best_gdt = peel.get_best_level(res_gdt, list_nb_PU)
-
-    # Peeled-TMalignment (other sense):
-    print("\nNOW REVERSE ORDER")
-    tuple_res_rev = peel.peeled_TMalign(PEELED_PDB_PATH, PEELED_PDB_ID,
-                                        DICT_COORD_PEELED,
-                                        REF_PDB_PATH, REF_PDB_ID,
-                                        DICT_COORD_REF, not PEEL_LONGER)
-    res_peel_rev, list_nb_PU_rev, res_gdt_rev = tuple_res_rev
     idx_best_level_rev = peel.get_best_level(res_peel_rev, list_nb_PU_rev)
     idx_best_gdt_rev = peel.get_best_level(res_gdt_rev, list_nb_PU_rev)
 
-    # Simple TMalignment between both pdb:
-    TMscore_ref = ext.TM_align(REF_PDB_ID, PEELED_PDB_ID, PEEL_LONGER)
-    # Cleaning files from TMalign:
-    for extension in ('.sup_atm', '.sup_all_atm'):
-        os.remove("results/" + REF_PDB_ID + extension)
-
     # Variables to write:
     best_peel_TM = res_peel[idx_best_level]
     best_peel_TM_rev = res_peel_rev[idx_best_level_rev]
@@ -123,13 +269,20 @@ if __name__ == "__main__":
     print("Best peeled TMscore (rev):", best_peel_TM_rev)
     print("Max of peeled TMscores", max_peel_TM)
     print("parMATT TMscore:", TM_parMATT, '\n')
+    # Hits and misses of the caches (the lookups of the tasks being saved
+    # when their processes exit):
+    ext.report_cache_stats()
 
     # Cleaning remaning useless files:
     os.remove("results/" + PEELED_PDB_ID + '.pdb')
     os.remove("results/" + REF_PDB_ID + '.pdb')
+    # Back to the launching directory, with the models of the PUs:
+    mio.close_workspace(LAUNCH_DIR, WORK_DIR)
 
-    # Plot of the curves associated with the peeled-TMalign:
+    # Plot of the curves associated with the peeled-TMalign (matplotlib is
+    # only imported here, the benchmarking running main.py for every pair):
     if not BENCH_MODE:
+        import src.plotting as plot
         plot.display_curve(list_nb_PU, list_nb_PU_rev, res_peel, res_peel_rev,
                       res_gdt, res_gdt_rev,
                       REF_PDB_ID, PEELED_PDB_ID, TM_parMATT, TMscore_ref)
@@ -6,16 +6,423 @@ Module gethering all the functions that run external programs
 
 import re
 import os
+import sys
+import json
+import fcntl
+import ctypes
+import asyncio
+import hashlib
+import weakref
+import threading
 import subprocess as sub
+import multiprocessing.util as mpu
+import numpy as np
 import src.manage_io as mio
+import src.tm_engine as tme
 import urllib.request as urlreq
 import pyquery as pyq
 
 
+# Backend used for the TM computations: "binary" (executables from bin/) or
+# "numpy" (in-process engine of src/tm_engine.py)
+BACKEND = "binary"
+
+# Directory of the caches of the outputs of the external programs (None for
+# no cache), one sub-directory per cache (see cache_get and cache_put)
+CACHE_DIR = None
+# Maximal size (bytes) of each cache, the least recently used files being
+# removed beyond it:
+CACHE_MAX_SIZE = 256 * 2**20
+# Lookups of each cache counted by this process (and the process counting
+# them), added to the statistics of the caches when it exits (see
+# save_cache_stats):
+_CACHE_STATS = {}
+_STATS_PID = None
+
+# Shared library of the peeling program (built from bin/peel_fixed_1.c, see
+# the README), loaded at its first use by peel_lib:
+PEEL_LIB_PATH = "bin/libpeel.so"
+_PEEL_LIB = None
+# The program keeps its state in global variables, and ctypes releases the
+# GIL during the call, so the calls are serialized:
+_PEEL_LOCK = threading.Lock()
+# Bounds of the program on the number of levels and of PUs per level:
+PEEL_MAX_LEVELS = 32
+PEEL_MAX_PU = 128
+
+# Maximal number of external programs run at the same time by the async
+# functions of this module (see run_async), with the semaphore bounding them
+# in each event loop:
+MAX_CHILDREN = os.cpu_count() or 1
+_SEMAPHORES = weakref.WeakKeyDictionary()
+
+
+def set_backend(backend):
+    """
+    Select the backend used by the TM functions of this module
+
+    Args:
+        backend: Name (str) of the backend, "binary" or "numpy"
+    """
+    global BACKEND
+
+    if backend not in ("binary", "numpy"):
+        print("ERROR! Unknown backend: " + backend + " (binary or numpy)")
+        sys.exit(2)
+    BACKEND = backend
+
+
+def set_max_children(nb_children):
+    """
+    Set the maximal number of external programs run at the same time by the
+    async functions of this module
+
+    Args:
+        nb_children: Number (int) of programs
+    """
+    global MAX_CHILDREN
+
+    MAX_CHILDREN = nb_children
+    _SEMAPHORES.clear()
+
+
+async def run_async(cmd_line):
+    """
+    Run an external program from an event loop, without blocking it: at most
+    MAX_CHILDREN programs are run at the same time, the other ones waiting
+    for their turn
+
+    Args:
+        cmd_line: Command line (str) of the program
+
+    Returns:
+        The standard output (bytes) of the program
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _SEMAPHORES:
+        _SEMAPHORES[loop] = asyncio.Semaphore(MAX_CHILDREN)
+
+    async with _SEMAPHORES[loop]:
+        process = await asyncio.create_subprocess_exec(
+            *cmd_line.split(), stdout=asyncio.subprocess.PIPE)
+        return (await process.communicate())[0]
+
+
+def set_cache(cache_dir):
+    """
+    Select the directory of the caches used by cache_get and cache_put
+
+    Args:
+        cache_dir: Path (str) of the directory, None to disable the caches
+    """
+    global CACHE_DIR
+
+    CACHE_DIR = cache_dir
+
+
+def atoms_key(pdb_path, params=""):
+    """
+    Key of the output of a program run on a pdb: hash of its atoms (names,
+    residues and coordinates, the atom numbers being ignored) and of the
+    parameters of the program
+
+    Args:
+        pdb_path: Path (str) to the pdb
+        params: Parameters (str) of the program
+
+    Returns:
+        The hexadecimal digest (str) of the atoms and parameters
+    """
+    hasher = hashlib.sha256(params.encode())
+    with open(pdb_path, 'rb') as pdb_file:
+        for line in pdb_file:
+            if line[0:4] == b"ATOM" or line[0:6] == b"HETATM":
+                hasher.update(line[12:54])
+
+    return hasher.hexdigest()
+
+
+def file_key(file_path, params=""):
+    """
+    Key of a result read from a file: hash of the content of the file and of
+    the parameters of the reading
+
+    Args:
+        file_path: Path (str) to the file
+        params: Parameters (str) of the reading
+
+    Returns:
+        The hexadecimal digest (str) of the file and parameters
+    """
+    hasher = hashlib.sha256(params.encode())
+    with open(file_path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(2**20), b''):
+            hasher.update(block)
+
+    return hasher.hexdigest()
+
+
+def evict_cache(cache_path):
+    """
+    Remove the least recently used files of a cache if it is too big
+    The caches being shared by the runs processed at the same time, this is
+    done under a lock
+
+    Args:
+        cache_path: Path (str) of the directory of the cache
+    """
+    with open(os.path.join(cache_path, ".lock"), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        # The last use of a file is its modification time:
+        list_cached = []
+        for filename in os.listdir(cache_path):
+            if filename.endswith(".out"):
+                file_stat = os.stat(os.path.join(cache_path, filename))
+                list_cached.append((file_stat.st_mtime, file_stat.st_size,
+                                    filename))
+        cache_size = sum(size for _, size, _ in list_cached)
+        for _, size, filename in sorted(list_cached):
+            if cache_size <= CACHE_MAX_SIZE:
+                break
+            os.remove(os.path.join(cache_path, filename))
+            cache_size -= size
+
+
+def count_lookup(cache_name, hit):
+    """
+    Count a lookup of a cache in this process (see save_cache_stats)
+
+    Args:
+        cache_name: Name (str) of the cache
+        hit: Boolean telling if the lookup found the key
+    """
+    global _STATS_PID
+
+    # The counts of a forked process start from zero, and are saved when it
+    # exits (the processes of multiprocessing run its finalizers, but not the
+    # atexit functions):
+    if _STATS_PID != os.getpid():
+        _STATS_PID = os.getpid()
+        _CACHE_STATS.clear()
+        mpu.Finalize(None, save_cache_stats, exitpriority=10)
+
+    stats = _CACHE_STATS.setdefault(cache_name, {"hits": 0, "misses": 0})
+    stats["hits" if hit else "misses"] += 1
+
+
+def save_cache_stats():
+    """
+    Add the lookups counted by this process to the statistics of the caches
+    (stats.json of each cache, updated under its lock)
+    """
+    for cache_name, counts in _CACHE_STATS.items():
+        cache_path = os.path.join(CACHE_DIR, cache_name)
+        stats_path = os.path.join(cache_path, "stats.json")
+        os.makedirs(cache_path, exist_ok=True)
+
+        with open(os.path.join(cache_path, ".lock"), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            stats = {"hits": 0, "misses": 0}
+            if os.path.isfile(stats_path):
+                with open(stats_path) as stats_file:
+                    stats = json.load(stats_file)
+            for count in counts:
+                stats[count] += counts[count]
+            with open(stats_path + ".tmp", 'w') as stats_file:
+                json.dump(stats, stats_file)
+            os.replace(stats_path + ".tmp", stats_path)
+
+    _CACHE_STATS.clear()
+
+
+def report_cache_stats():
+    """
+    Print the statistics of the caches (hits and misses of all the runs), the
+    lookups of this process being saved first
+    """
+    if CACHE_DIR is None:
+        return
+
+    save_cache_stats()
+    for cache_name in sorted(os.listdir(CACHE_DIR)):
+        stats_path = os.path.join(CACHE_DIR, cache_name, "stats.json")
+        if os.path.isfile(stats_path):
+            with open(stats_path) as stats_file:
+                stats = json.load(stats_file)
+            print(cache_name + " cache: " + str(stats["hits"]) + " hits, " +
+                  str(stats["misses"]) + " misses")
+
+
+def cache_get(cache_name, key):
+    """
+    Look for the output of a program in a cache
+
+    Args:
+        cache_name: Name (str) of the cache (e.g. "dssp")
+        key: Key (str) of the output (see atoms_key)
+
+    Returns:
+        The output (str), None if it is not in the cache (or if the caches
+        are disabled)
+    """
+    cached_path = cache_lookup(cache_name, key)
+    if cached_path is None:
+        return None
+
+    try:
+        with open(cached_path) as cached_file:
+            return cached_file.read()
+    except FileNotFoundError: # Removed by another run in the meantime
+        return None
+
+
+def cache_lookup(cache_name, key):
+    """
+    Look for a file in a cache, to be read by the caller (e.g. memory-mapped,
+    for the binary files)
+
+    Args:
+        cache_name: Name (str) of the cache (e.g. "dssp")
+        key: Key (str) of the file (see atoms_key and file_key)
+
+    Returns:
+        The path (str) of the cached file, None if it is not in the cache (or
+        if the caches are disabled)
+    """
+    if CACHE_DIR is None:
+        return None
+
+    cached_path = os.path.join(CACHE_DIR, cache_name, key + ".out")
+    # The last use of a file is its modification time (see evict_cache):
+    try:
+        os.utime(cached_path)
+    except FileNotFoundError:
+        cached_path = None
+    count_lookup(cache_name, cached_path is not None)
+
+    return cached_path
+
+
+def cache_put(cache_name, key, output):
+    """
+    Store the output of a program in a cache (nothing is done for an empty
+    output, i.e. a failed run, or if the caches are disabled)
+
+    Args:
+        cache_name: Name (str) of the cache (e.g. "dssp")
+        key: Key (str) of the output (see atoms_key and file_key)
+        output: Output (str, or bytes for a binary file) to store
+    """
+    if CACHE_DIR is None or not output:
+        return
+
+    cache_path = os.path.join(CACHE_DIR, cache_name)
+    cached_path = os.path.join(cache_path, key + ".out")
+    os.makedirs(cache_path, exist_ok=True)
+    # The file is renamed once complete, so that other runs never read a
+    # partial file:
+    with open(cached_path + '.' + str(os.getpid()),
+              'wb' if isinstance(output, bytes) else 'w') as cached_file:
+        cached_file.write(output)
+    os.replace(cached_path + '.' + str(os.getpid()), cached_path)
+
+    # The cache only grows here, so it is the only place where it can
+    # exceed its maximal size:
+    evict_cache(cache_path)
+
+
+def dssp(pdb_path):
+    """
+    Run the dssp binary on a pdb, or take its output from the "dssp" cache if
+    the same chain (same atoms and coordinates) was already processed
+
+    Args:
+        pdb_path: Path (str) to the pdb
+
+    Returns:
+        The content (str) of the DSSP file
+    """
+    key = atoms_key(pdb_path)
+    output = cache_get("dssp", key)
+
+    if output is None:
+        output = sub.Popen(["bin/dssp64", "-i", pdb_path],
+                           stdout=sub.PIPE).communicate()[0].decode()
+        cache_put("dssp", key, output)
+
+    return output
+
+
+def load_peel_lib():
+    """
+    Load the shared library of the peeling program and declare the types of
+    its entry point (peel_arrays)
+
+    Returns:
+        The peel_arrays function of the library
+    """
+    global _PEEL_LIB
+
+    if _PEEL_LIB is None:
+        int_array = np.ctypeslib.ndpointer(np.int32, flags="C_CONTIGUOUS")
+        float_array = np.ctypeslib.ndpointer(np.float32, flags="C_CONTIGUOUS")
+        peel_arrays = ctypes.CDLL(os.path.abspath(PEEL_LIB_PATH)).peel_arrays
+        peel_arrays.argtypes = ([ctypes.c_int, int_array, ctypes.c_int,
+                                 int_array] + [ctypes.c_int] * 4 +
+                                [ctypes.c_float] * 2 + [ctypes.c_int] * 2 +
+                                [ctypes.c_float, float_array, float_array,
+                                 int_array, int_array])
+        peel_arrays.restype = ctypes.c_int
+        _PEEL_LIB = peel_arrays
+
+    return _PEEL_LIB
+
+
+def peel_lib(coords, sec_struct, peel_args):
+    """
+    Run the peeling program in-process, through its shared library: the
+    arrays are given directly to the C code, so no process is launched and
+    no file is written (as the DSSP and contact files of the executable)
+
+    Args:
+        coords: Array (L, 3) of the coordinates of the CA, as read by the
+        program (see peel_engine.read_CA)
+        sec_struct: Array of the secondary structures (see
+        peel_engine.read_dssp)
+        peel_args: Tuple of the 9 numerical parameters of the program (see
+        peeling.peeling)
+
+    Returns:
+        The list of the levels, as tuples of their CI, R and array (n_PU, 2)
+        of the bounds of their units (as peel_engine.peel), None if the
+        protein is too big for the program (more than 1024 residues)
+    """
+    peel_arrays = load_peel_lib()
+    coords = np.ascontiguousarray(coords, dtype=np.int32)
+    sec_struct = np.ascontiguousarray(sec_struct, dtype=np.int32)
+    out_CI = np.zeros(PEEL_MAX_LEVELS, dtype=np.float32)
+    out_R = np.zeros(PEEL_MAX_LEVELS, dtype=np.float32)
+    out_nb_PU = np.zeros(PEEL_MAX_LEVELS, dtype=np.int32)
+    out_bounds = np.zeros((PEEL_MAX_LEVELS, PEEL_MAX_PU, 2), dtype=np.int32)
+
+    with _PEEL_LOCK:
+        nb_levels = peel_arrays(len(coords), coords, len(sec_struct),
+                                sec_struct, *peel_args, out_CI, out_R,
+                                out_nb_PU, out_bounds)
+    if nb_levels < 0:
+        return None
+
+    return [(float(out_CI[i]), float(out_R[i]), out_bounds[i, :out_nb_PU[i]])
+            for i in range(nb_levels)]
+
+
 def TM_score(peeled_pdb_path, ref_pdb_path, peel_longer):
     """
-    Using the TMscore binary, calculate the TMscore of a given pdb, containing
-    all aligned PUs and the reference pdb (so no alignment is processed)
+    Using the TMscore binary (or the NumPy engine, according to BACKEND),
+    calculate the TMscore of a given pdb, containing all aligned PUs and the
+    reference pdb (so no alignment is processed)
 
     Args:
         peeled_pdb_path: Path (str) to pdb that has been peeled (or just the
@@ -27,12 +434,59 @@ def TM_score(peeled_pdb_path, ref_pdb_path, peel_longer):
     Returns:
         The value of the associated TMscore (or -1 if no matching residues)
     """
+    if BACKEND == "numpy":
+        if peel_longer:
+            model_path, native_path = peeled_pdb_path, ref_pdb_path
+        else:
+            model_path, native_path = ref_pdb_path, peeled_pdb_path
+        coords_model, resIDs_model = mio.get_CA_coords(model_path)
+        coords_native, resIDs_native = mio.get_CA_coords(native_path)
+
+        TMscore = tme.TM_score_coords(coords_model, resIDs_model,
+                                      coords_native, resIDs_native)
+        # Same precision than the output of the binary:
+        return round(TMscore, 4)
+
+    cmdLine_TM = _TM_score_cmd(peeled_pdb_path, ref_pdb_path, peel_longer)
+    out_TM = sub.Popen(cmdLine_TM.split(), stdout=sub.PIPE).communicate()[0]
+
+    return _parse_TM_score(out_TM)
+
+
+async def TM_score_async(peeled_pdb_path, ref_pdb_path, peel_longer):
+    """
+    Same as TM_score, the TMscore binary being run without blocking the event
+    loop (see run_async), as well as the NumPy engine (run in a thread of the
+    default executor of the loop)
+    """
+    if BACKEND == "numpy":
+        return await asyncio.get_running_loop().run_in_executor(
+            None, TM_score, peeled_pdb_path, ref_pdb_path, peel_longer)
+
+    out_TM = await run_async(_TM_score_cmd(peeled_pdb_path, ref_pdb_path,
+                                           peel_longer))
+
+    return _parse_TM_score(out_TM)
+
+
+def _TM_score_cmd(peeled_pdb_path, ref_pdb_path, peel_longer):
+    """
+    Returns:
+        The command line (str) of the TMscore binary (see TM_score)
+    """
     if peel_longer:
-        cmdLine_TM = ("bin/TMscore64 " + peeled_pdb_path + " " + ref_pdb_path)
-    else:
-        cmdLine_TM = ("bin/TMscore64 " + ref_pdb_path + " " + peeled_pdb_path)
+        return ("bin/TMscore64 " + peeled_pdb_path + " " + ref_pdb_path)
+    return ("bin/TMscore64 " + ref_pdb_path + " " + peeled_pdb_path)
 
-    out_TM = sub.Popen(cmdLine_TM.split(), stdout=sub.PIPE).communicate()[0]
+
+def _parse_TM_score(out_TM):
+    """
+    Args:
+        out_TM: Output (bytes) of the TMscore binary
+
+    Returns:
+        The value of the TMscore (or -1 if no matching residues)
+    """
     lines_TM = out_TM.decode()
 
     regex_TMscore = re.compile("(?:TM-score.+= )([0-9]\.[0-9]*)[ $]")
@@ -58,34 +512,67 @@ def parMATT(peeled_pdb_path, ref_pdb_path, peel_longer):
         The value of TMscore associated with the structures aligned with
         parMATT (normalized by the longest protein)
     """
-    cmdLine_parMatt = ("bin/parMATT/bin/parMatt64 " + ref_pdb_path + " " +
-                       peeled_pdb_path + " -f pdb -t 1 -o output")
-
+    cmdLine_parMatt = _parMATT_cmd(peeled_pdb_path, ref_pdb_path)
     out_parMatt = sub.Popen(cmdLine_parMatt.split(),
                             stdout=sub.PIPE).communicate()[0]
 
-    # parMATT produces a single PDB file with both (aligned) structures inside
-    # So we need to exctract to extract both chains (each structure) to give
-    # them as argument to the TMscore program
-    PEELED_PDB, PEELED_PDB_ID = mio.extract_chain("output.pdb", "A")
-    REF_PDB, REF_PDB_ID = mio.extract_chain("output.pdb", "B")
-
+    _split_parMATT()
     TMscore = TM_score("results/outputA.pdb", "results/outputB.pdb",
                        peel_longer)
+    _clean_parMATT()
+
+    return TMscore
+
+
+async def parMATT_async(peeled_pdb_path, ref_pdb_path, peel_longer):
+    """
+    Same as parMATT, the binaries being run without blocking the event loop
+    (see run_async)
+    """
+    await run_async(_parMATT_cmd(peeled_pdb_path, ref_pdb_path))
+
+    _split_parMATT()
+    TMscore = await TM_score_async("results/outputA.pdb",
+                                   "results/outputB.pdb", peel_longer)
+    _clean_parMATT()
+
+    return TMscore
+
+
+def _parMATT_cmd(peeled_pdb_path, ref_pdb_path):
+    """
+    Returns:
+        The command line (str) of the parMATT binary (see parMATT)
+    """
+    return ("bin/parMATT/bin/parMatt64 " + ref_pdb_path + " " +
+            peeled_pdb_path + " -f pdb -t 1 -o output")
+
+
+def _split_parMATT():
+    """
+    parMATT produces a single PDB file with both (aligned) structures inside
+    So we need to exctract to extract both chains (each structure) to give
+    them as argument to the TMscore program
+    """
+    mio.extract_chain("output.pdb", "A")
+    mio.extract_chain("output.pdb", "B")
+
 
-    # Remove useless files produced by parMATT:
+def _clean_parMATT():
+    """
+    Remove useless files produced by parMATT
+    """
     os.remove("output.pdb")
     os.remove("results/outputA.pdb")
     os.remove("results/outputB.pdb")
 
-    return TMscore
-
 
 def TM_align(PU_name, ref_pdb_name, peel_longer):
     """
-    Using the TMalign binary, proceed to a structural alignment between a given
-    PU and the reference pdb (TMscore is returned as the stdout of TMalign
-    program)
+    Using the TMalign binary (or the NumPy engine, according to BACKEND),
+    proceed to a structural alignment between a given PU and the reference pdb
+    (TMscore is returned as the stdout of TMalign program)
+    The superposition is written in the .sup_atm and .sup_all_atm files
 
     Args:
         PU_name: Name (str) of the PU to align
@@ -96,11 +583,54 @@ def TM_align(PU_name, ref_pdb_name, peel_longer):
     Returns:
         The value of the associated TMscore (normalized by the longest protein)
     """
-    cmdLine_TM = ("bin/TMalign64 results/" + PU_name + '.pdb' +
-                  " results/" + ref_pdb_name + '.pdb' + " -o " + "results/" +
-                  PU_name + '.sup')
+    if BACKEND == "numpy":
+        return TM_align_batch([PU_name], ref_pdb_name, peel_longer)[0]
 
+    cmdLine_TM = _TM_align_cmd(PU_name, ref_pdb_name)
     out_TM = sub.Popen(cmdLine_TM.split(), stdout=sub.PIPE).communicate()[0]
+
+    return _parse_TM_align(out_TM, PU_name, peel_longer)
+
+
+async def TM_align_async(PU_name, ref_pdb_name, peel_longer):
+    """
+    Same as TM_align, the TMalign binary being run without blocking the event
+    loop (see run_async), as well as the NumPy engine (run in a thread of the
+    default executor of the loop)
+    """
+    if BACKEND == "numpy":
+        return await asyncio.get_running_loop().run_in_executor(
+            None, TM_align, PU_name, ref_pdb_name, peel_longer)
+
+    out_TM = await run_async(_TM_align_cmd(PU_name, ref_pdb_name))
+
+    return _parse_TM_align(out_TM, PU_name, peel_longer)
+
+
+def _TM_align_cmd(PU_name, ref_pdb_name):
+    """
+    Returns:
+        The command line (str) of the TMalign binary (see TM_align)
+    """
+    return ("bin/TMalign64 results/" + PU_name + '.pdb' +
+            " results/" + ref_pdb_name + '.pdb' + " -o " + "results/" +
+            PU_name + '.sup')
+
+
+def _parse_TM_align(out_TM, PU_name, peel_longer):
+    """
+    Get the TMscore from the output of the TMalign binary, and remove the
+    files of the superposition that are not used
+
+    Args:
+        out_TM: Output (bytes) of the TMalign binary
+        PU_name: Name (str) of the aligned PU
+        peel_longer: Boolean telling if the peeled protein is longer (or not)
+        than the reference protein
+
+    Returns:
+        The value of the TMscore (normalized by the longest protein)
+    """
     lines_TM = out_TM.decode()
 
     if peel_longer: # If peeled prot is longer, we get "normalized by chain 2"
@@ -116,10 +646,102 @@ def TM_align(PU_name, ref_pdb_name, peel_longer):
     return float(searchObj.group(1))
 
 
+def TM_align_batch(list_PU_names, ref_pdb_name, peel_longer):
+    """
+    Align several PUs against the same reference pdb: with the NumPy engine,
+    all the PUs are aligned in a single vectorized call (else TMalign is run
+    for each PU)
+    The superposition of each PU is written in its .sup_atm and .sup_all_atm
+    files
+
+    Args:
+        list_PU_names: Names (list of str) of the PUs to align
+        ref_pdb_name: Name (str) of the PDB to align against
+        peel_longer: Boolean telling if the peeled protein is longer (or not)
+        than the reference protein
+
+    Returns:
+        The list of the TMscores (float) of the PUs (normalized by the
+        longest protein)
+    """
+    if BACKEND != "numpy":
+        return [TM_align(PU_name, ref_pdb_name, peel_longer)
+                for PU_name in list_PU_names]
+
+    atoms_ref, coords_ref = mio.get_atoms("results/" + ref_pdb_name + '.pdb')
+    list_atoms_PU, list_coords_PU = [], []
+    for PU_name in list_PU_names:
+        atoms_PU, coords_PU = mio.get_atoms("results/" + PU_name + '.pdb')
+        list_atoms_PU.append(atoms_PU)
+        list_coords_PU.append(coords_PU)
+
+    TMscores, rot, trans, list_algnd_PU, list_algnd_ref = TM_align_atoms(
+        list_atoms_PU, list_coords_PU, atoms_ref, coords_ref, peel_longer)
+
+    for i, PU_name in enumerate(list_PU_names):
+        mio.write_sup_atm("results/" + PU_name + '.sup', list_atoms_PU[i],
+                          tme.transform(list_coords_PU[i], rot[i], trans[i]),
+                          list_algnd_PU[i], atoms_ref, coords_ref,
+                          list_algnd_ref[i])
+
+    return TMscores
+
+
+def TM_align_atoms(list_atoms_PU, list_coords_PU, atoms_ref, coords_ref,
+                   peel_longer):
+    """
+    Align several PUs against the same reference, given as atoms in memory
+    (NumPy engine only), in a single vectorized call
+
+    Args:
+        list_atoms_PU: List of the atoms of each PU (see mio.get_atoms)
+        list_coords_PU: List of the coordinates (arrays) of each PU
+        atoms_ref: List of the atoms of the reference
+        coords_ref: Array of the coordinates of the reference
+        peel_longer: Boolean telling if the peeled protein is longer (or not)
+        than the reference protein
+
+    Returns:
+        The list of the TMscores (float) of the PUs (normalized by the
+        longest protein), the rotations (B, 3, 3) and translations (B, 3)
+        superposing each PU onto the reference (see tme.transform) and the
+        lists of the sets of aligned residue IDs (number, insertion code) of
+        each PU and of the reference
+    """
+    CA_ref = [idx for idx, atom in enumerate(atoms_ref)
+              if atom[1].strip() == "CA"]
+    list_CA_PU = [[idx for idx, atom in enumerate(atoms_PU)
+                   if atom[1].strip() == "CA"] for atoms_PU in list_atoms_PU]
+
+    # All the PUs are stacked, to be aligned in a single call:
+    coords_CA, len_CA, resnums_CA = tme.stack_structures(
+        [coords[CA] for coords, CA in zip(list_coords_PU, list_CA_PU)],
+        [[atoms[idx][3] for idx in CA]
+         for atoms, CA in zip(list_atoms_PU, list_CA_PU)])
+    TM_PU, TM_ref, rot, trans, list_pairs = tme.TM_align_batch(
+        coords_CA, len_CA, resnums_CA, coords_ref[CA_ref],
+        [atoms_ref[idx][3] for idx in CA_ref])
+
+    list_algnd_PU, list_algnd_ref = [], []
+    for i, atoms_PU in enumerate(list_atoms_PU):
+        CA_PU, pairs = list_CA_PU[i], list_pairs[i]
+        list_algnd_PU.append({atoms_PU[CA_PU[idx]][3:5]
+                              for idx in pairs[:, 0]})
+        list_algnd_ref.append({atoms_ref[CA_ref[idx]][3:5]
+                               for idx in pairs[:, 1]})
+
+    # Same precision (and type) than the output of the binary:
+    TMscores = [round(float(TM), 5) for TM in (TM_ref if peel_longer
+                                               else TM_PU)]
+
+    return (TMscores, rot, trans, list_algnd_PU, list_algnd_ref)
+
+
 def gdt_pl(PU_alignd_file, ref_pdb_path, peel_longer):
     """
-    Run the gdt.pl script, to get a maximized TMscore for the alignment between
-    aligned PUs and reference PDB
+    Get a maximized TMscore for the alignment between aligned PUs and
+    reference PDB, computed in-process as the gdt.pl script does (see
+    tme.gdt_scores)
 
     Args:
         PU_alignd_file: Path to the pdb file gethering all aligned PUs
@@ -131,31 +753,20 @@ def gdt_pl(PU_alignd_file, ref_pdb_path, peel_longer):
         The value of the maximized TMscore between both structures
     """
     PU_pdb_path = "results/" + PU_alignd_file + '.pdb'
-    tmp_file = PU_alignd_file + ".pdb"
 
-    # Creation of the input file for the gdt.pl script:
+    # Same order of the structures than the input file of the script:
     if peel_longer:
-        os.system("cat " + ref_pdb_path + " > " + tmp_file)
-        os.system("echo TER >> " + tmp_file)
-        os.system("cat " + PU_pdb_path + " >> " + tmp_file)
+        list_paths = (ref_pdb_path, PU_pdb_path)
     else:
-        os.system("cat " + PU_pdb_path + " > " + tmp_file)
-        os.system("echo TER >> " + tmp_file)
-        os.system("cat " + ref_pdb_path + " >> " + tmp_file)
-    os.system("echo TER >> " + tmp_file)
-
-    cmdLine_gdt = ("perl bin/gdt.pl " + tmp_file)
-
-    out_gdt = sub.Popen(cmdLine_gdt.split(), stdout=sub.PIPE).communicate()[0]
-    lines_gdt = out_gdt.decode()
-
-    # We get the TMscore by the chain 2, because it corresponds to the longer
-    # protein
-    regex_gdt = re.compile("(?:TM-score.+)([0]\.[0-9]*)(?:.+Chain 2)")
-    searchObj = re.search(regex_gdt, lines_gdt)
-    os.remove(tmp_file)
-
-    return float(searchObj.group(1))
+        list_paths = (PU_pdb_path, ref_pdb_path)
+    coords_1, coords_2 = [mio.get_CA_coords(pdb_path, np.float64)[0]
+                          for pdb_path in list_paths]
+
+    # The TMscore used is the one written for the "Chain 2" by the script,
+    # which is normalized by the length of its 1st structure:
+    TMscore = tme.gdt_scores(coords_1, coords_2)[0]
+    # Same precision than the output of the script:
+    return float("%5.3f" % TMscore)
 
 
 class AppURLopener(urlreq.FancyURLopener):
@@ -6,6 +6,76 @@ It contains parsing and writting functions.
 """
 
 import os
+import sys
+import bz2
+import gzip
+import mmap
+import atexit
+import shutil
+import signal
+import tempfile
+import numpy as np
+import src.structure as strc
+
+
+# Functions opening the compressed pdb files (e.g. .pdb.gz, .ent.gz), by
+# extension:
+COMPRESSED_OPENERS = {".gz": gzip.open, ".bz2": bz2.open}
+
+
+def open_workspace(scratch_root=None):
+    """
+    Create a scratch directory for the run and move into it, so that several
+    runs can be processed at the same time: each run gets its own results/
+    and data/ folders (and the files written by the external programs in the
+    working directory), bin/ being a link to the one of the launching
+    directory
+    The workspace is removed at the end of the run (see close_workspace), even
+    if the run is stopped by an error or a SIGTERM
+
+    Args:
+        scratch_root: Directory (str) where the workspace is created (e.g. a
+        tmpfs as /dev/shm), None for the default temporary directory
+
+    Returns:
+        The path (str) of the launching directory
+    """
+    launch_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="peelalign_", dir=scratch_root)
+
+    os.symlink(os.path.join(launch_dir, "bin"), os.path.join(work_dir, "bin"))
+    os.mkdir(os.path.join(work_dir, "results"))
+    os.mkdir(os.path.join(work_dir, "data"))
+    os.chdir(work_dir)
+
+    atexit.register(close_workspace, launch_dir, work_dir)
+    # A SIGTERM leads to a normal exit, so the workspace is cleaned:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    return launch_dir
+
+
+def close_workspace(launch_dir, work_dir):
+    """
+    Go back to the launching directory and remove the workspace of the run,
+    the files left in its results/ folder being moved to the results/ folder
+    of the launching directory
+
+    Args:
+        launch_dir: Path (str) of the launching directory
+        work_dir: Path (str) of the workspace
+    """
+    atexit.unregister(close_workspace)
+    os.chdir(launch_dir)
+    if not os.path.isdir(work_dir):
+        return
+
+    os.makedirs("results", exist_ok=True)
+    for filename in os.listdir(os.path.join(work_dir, "results")):
+        # Not os.rename, as the workspace can be on another file system:
+        shutil.move(os.path.join(work_dir, "results", filename),
+                    os.path.join("results", filename))
+    shutil.rmtree(work_dir)
 
 
 def extract_chain(pdb_path, chain_id_arg='first'):
@@ -60,46 +130,322 @@ def extract_chain(pdb_path, chain_id_arg='first'):
 
     # Rename file, in the case where no chain had been specified:
     if chain_id_arg == 'first':
-        os.system("mv " + out_filename + " results/" + pdb_id +
-                  first_chain_id + '.pdb')
+        os.replace(out_filename,
+                   "results/" + pdb_id + first_chain_id + '.pdb')
         return (pdb_id + first_chain_id + '.pdb', pdb_id + first_chain_id)
 
     return (pdb_id + chain_id_arg + '.pdb', pdb_id + chain_id_arg)
 
 
-def parse_pdb(pdb_file):
+def parse_chain(pdb_path, chain_id_arg='first'):
+    """
+    Read a chain of a pdb in a single pass: the chain is selected (as done by
+    extract_chain), its residues are renumbered from 1 (as done by
+    bin/reindex_pdb.py, that only keeps the ATOM lines and the 1st alternative
+    location) and its atoms are stored into a Structure (see write_chain for
+    the file of the renumbered chain)
+    The file is memory-mapped and its lines are indexed in one vectorized
+    scan, only the lines of the chain being copied (see select_chain)
+    A compressed pdb (see COMPRESSED_OPENERS) is decompressed in memory,
+    without any decompressed file
+
+    Args:
+        pdb_path: Path (str) to the pdb file, from which the chain will be
+            extracted
+        chain_id_arg: The ID (str, 1 or 2 letters) of the chain to extract
+
+    Returns:
+        The Structure of the atoms of the chain
+    """
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(pdb_path)[1])
+
+    if opener is not None:
+        with opener(pdb_path, 'rb') as pdb_in:
+            columns = select_chain(pdb_in.read(), chain_id_arg)
+    else:
+        with open(pdb_path, 'rb') as pdb_in:
+            if os.fstat(pdb_in.fileno()).st_size:
+                with mmap.mmap(pdb_in.fileno(), 0,
+                               access=mmap.ACCESS_READ) as pdb_map:
+                    columns = select_chain(pdb_map, chain_id_arg)
+            else: # An empty file can not be mapped
+                columns = np.empty((0, 80), dtype=np.uint8)
+
+    if not len(columns):
+        print("ERROR! The chain ID you specified does not belong to " +
+              pdb_path + ' !\n')
+        sys.exit(1)
+
+    return strc.Structure.from_columns(columns)
+
+
+def write_chain(pdb_path, structure):
+    """
+    Write a chain read from a pdb (see parse_chain) in the results/ folder,
+    its file being named after the pdb and the chain ID
+
+    Args:
+        pdb_path: Path (str) to the pdb file, from which the chain was
+            extracted (its compression extension being dropped)
+        structure: Structure of the chain
+
+    Returns:
+        The name of the file (with .pdb extension)
+        The pdb id (without .pdb extension)
+        The size of the chain and its Structure
+    """
+    pdb_name = os.path.basename(pdb_path) # With .pdb extension
+    if os.path.splitext(pdb_name)[1] in COMPRESSED_OPENERS:
+        pdb_name = os.path.splitext(pdb_name)[0]
+    pdb_id = os.path.splitext(pdb_name)[0] # Without .pdb extension
+    # The chain ID is the one of the 1st residue label:
+    chain_id = structure.labels[structure.label_idx[0]][4:5].decode().strip()
+
+    structure.write_pdb("results/" + pdb_id + chain_id + '.pdb')
+
+    # Atoms read before the 1st "N" are not counted as a residue:
+    return (pdb_id + chain_id + '.pdb', pdb_id + chain_id,
+            len(structure) + structure.first_res - 1, structure)
+
+
+def index_lines(buffer):
     """
-    Read a pdb and get all the lines associated with each residue
-    The keys are the residue ID, but reindexed and the value contains the old
-    residue ID (the original one, from the PDB)
+    Index the lines of a text in one vectorized scan
 
     Args:
-        pdb_file: The name (str) of the pdb or atm file
+        buffer: Buffer (bytes, mmap...) of the text
 
     Returns:
-        A dict where values are all the lines associates to a given residue and
-        the size of the read PDB
+        The arrays of the offsets of the lines and of their lengths (without
+        the end of line)
     """
+    text = np.frombuffer(buffer, dtype=np.uint8)
+    ends = np.flatnonzero(text == ord('\n'))
+    if len(text) and text[-1] != ord('\n'): # Last line without end of line
+        ends = np.append(ends, len(text))
+    starts = np.concatenate(([0], ends[:-1] + 1))[:len(ends)].astype(
+        np.int64)
+    lengths = ends - starts
+    # The "\r" of the Windows ends of line are not part of the lines:
+    lengths -= (lengths > 0) & (text[np.maximum(ends - 1, 0)] == ord('\r'))
 
-    dict_coord = {}
-    # Id for residu because in some pdb files the num residu
-    # dosen't start to 1
-    resID = 0
+    return (starts, lengths)
 
-    for line in pdb_file:
-        resName = line[17:20].strip()
-        resID_pdb = line[22:26]
 
-        if (line[0:4] == "ATOM") or ((line[0:6] == "HETATM") and
-           ( (resName == "MET") or resName == "MSE") ):
-            if line[12:16].strip() == "N": # Suppose that 1st = "N"
-                resID += 1
-                resID_pdb = line[22:26].strip() # Needed for erasing
+def get_columns(buffer, starts, lengths, first, last):
+    """
+    Get fixed columns of lines of a text (see index_lines), the lines being
+    padded with spaces
+
+    Args:
+        buffer: Buffer (bytes, mmap...) of the text
+        starts: Array of the offsets of the lines
+        lengths: Array of the lengths of the lines
+        first: Index (int) of the 1st column to get
+        last: Index (int) of the column after the last one
+
+    Returns:
+        An array (n_lines, last-first) of the characters (uint8) of the
+        columns
+    """
+    text = np.frombuffer(buffer, dtype=np.uint8)
+    cols = np.arange(first, last)
+    columns = text.take(starts[:, None] + cols, mode='clip')
+    # Padding of the short lines:
+    short = np.flatnonzero(lengths < last)
+    columns[short] = np.where(cols < lengths[short, None], columns[short],
+                              ord(' '))
+
+    return columns
+
+
+def select_chain(buffer, chain_id_arg='first'):
+    """
+    Select the lines of a chain in the text of a pdb (see parse_chain), and
+    renumber its residues from 1, with vectorized operations on the columns
+    of the lines
+
+    Args:
+        buffer: Buffer (bytes, mmap...) of the pdb
+        chain_id_arg: The ID (str, 1 or 2 letters) of the chain to extract
+
+    Returns:
+        An array (n_atoms, 80) of the characters (uint8) of the renumbered
+        lines of the chain
+    """
+    starts, lengths = index_lines(buffer)
+    records = get_columns(buffer, starts, lengths, 0, 6)
+    is_atom = (records[:, 0:4] == np.frombuffer(b"ATOM", np.uint8)).all(1)
+    is_het = (records == np.frombuffer(b"HETATM", np.uint8)).all(1)
+    # Only the ATOM and HETATM lines are read in full:
+    candidates = np.flatnonzero(is_atom | is_het)
+    columns = get_columns(buffer, starts[candidates], lengths[candidates],
+                          0, 80)
+
+    res_names = columns[:, 17:20]
+    is_MET = ((res_names == np.frombuffer(b"MET", np.uint8)).all(1) |
+              (res_names == np.frombuffer(b"MSE", np.uint8)).all(1))
+    columns = columns[is_atom[candidates] | (is_het[candidates] & is_MET)]
+
+    if chain_id_arg == 'first':
+        first_chain_id = columns[0, 21] if len(columns) else ord(' ')
+        # The chain ends at the 1st line of another chain:
+        other_chain = np.flatnonzero(columns[:, 21] != first_chain_id)
+        if len(other_chain):
+            columns = columns[:other_chain[0]]
+    elif len(chain_id_arg) == 1:
+        columns = columns[columns[:, 21] == ord(chain_id_arg)]
+    else:
+        columns = columns[:0]
+
+    # Lines dropped by the renumbering:
+    columns = columns[(columns[:, 0:6] ==
+                       np.frombuffer(b"ATOM  ", np.uint8)).all(1) &
+                      ((columns[:, 16] == ord('A')) |
+                       (columns[:, 16] == ord(' ')))]
+    if not len(columns):
+        return columns
+
+    # A new residue starts at each change of residue number:
+    new_res = np.cumsum(np.concatenate((
+        [True], (columns[1:, 22:27] != columns[:-1, 22:27]).any(1))))
+    numbers = np.char.rjust(np.arange(new_res[-1] + 1).astype('S4'), 4)
+    columns[:, 16] = ord(' ')
+    columns[:, 22:26] = numbers.view(np.uint8).reshape(-1, 4)[new_res]
+    columns[:, 26] = ord(' ')
+
+    return columns
+
+
+def get_CA_coords(pdb_path, dtype=np.float32):
+    """
+    Read the CA atoms of a pdb, following the rules of the TM programs (only
+    ATOM lines of the 1st chain, i.e. before the 1st TER, alternative
+    locations being skipped)
+
+    Args:
+        pdb_path: Path (str) to the pdb file
+        dtype: Type of the coordinates (float32 as the TM programs, float64
+        as the gdt.pl script)
+
+    Returns:
+        An array of the CA coordinates and the list of the associated residue
+        IDs (number + insertion code)
+    """
+    list_coords, list_resIDs = [], []
+    seen_resIDs = set()
+
+    with open(pdb_path, 'r') as pdb_file:
+        for line in pdb_file:
+            if line[0:3] == "TER" and list_coords:
+                break
+
+            if line[0:4] == "ATOM" and line[12:16].strip() == "CA":
+                resID = (int(line[22:26]), line[26:27].strip())
+                # Alternative location of an already read residue:
+                if line[16:17].strip() and resID in seen_resIDs:
+                    continue
+
+                seen_resIDs.add(resID)
+                list_resIDs.append(resID)
+                list_coords.append((float(line[30:38]), float(line[38:46]),
+                                    float(line[46:54])))
+
+    return (np.array(list_coords, dtype=dtype).reshape(-1, 3), list_resIDs)
+
+
+def get_atoms(pdb_path):
+    """
+    Read all the atoms of a pdb, following the rules of the TMalign binary for
+    its superposition files (only ATOM lines of the 1st chain, alternative
+    locations of an already read atom being skipped)
+
+    Args:
+        pdb_path: Path (str) to the pdb file
+
+    Returns:
+        The list of the atoms (tuples of the atom number, atom name, residue
+        name, residue number and insertion code) and the array (float32) of
+        their coordinates
+    """
+    list_atoms, list_coords = [], []
+    seen_atoms = set()
+    nb_CA = 0
+
+    with open(pdb_path, 'r') as pdb_file:
+        for line in pdb_file:
+            if line[0:3] == "TER" and nb_CA:
+                break
+
+            if line[0:4] == "ATOM":
+                resID = (int(line[22:26]), line[26:27])
+                # Alternative location of an already read atom:
+                if line[16:17].strip() and (resID, line[12:16]) in seen_atoms:
+                    continue
+
+                seen_atoms.add((resID, line[12:16]))
+                list_atoms.append((int(line[6:11]), line[12:16],
+                                   line[17:20], resID[0], resID[1]))
+                list_coords.append((float(line[30:38]), float(line[38:46]),
+                                    float(line[46:54])))
+                if line[12:16].strip() == "CA":
+                    nb_CA += 1
+
+    return (list_atoms, np.array(list_coords, dtype=np.float32).reshape(-1, 3))
+
+
+def write_sup_atm(sup_path, atoms_1, coords_1, aligned_1, atoms_2, coords_2,
+                  aligned_2):
+    """
+    Write the .sup_atm (aligned residues only) and .sup_all_atm (whole
+    structures) files of a superposition, in the format of the TMalign binary
+    (moved structure as chain A, fixed structure as chain B)
+
+    Args:
+        sup_path: Path (str) of the superposition, without the "_atm" or
+        "_all_atm" suffixes
+        atoms_1: List of the atoms of the moved structure (see get_atoms)
+        coords_1: Array (n, 3) of the superposed coordinates of the moved
+        structure
+        aligned_1: Set of the aligned residue IDs (number, insertion code) of
+        the moved structure
+        atoms_2: List of the atoms of the fixed structure
+        coords_2: Array (n, 3) of the coordinates of the fixed structure
+        aligned_2: Set of the aligned residue IDs of the fixed structure
+    """
+    for suffix in ("_atm", "_all_atm"):
+        with open(sup_path + suffix, 'w') as sup_file:
+            for chain_ID, atoms, coords, aligned in (
+                    ("A", atoms_1, coords_1, aligned_1),
+                    ("B", atoms_2, coords_2, aligned_2)):
+                sup_file.write(format_atoms(atoms, coords, chain_ID,
+                                            aligned if suffix == "_atm"
+                                            else None))
+                sup_file.write("TER\n")
+
+
+def format_atoms(atoms, coords, chain_ID, aligned=None):
+    """
+    Format atoms as the ATOM lines of the superposition files of TMalign
+
+    Args:
+        atoms: List of the atoms (see get_atoms)
+        coords: Array (n, 3) of the coordinates of the atoms
+        chain_ID: Chain ID (str) to write
+        aligned: Set of the residue IDs (number, insertion code) to write
+        (None to write all the atoms)
+
+    Returns:
+        The text (str) of the ATOM lines
+    """
+    list_lines = []
 
-            if resID not in dict_coord.keys():
-                dict_coord[resID] = [resID_pdb, line]
-            else:
-                dict_coord[resID][1] += line
+    for atom, (x, y, z) in zip(atoms, coords):
+        if aligned is not None and atom[3:5] not in aligned:
+            continue
+        list_lines.append("ATOM  {:5d} {:4s} {:3s} {}{:4d}{:1s}   "
+                          "{:8.3f}{:8.3f}{:8.3f}\n".format(
+                              atom[0], atom[1], atom[2], chain_ID, atom[3],
+                              atom[4], x, y, z))
 
-    # The resID is now equivalent to the size of the protein given as argument
-    return (resID, dict_coord)
+    return ''.join(list_lines)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+
+"""
+In-process NumPy engine reproducing the Protein Peeling program (peel32,
+built from bin/peel_fixed_1.c)
+
+The contact probability matrix is computed once, and the partition index of
+all the candidate cuts of a level is evaluated at once from block sums of its
+summed-area table, so no process is launched and no file is written
+"""
+
+import numpy as np
+
+
+# Same bound on the number of levels than the peeling program:
+MAX_ITERATION = 32
+
+
+def read_CA(pdb_lines):
+    """
+    Read the CA of a pdb as the peeling program does: the coordinates are
+    truncated to integers, and the last line is read twice when it is a CA
+    ending with a newline (the program does not check the end of file)
+
+    Args:
+        pdb_lines: List of the lines (str) of the pdb
+
+    Returns:
+        An array (L, 3) of the (integer) coordinates of the CA
+    """
+    list_coords = []
+    if pdb_lines and pdb_lines[-1].endswith('\n'):
+        pdb_lines = pdb_lines + pdb_lines[-1:]
+
+    for line in pdb_lines:
+        fields = line.split()
+        if (line[0:4] != "ATOM" or len(fields) < 3 or
+                not fields[2].startswith("CA")):
+            continue
+        list_coords.append((float(line[30:38]), float(line[38:46]),
+                            float(line[46:54])))
+
+    return np.trunc(np.array(list_coords, dtype=np.float32).reshape(-1, 3))
+
+
+def read_dssp(dssp_lines):
+    """
+    Read the secondary structures of a DSSP file as the peeling program does:
+    a line is a residue if its 127th character (kept from a previous line for
+    the shorter lines) is neither a space nor "-", and the last line is read
+    twice when it ends with a newline
+
+    Args:
+        dssp_lines: List of the lines (str) of the DSSP file
+
+    Returns:
+        An array of the secondary structure of each residue (0: coil, 1:
+        helix, 2: strand)
+    """
+    buffer = bytearray(b'X' * 200)
+    list_ss = []
+    if dssp_lines and dssp_lines[-1].endswith('\n'):
+        dssp_lines = dssp_lines + dssp_lines[-1:]
+
+    for line in dssp_lines:
+        line = line.encode()[:199]
+        buffer[:len(line)] = line
+        buffer[len(line)] = 0
+        buffer[127] = 0
+        if buffer[126] in b" \t\n\v\f\r-":
+            continue
+        list_ss.append({ord('H'): 1, ord('G'): 1, ord('B'): 2,
+                        ord('E'): 2}.get(buffer[16], 0))
+
+    return np.array(list_ss, dtype=np.int32)
+
+
+def cutting_mask(sec_struct, limit_size_ss2, length):
+    """
+    Positions where the protein can be cut: everywhere but inside the short
+    secondary structures (the start of a structure being kept when its type
+    changes, as done by the peeling program)
+
+    Args:
+        sec_struct: Array of the secondary structures (see read_dssp)
+        limit_size_ss2: Size (int) under which a secondary structure is short
+        length: Number (int) of CA of the protein
+
+    Returns:
+        A boolean array (max(length, n_ss) + 2) telling if the protein can be
+        cut before each position
+    """
+    cuttable = np.zeros(max(length, len(sec_struct)) + 2, dtype=bool)
+    cuttable[0:len(sec_struct)] = True
+    cuttable[0] = True
+
+    type_ss, start_ss = 0, 0
+    for i, ss in enumerate(sec_struct.tolist()):
+        if ss != 0 and type_ss == 0:
+            type_ss, start_ss = ss, i
+        # End of a structure (change of type, or coil):
+        if (ss != 0 and ss != type_ss) or (ss == 0 and type_ss != 0):
+            type_ss = ss
+            if 0 < (i - 1) - start_ss <= limit_size_ss2:
+                cuttable[start_ss:i-1] = False
+
+    return cuttable
+
+
+def contact_proba(coords, sec_struct, d0, delta, only_ss2):
+    """
+    Contact probabilities between all the CA, from a logistic function of
+    their distances (single precision, as the peeling program)
+
+    Args:
+        coords: Array (L, 3) of the CA coordinates (see read_CA)
+        sec_struct: Array of the secondary structures (see read_dssp)
+        d0: Distance (float) of probability 0.5
+        delta: Steepness (float) of the logistic function
+        only_ss2: If 1, the probabilities of the residues out of secondary
+        structures are divided by 10
+
+    Returns:
+        The array (L, L) of the probabilities (float32)
+    """
+    coords = coords.astype(np.float64)
+    dist = np.sqrt(((coords[:, np.newaxis] - coords) ** 2).sum(axis=2))
+    tmp = (dist - np.float64(np.float32(d0))).astype(np.float32)
+    tmp = (tmp / np.float32(delta)).astype(np.float32)
+    with np.errstate(over='ignore'):
+        proba = (1 / (1 + np.exp(tmp.astype(np.float64)))).astype(np.float32)
+
+    if only_ss2 == 1:
+        nb_res = min(len(coords), len(sec_struct))
+        coil = sec_struct[:nb_res] == 0
+        low = coil[:, np.newaxis] | coil
+        proba[:nb_res, :nb_res][low] /= np.float32(10)
+
+    return proba
+
+
+def _block_sums(table, row_start, row_end, col_start, col_end):
+    """
+    Sums of blocks of a matrix, from its summed-area table (bounds included,
+    empty blocks giving 0)
+
+    Args:
+        table: Summed-area table (L+1, L+1) of the matrix
+        row_start, row_end, col_start, col_end: Arrays of the bounds
+
+    Returns:
+        The array of the sums of the blocks
+    """
+    row_end = np.maximum(row_end + 1, row_start)
+    col_end = np.maximum(col_end + 1, col_start)
+    return (table[row_end, col_end] - table[row_start, col_end] -
+            table[row_end, col_start] + table[row_start, col_start])
+
+
+def _partition_index(a, b, c):
+    """
+    Partition index (Matthews coefficient) of cuts, from the contacts inside
+    the units (a, b) and between them (c); undefined values are never kept
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coeff = (a * b - c * c) / ((a + c) * (b + c))
+    coeff[np.isnan(coeff)] = -np.inf
+    return coeff
+
+
+def simple_cuts(table, start, end, cuttable, min_size_pu):
+    """
+    Evaluate all the cuts of a unit in two parts
+
+    Args:
+        table: Summed-area table of the contact probabilities
+        start, end: Bounds (int) of the unit (included)
+        cuttable: Boolean array of the positions that can be cut
+        min_size_pu: Minimal size (int) of the parts
+
+    Returns:
+        The array of the partition indexes and the array (n, 6) of the bounds
+        of the cuts (start, i1, i2, j1, j2, end, j1 and j2 being -1)
+    """
+    i = np.arange(start + min_size_pu, min(end - min_size_pu, end - 1) + 1)
+    i = i[cuttable[i + 1]]
+    a = _block_sums(table, start, i, start, i)
+    b = _block_sums(table, i + 1, end, i + 1, end)
+    c = _block_sums(table, start, i, i + 1, end)
+
+    cuts = np.full((len(i), 6), -1)
+    cuts[:, 0], cuts[:, 1], cuts[:, 2], cuts[:, 5] = start, i, i + 1, end
+    return (_partition_index(a, b, c), cuts)
+
+
+def double_cuts(table, start, end, cuttable, min_size_pu):
+    """
+    Evaluate all the cuts of a unit in three parts, the middle part being one
+    unit and both ends the other one
+
+    Args:
+        table: Summed-area table of the contact probabilities
+        start, end: Bounds (int) of the unit (included)
+        cuttable: Boolean array of the positions that can be cut
+        min_size_pu: Minimal size (int) of the parts
+
+    Returns:
+        The array of the partition indexes and the array (n, 6) of the bounds
+        of the cuts (start, i1, i2, j1, j2, end)
+    """
+    max_j = end - min_size_pu // 2
+    i = np.arange(max(start + min_size_pu - 1, 0), end - min_size_pu)
+    i = i[cuttable[i + 1] & cuttable[i] & (i + 2*min_size_pu < max_j)]
+    j = np.arange(start + 2*min_size_pu - 1, max_j + 1)
+    j = j[cuttable[j + 1]]
+    i, j = np.meshgrid(i, j, indexing='ij')
+    valid = j >= i + min_size_pu
+    i, j = i[valid], j[valid]
+
+    a = _block_sums(table, i + 1, j, i + 1, j)
+    b = (_block_sums(table, start, i, start, i) +
+         _block_sums(table, j + 1, end, j + 1, end) +
+         2 * _block_sums(table, start, i, j + 1, end))
+    c = (_block_sums(table, i + 1, j, start, i) +
+         _block_sums(table, j + 1, end, i + 1, j))
+
+    cuts = np.empty((len(i), 6), dtype=np.int64)
+    cuts[:, 0], cuts[:, 1], cuts[:, 2] = start, i, i + 1
+    cuts[:, 3], cuts[:, 4], cuts[:, 5] = j, j + 1, end
+    return (_partition_index(a, b, c), cuts)
+
+
+def homogeneity(proba, start, end):
+    """
+    Homogeneity index of a unit (used to prune the peeling)
+
+    Args:
+        proba: Array (L, L) of the contact probabilities
+        start, end: Bounds (int) of the unit (included)
+
+    Returns:
+        The homogeneity index (float)
+    """
+    block = proba[start:end+1, start:end+1].astype(np.float64)
+    pos = np.arange(len(block))
+    local = np.abs(pos[:, np.newaxis] - pos) < 6
+    contact = block > 0.5
+    pcontact1 = block[contact].sum()
+    pcontact2 = block[contact & local].sum()
+
+    # The entropies are computed without the last residue:
+    block, contact, local = block[:-1, :-1], contact[:-1, :-1], local[:-1, :-1]
+    contact &= block >= 0.0001
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pnorm1 = block[contact] / pcontact1
+        pnorm2 = block[contact & local] / pcontact2
+        H_1 = (pnorm1 * np.log(pnorm1)).sum()
+        H_2 = (pnorm2 * np.log(pnorm2)).sum()
+
+        return (np.exp(-H_1) - np.exp(-H_2)) / np.float64(end - start)
+
+
+def _float_sum(values):
+    """
+    Sum of an array in single precision, adding the values one after the
+    other as the peeling program does (np.cumsum being sequential)
+    """
+    values = np.ravel(values).astype(np.float32)
+    return np.cumsum(values)[-1] if len(values) else np.float32(0)
+
+
+def mutual_information(proba, bounds):
+    """
+    Compactness index of a level, from the mutual information of the contacts
+    between its units
+    The sums are done in single precision as in the peeling program, the CI
+    deciding when the peeling stops
+
+    Args:
+        proba: Array (L, L) of the contact probabilities
+        bounds: Array (n_PU, 2) of the bounds of the units (included)
+
+    Returns:
+        The CI and R (float) of the level
+    """
+    nb_PU = len(bounds)
+    prob_zone = np.empty((nb_PU, nb_PU), dtype=np.float32)
+    for x, (x1, x2) in enumerate(bounds):
+        for y, (y1, y2) in enumerate(bounds):
+            prob_zone[x, y] = _float_sum(proba[x1:x2+1, y1:y2+1])
+    sprob_zone = np.array([_float_sum(row) for row in prob_zone])
+    sprob_tot = _float_sum(sprob_zone)
+    prob_zone /= sprob_tot
+    sprob_zone /= sprob_tot
+
+    entropy = np.float32(0)
+    for x in range(nb_PU):
+        for y in range(nb_PU):
+            if (prob_zone[x, y] > 0.00001 and sprob_zone[x] > 0.00001 and
+                    sprob_zone[y] > 0.00001):
+                ratio = prob_zone[x, y] / (sprob_zone[x] * sprob_zone[y])
+                entropy = np.float32(np.float64(entropy) +
+                                     np.float64(prob_zone[x, y]) *
+                                     np.log(np.float64(ratio)))
+
+    entropy = np.float64(entropy)
+    CI = np.float32(100 * np.sqrt(1 - np.exp(-2 * entropy)))
+    R = np.float32(100 * (1 - np.exp(-2 * entropy)))
+
+    return (float(CI), float(R))
+
+
+def peel(proba, cuttable, r2_max, min_size_pu, max_size_pu, pruning,
+         cutoff_pruning):
+    """
+    Peeling of a protein: at each level, the best cut (in two or three parts)
+    of one of the units is kept, until the units are compact enough
+
+    Args:
+        proba: Array (L, L) of the contact probabilities
+        cuttable: Boolean array of the positions that can be cut
+        r2_max: Maximal CI (int) of a level, the peeling stopping beyond
+        min_size_pu: Minimal size (int) of the units
+        max_size_pu: If not 0, the peeling stops when no unit is bigger
+        pruning: If not 0, the peeling stops when the new units are all less
+        homogeneous than cutoff_pruning
+        cutoff_pruning: Homogeneity cutoff (float) of the pruning
+
+    Returns:
+        The list of the levels, as tuples of their CI, R and array (n_PU, 2)
+        of the bounds of their units (numbered from 1, included)
+    """
+    table = np.zeros((len(proba) + 1, len(proba) + 1))
+    table[1:, 1:] = proba.cumsum(axis=0, dtype=np.float64).cumsum(axis=1)
+    list_levels = []
+    list_PU = [(0, len(proba) - 1)]
+
+    for _ in range(1, MAX_ITERATION):
+        # All the cuts of the level, in the order of the peeling program (the
+        # first best one is kept):
+        list_coeffs, list_cuts, list_idx = [], [], []
+        for idx_PU, (start, end) in enumerate(list_PU):
+            if end - start < min_size_pu:
+                continue
+            for cutting in (simple_cuts, double_cuts):
+                coeffs, cuts = cutting(table, start, end, cuttable,
+                                       min_size_pu)
+                list_coeffs.append(coeffs)
+                list_cuts.append(cuts)
+                list_idx.append(np.full(len(coeffs), idx_PU))
+
+        coeffs = np.concatenate(list_coeffs) if list_coeffs else np.empty(0)
+        if not len(coeffs) or coeffs.max() <= 0:
+            break
+        best = np.argmax(coeffs)
+        start, i1, i2, j1, j2, end = np.concatenate(list_cuts)[best].tolist()
+        best_PU = np.concatenate(list_idx)[best]
+
+        if j1 == -1:
+            new_PU = [(start, i1), (i2, end)]
+        else:
+            new_PU = [(start, i1), (i2, j1), (j2, end)]
+
+        if max_size_pu != 0 and all(end - start <= max_size_pu
+                                    for start, end in list_PU):
+            break
+        if pruning != 0 and not any(homogeneity(proba, start, end) >=
+                                    cutoff_pruning for start, end in new_PU):
+            break
+
+        list_PU = new_PU + [bounds for idx_PU, bounds in enumerate(list_PU)
+                            if idx_PU != best_PU]
+        bounds = np.array(list_PU)
+        CI, R = mutual_information(proba, bounds)
+        list_levels.append((CI, R, bounds + 1))
+        if CI > r2_max:
+            break
+
+    return list_levels
+
+
+def peel_lines(pdb_lines, dssp_lines, r2_max, limit_size_ss2, min_size_pu,
+               max_size_pu, d0, delta, only_ss2, pruning, cutoff_pruning):
+    """
+    Peeling of a protein, with the same parameters than the peeling program
+
+    Args:
+        pdb_lines: List of the lines (str) of the pdb
+        dssp_lines: List of the lines (str) of its DSSP file
+        Other parameters: see contact_proba, cutting_mask and peel
+
+    Returns:
+        The list of the levels (see peel)
+    """
+    coords = read_CA(pdb_lines)
+    sec_struct = read_dssp(dssp_lines)
+    proba = contact_proba(coords, sec_struct, d0, delta, only_ss2)
+    cuttable = cutting_mask(sec_struct, limit_size_ss2, len(coords))
+
+    return peel(proba, cuttable, r2_max, min_size_pu, max_size_pu, pruning,
+                cutoff_pruning)
+
+
+def level_line(CI, R, bounds):
+    """
+    Returns:
+        The line (str) written by the peeling program for a level
+    """
+    return ("X.XX X.XX {:f} {:f} N ".format(CI, R) +
+            "".join("{} {} ".format(start, end) for start, end in bounds))
@@ -6,17 +6,30 @@ generation of the PU found
 """
 
 import os
+import shutil
 import subprocess as sub
 import numpy as np
 import multiprocessing as mp
-import functools as ftls
+import heapq
+import queue
+import itertools
+import functools
 import src.manage_io as mio
 import src.external as ext
+import src.peel_engine as pe
+import src.structure as strc
+import src.tm_engine as tme
+
+
+# Structures loaded in an aligning process, by their pdb ID:
+_STRUCTS = {}
 
 
 def peeling(peeled_pdb_path, peeled_pdb_id):
     """
-    Run the process of peeling using the executable into bin/
+    Run the process of peeling using the executable into bin/, or in-process
+    (the NumPy engine of src/peel_engine.py, according to the backend of ext,
+    else the shared library of the program, if it was built)
 
     Args:
         peeled_pdb_path: Path (str) to pdb that has been peeled (or just the
@@ -27,16 +40,65 @@ def peeling(peeled_pdb_path, peeled_pdb_id):
         A list of lines from the output of the peeling program, containing all
         the boundaries of the different PUs at each level of cutting
     """
+    dss_path = "data/" + peeled_pdb_id + ".dss"
     a_la_fac = False
     if a_la_fac:
+        peel_params = ("-R2 95 -ss2 8 -lspu 20 -mspu 0 -d0 6.0 -delta 1.5"
+                       " -oss 1 -p 0 -cp 0 -npu 16")
         cmdLine_peel = ("bin/peel64 -pdb " + peeled_pdb_path +
-                        " -dssp data/" + peeled_pdb_id + ".dss"
-                        " -R2 95 -ss2 8 -lspu 20 -mspu 0 -d0 6.0 -delta 1.5"
-                        " -oss 1 -p 0 -cp 0 -npu 16")
+                        " -dssp " + dss_path + " " + peel_params)
 
     else:
-        cmdLine_peel = ("bin/peel32 " + peeled_pdb_path + " data/" +
-                        peeled_pdb_id + ".dss 95 8 20 0 6.0 1.5 1 0 0")
+        # R2 max, size of short secondary structures, min and max sizes of the
+        # PUs, d0 and delta of the contact probabilities, only secondary
+        # structures, pruning and its cutoff:
+        peel_args = (95, 8, 20, 0, 6.0, 1.5, 1, 0, 0)
+        peel_params = " ".join(map(str, peel_args))
+        cmdLine_peel = ("bin/peel32 " + peeled_pdb_path + " " + dss_path +
+                        " " + peel_params)
+
+    # The NumPy engine and the library reproduce peel32 (same parameters):
+    in_process = ext.BACKEND == "numpy" and not a_la_fac
+    use_lib = (not in_process and not a_la_fac and
+               os.path.isfile(ext.PEEL_LIB_PATH))
+    if in_process:
+        engine = "numpy"
+    elif use_lib:
+        engine = ext.PEEL_LIB_PATH
+    else:
+        engine = cmdLine_peel.split()[0]
+
+    # The output only depends on the atoms and the parameters, so a chain
+    # already peeled is taken from the "peeling" cache:
+    cache_key = ext.atoms_key(peeled_pdb_path, engine + " " + peel_params)
+    output = ext.cache_get("peeling", cache_key)
+    if output is not None:
+        print("Peeling of " + peeled_pdb_id + " found in the cache!")
+        return output.split('\n')
+
+    if in_process or use_lib:
+        print("Peeling of " + peeled_pdb_id + " in progress (" +
+              ("numpy" if in_process else "library") + ")...")
+        with open(peeled_pdb_path) as pdb_file:
+            pdb_lines = pdb_file.readlines()
+        dssp_lines = ext.dssp(peeled_pdb_path).splitlines(keepends=True)
+        levels = None
+        if use_lib:
+            levels = ext.peel_lib(pe.read_CA(pdb_lines),
+                                  pe.read_dssp(dssp_lines), peel_args)
+        # The NumPy engine has no bound on the size of the protein:
+        if levels is None:
+            levels = pe.peel_lines(pdb_lines, dssp_lines, *peel_args)
+        list_out = [pe.level_line(CI, R, bounds) for CI, R, bounds in levels]
+        ext.cache_put("peeling", cache_key, '\n'.join(list_out))
+        print("Peeling done!")
+
+        return list_out
+
+    # Creation of dssp file (needed for peeling):
+    if not os.path.isfile(dss_path):
+        with open(dss_path, 'w') as dss_file:
+            dss_file.write(ext.dssp(peeled_pdb_path))
 
     print("Peeling of " + peeled_pdb_id + " in progress...")
     outPeel_sub = sub.Popen(cmdLine_peel.split(),
@@ -44,7 +106,7 @@ def peeling(peeled_pdb_path, peeled_pdb_id):
     outPeel_w_dies = outPeel_sub.decode().split('\n')
 
     # Remove files generated and used by peeling execution:
-    os.remove("data/" + peeled_pdb_id + '.dss')
+    os.remove(dss_path)
     os.remove("file_ca_coo.pdb")
     os.remove("file_proba_contact.mat")
     if os.path.isfile("file_pu_delineation.mtx"):
@@ -52,11 +114,25 @@ def peeling(peeled_pdb_path, peeled_pdb_id):
         os.remove("file_matrix_pu_contact.mtx")
 
     list_out = [line for line in outPeel_w_dies if line and line[0] != '#']
+    ext.cache_put("peeling", cache_key, '\n'.join(list_out))
     print("Peeling done!")
     
     return list_out
 
 
+def peeling_writes_files():
+    """
+    Tell if peeling runs the peeling executable, which writes its files (as
+    file_ca_coo.pdb) in the working directory, so that two peelings can not
+    be run at the same time from the same directory
+
+    Returns:
+        A boolean, False if the peeling is run in-process
+    """
+    return (ext.BACKEND != "numpy" and
+            not os.path.isfile(ext.PEEL_LIB_PATH))
+
+
 def peeled_to_dict(line):
     """
     Take a line from the peeling output and return a dictionary, where each key
@@ -82,7 +158,7 @@ def peeled_to_dict(line):
     return dict_PU
 
 
-def generate_PU_pdbs(dict_PU, level_cut, dict_coord_peeled, peeled_pdb_id):
+def generate_PU_pdbs(dict_PU, level_cut, struct_peeled, peeled_pdb_id):
     """
     Generate different pdb file, associated to each PU, based to the boundaries
     given as output of the peeling program
@@ -90,24 +166,28 @@ def generate_PU_pdbs(dict_PU, level_cut, dict_coord_peeled, peeled_pdb_id):
     Args:
         dict_PU: Dict containing the boundaries of each PU at a given level
         level_cut: The current level considered (int)
-        dict_coord_peeled: Coordinates of the peeled pdb (dict)
+        struct_peeled: Structure of the peeled pdb
         peeled_pdb_id: Name (str) of the PDB that have been peeled
     """
     nb_PU = len(dict_PU)
 
     for i in range(1, nb_PU+1):
         out_file = "results/" + peeled_pdb_id + "_PU_" + str(level_cut)
-        with open(out_file + '_' + str(i) + '.pdb', 'w') as out_PU:
-            inf_bound, sup_bound = dict_PU[i]
+        inf_bound, sup_bound = dict_PU[i]
+        struct_peeled.residues(inf_bound, sup_bound).write_pdb(
+            out_file + '_' + str(i) + '.pdb')
 
-            for resID in range(inf_bound, sup_bound+1):
-                out_PU.write(dict_coord_peeled[resID][1])
 
-
-def get_bestAlgnd_PU(nb_PU, already_selcted, peeled_pdb_id, ref_pdb_id, level):
+def get_bestAlgnd_PU(nb_PU, already_selcted, peeled_pdb_id, ref_pdb_id, level,
+                     memo_keys, dict_algnd, PU_cache=None, strict=False,
+                     mem_data=None):
     """
     Align the different PU (that need to be aligned) against the reference pdb
     (using TMalign) and get the number of the PU that has the maximum TMscore
+    With a cache, only the PUs whose previous alignment is no longer valid are
+    aligned (a cached PU is realigned before being selected, until the best
+    PU has a fresh alignment)
+    This is a generator, yielding the alignments as jobs (see align_PUs)
 
     Args:
         nb_PU: Total number of PU at this given level
@@ -116,6 +196,19 @@ def get_bestAlgnd_PU(nb_PU, already_selcted, peeled_pdb_id, ref_pdb_id, level):
         peeled_pdb_id: PDB ID (str) of the PDB that have been peeled
         ref_pdb_id: PDB ID (str) of the PDB to align against
         level: Current level (int) considered
+        memo_keys: List of the keys of the PUs (see PU_memo_key), for the
+        current state of the reference
+        dict_algnd: Dict of the superpositions of the PUs against the current
+        state of the reference, filled by align_PUs
+        PU_cache: Dict {PU_number:[TMscore, set of aligned ref resIDs,
+        distances between the aligned residues]} of the alignments still
+        valid from the previous iteration (None to align all the remaining
+        PUs)
+        strict: Boolean telling if all the remaining PUs are aligned anyway
+        (the selection is the same as without cache, the one obtained from the
+        cache is only checked against it)
+        mem_data: Dict of the PUs kept in memory (None to work with files),
+        see peel_calc
 
     Returns:
         Index of the PU that is best aligned with the given PDB file
@@ -124,97 +217,504 @@ def get_bestAlgnd_PU(nb_PU, already_selcted, peeled_pdb_id, ref_pdb_id, level):
     # Already aligned PU have their value set to -1 (will never be the max):
     for nb_PU_algnd in already_selcted:
         arr_scores[nb_PU_algnd-1] = -1
+    # Number of iterations left in the level (priority of its jobs):
+    nb_left = nb_PU - len(already_selcted)
+
+    to_align = [i for i in range(nb_PU) if (i+1) not in already_selcted]
+    if PU_cache is None:
+        arr_scores[to_align] = yield from align_PUs(to_align, peeled_pdb_id,
+                                                    ref_pdb_id, level,
+                                                    memo_keys, dict_algnd,
+                                                    None, mem_data, nb_left)
+        return np.argmax(arr_scores) + 1
+
+    # Scores used by the incremental selection (cached ones are reused):
+    arr_incr = arr_scores.copy()
+    cached = {i for i in to_align if (i+1) in PU_cache}
+    for i in cached:
+        arr_incr[i] = PU_cache[i+1][0]
+    if not strict:
+        to_align = [i for i in to_align if i not in cached]
+
+    arr_scores[to_align] = yield from align_PUs(to_align, peeled_pdb_id,
+                                                ref_pdb_id, level, memo_keys,
+                                                dict_algnd, PU_cache,
+                                                mem_data, nb_left)
+    for i in to_align:
+        if i not in cached:
+            arr_incr[i] = arr_scores[i]
+
+    # A cached PU has no superposition against the current reference, so it
+    # is realigned before being selected:
+    idx_max = np.argmax(arr_incr)
+    while idx_max in cached:
+        cached.remove(idx_max)
+        if not strict:
+            arr_scores[idx_max] = (yield from align_PUs(
+                [idx_max], peeled_pdb_id, ref_pdb_id, level, memo_keys,
+                dict_algnd, PU_cache, mem_data, nb_left))[0]
+        arr_incr[idx_max] = arr_scores[idx_max]
+        idx_max = np.argmax(arr_incr)
+
+    if strict and idx_max != np.argmax(arr_scores):
+        print("Level", level, "- incremental selection of PU", idx_max + 1,
+              "instead of PU", np.argmax(arr_scores) + 1)
+        return np.argmax(arr_scores) + 1
+
+    return idx_max + 1
+
+
+def align_PUs(list_idx, peeled_pdb_id, ref_pdb_id, level, memo_keys,
+              dict_algnd, PU_cache=None, mem_data=None, nb_left=0):
+    """
+    Align several PUs against the reference pdb and store their alignments in
+    the cache if given
+    This is a generator: the alignments are yielded as a list of jobs (key,
+    priority, function and arguments), run by the pool of the levels (see
+    run_levels), which sends back their results. A job whose key (see
+    PU_memo_key) was already computed at another level is not run again
+    The superpositions are kept in dict_algnd (the rotation and translation
+    of the PU in memory, the lines of the superposed PU with files), with
+    the aligned resIDs of the reference, so no file is read afterwards
+
+    Args:
+        list_idx: Indexes (list of int) of the PUs to align
+        peeled_pdb_id: PDB ID (str) of the PDB that have been peeled
+        ref_pdb_id: PDB ID (str) of the PDB to align against
+        level: Current level (int) considered
+        memo_keys: List of the keys (see PU_memo_key) of all the PUs
+        dict_algnd: Dict {PU index: result of its job without the TMscore}
+        PU_cache: Dict {PU_number:[TMscore, set of aligned ref resIDs,
+        distances between the aligned residues]}
+        mem_data: Dict of the PUs kept in memory, see peel_calc
+        nb_left: Number (int) of iterations left in the level
 
-    for i in range(nb_PU):
-        if (i+1) not in already_selcted:
+    Returns:
+        The array of the TMscores of the PUs
+    """
+    list_jobs = []
+
+    for i in list_idx:
+        # The levels with the most iterations left, then the biggest PUs
+        # (bounds of the key), are aligned first:
+        inf_bound, sup_bound = memo_keys[i][1]
+        priority = (nb_left, sup_bound - inf_bound)
+        if mem_data is not None:
+            # The structures are loaded in the aligning processes, so the key
+            # is enough to get the PU and the reference:
+            list_jobs.append((memo_keys[i], priority, align_PU_atoms,
+                              memo_keys[i]))
+        else:
             PU_name = peeled_pdb_id + "_PU_" + str(level) + '_' + str(i+1)
-            # The "peel_longer" param is set to True, to avoid inversion
-            # when the PUs are processed
-            arr_scores[i] = ext.TM_align(PU_name, ref_pdb_id, True)
+            list_jobs.append((memo_keys[i], priority, align_PU_file,
+                              (PU_name, ref_pdb_id)))
+    list_res = (yield list_jobs) if list_jobs else []
 
-    return np.argmax(arr_scores) + 1
+    arr_scores = np.array([res[0] for res in list_res], dtype=float)
+    for i, res in zip(list_idx, list_res):
+        dict_algnd[i] = res[1:]
 
+    if PU_cache is not None:
+        for i, score in zip(list_idx, arr_scores):
+            # The distances between the aligned residues and the aligned
+            # resIDs of the reference end the results:
+            PU_cache[i+1] = [score, dict_algnd[i][-1], dict_algnd[i][-2]]
 
-def write_algnd_PUs(PU_max_name, algnd_filename, idx):
+    return arr_scores
+
+
+def align_PU_file(PU_name, ref_pdb_name):
     """
-    Take the number of the best aligned PU, open the associated TM_file and
-    append the file gethering all aligned PU with the coordinates of this
-    new PU
+    Align a PU against the reference pdb, from their files (job of align_PUs):
+    the superposition files written by TMalign are read here, then removed
 
     Args:
-        PU_max_name: Filename (str) of the PU that had the best TMscore
-        algnd_filename: Filename (str) of the file gethering all aligned PUs
-        idx: The iteration (int) of PU alignment, to deal with opening mode of
-        the "_PUs_algnd_" file
-    """
-    with open('results/' + PU_max_name + '.sup_all_atm', 'r') as sup_all_max:
-        if idx == 0:
-            aligned_PU = open('results/' + algnd_filename, 'w')
-        else:
-            aligned_PU = open('results/' + algnd_filename, 'a')
+        PU_name: Name (str) of the PU to align
+        ref_pdb_name: Name (str) of the PDB to align against
 
-        for line in sup_all_max:
-            if (line[0:4] == "ATOM") or ((line[0:6] == "HETATM") and
-               ( (resName == "MET") or resName == "MSE") ):
-               chain_ID = line[21:22].strip()
+    Returns:
+        The TMscore, the lines (str) of the superposed PU, the distances
+        between the aligned residues and the set of the aligned resIDs (str)
+        of the reference
+    """
+    # The "peel_longer" param is set to True, to avoid inversion when the
+    # PUs are processed:
+    TMscore = ext.TM_align(PU_name, ref_pdb_name, True)
+    sup_lines = get_algnd_lines(PU_name)
+    dists = get_algnd_dists(PU_name)
+    set_algnd = get_algnd_resIDs(PU_name)
+    for extension in ('.sup_atm', '.sup_all_atm'):
+        os.remove('results/' + PU_name + extension)
 
-               if chain_ID == "A":
-                   # Send chain A into the file getering all aligned PUs:
-                   aligned_PU.write(line)
+    return (TMscore, sup_lines, dists, set_algnd)
 
-        aligned_PU.close()
 
+def align_PU_atoms(peeled_pdb_id, bounds, ref_pdb_id, set_erased):
+    """
+    Align a PU against the reference, from the structures loaded in the
+    aligning process (job of align_PUs, NumPy engine only)
 
-def erase_algned(dict_coord_ref, ref_pdb_id, PU_max_name):
+    Args:
+        peeled_pdb_id: PDB ID (str) of the PDB that have been peeled
+        bounds: Bounds (tuple of int) of the PU
+        ref_pdb_id: PDB ID (str) of the PDB to align against
+        set_erased: Frozenset of the resIDs (str) erased from the reference
+
+    Returns:
+        The TMscore, the rotation and the translation superposing the PU onto
+        the reference (see tme.transform), the distances between the aligned
+        residues and the set of the aligned resIDs (str) of the reference
     """
-    Write a new reference pdb file, by writing only the residues that have not
-    been aligned yet
+    atoms_PU, coords_PU = _STRUCTS[peeled_pdb_id].residues(*bounds
+                                                            ).get_atoms()
+    atoms_ref, coords_ref = get_ref_atoms(ref_pdb_id, set_erased)
+    TMscores, rot, trans, list_algnd_PU, list_algnd_ref = ext.TM_align_atoms(
+        [atoms_PU], [coords_PU], atoms_ref, coords_ref, True)
+
+    # The alignment keeps the order of the residues, so the aligned CA atoms
+    # of both structures are paired in their order:
+    CA_PU = get_algnd_CA(atoms_PU, tme.transform(coords_PU, rot[0], trans[0]),
+                         list_algnd_PU[0])
+    CA_ref = get_algnd_CA(atoms_ref, coords_ref, list_algnd_ref[0])
+    dists = np.linalg.norm(CA_PU - CA_ref, axis=1)
+
+    return (TMscores[0], rot[0], trans[0], dists,
+            {str(resID[0]) for resID in list_algnd_ref[0]})
+
+
+def get_algnd_CA(atoms, coords, aligned):
+    """
+    Get the coordinates of the CA atoms of the aligned residues of a structure
 
     Args:
-        dict_coord_ref: Dict containing the coordinates of the reference pdb
-        ref_pdb_id: Name (str) of the reference pdb to create
-        PU_max_name: Filename (str) of the PU that had the best TMscore
+        atoms: List of the atoms of the structure (see mio.get_atoms)
+        coords: Array of the coordinates of the atoms
+        aligned: Set of the aligned residue IDs (number, insertion code)
+
+    Returns:
+        The array (n, 3) of the coordinates of the aligned CA atoms
+    """
+    return coords[[idx for idx, atom in enumerate(atoms)
+                   if atom[1].strip() == "CA" and atom[3:5] in aligned]]
+
+
+@functools.lru_cache(maxsize=8)
+def get_ref_atoms(ref_pdb_id, set_erased):
+    """
+    Get the atoms of a state of the reference loaded in the aligning process
+    (the jobs of a step of a level share the same state), as a masked view of
+    the whole reference: only the mask of its residues is computed
+
+    Args:
+        ref_pdb_id: PDB ID (str) of the reference
+        set_erased: Frozenset of the resIDs (str) erased from the reference
+
+    Returns:
+        The list of the atoms and the array of their coordinates (see
+        Structure.get_atoms)
+    """
+    struct_ref = _STRUCTS[ref_pdb_id]
+    list_atoms, arr_idx = get_ref_index(ref_pdb_id)
+    mask_atoms = struct_ref.kept_residues(set_erased)[
+        struct_ref.atom_res[arr_idx]]
+
+    return (list(itertools.compress(list_atoms, mask_atoms)),
+            struct_ref.coords[arr_idx[mask_atoms]])
+
+
+@functools.lru_cache(maxsize=2)
+def get_ref_index(ref_pdb_id):
+    """
+    Get the atoms of the whole reference loaded in the aligning process, read
+    once for all its states (see get_ref_atoms)
+
+    Args:
+        ref_pdb_id: PDB ID (str) of the reference
+
+    Returns:
+        The list of the atoms and the array of their indexes (see
+        Structure.index_atoms)
+    """
+    return _STRUCTS[ref_pdb_id].index_atoms()
+
+
+def load_structs(dict_shared):
+    """
+    Load the structures in an aligning process (initializer of the pool), as
+    views on their blocks of shared memory
+
+    Args:
+        dict_shared: Dict {pdb ID: descriptor of the block of the structure}
+        (see Structure.to_shared)
+    """
+    for pdb_id, descriptor in dict_shared.items():
+        _STRUCTS[pdb_id] = strc.Structure.from_shared(descriptor)
+    get_ref_atoms.cache_clear()
+    get_ref_index.cache_clear()
+
+
+def open_pool(nb_cpu, dict_structs):
+    """
+    Create the pool of the aligning processes of a batch of
+    peeled-TMalignments (see peeled_TMaligns), the structures being loaded
+    in its processes
+    The arrays of the structures are put in shared memory, the processes
+    attaching them without copy
+    The processes work in the current directory when the pool is created
+
+    Args:
+        nb_cpu: Number (int) of processes of the pool
+        dict_structs: Dict {pdb ID: Structure} of the structures to load in
+        the processes
+
+    Returns:
+        The pool of processes and the list of the blocks of shared memory of
+        the structures (see close_pool)
+    """
+    dict_shared, list_blocks = {}, []
+    for pdb_id, struct in dict_structs.items():
+        block, dict_shared[pdb_id] = struct.to_shared()
+        list_blocks.append(block)
+
+    return (mp.Pool(nb_cpu, initializer=load_structs,
+                    initargs=(dict_shared,)), list_blocks)
+
+
+def close_pool(pool, list_blocks):
+    """
+    Close a pool of aligning processes, waiting for them, and free the shared
+    memory of the structures (see open_pool)
+
+    Args:
+        pool: Pool of processes
+        list_blocks: List of the blocks of shared memory of the structures
     """
-    # Get atoms of reference pdb that are aligned, they will be discarded
-    # (corresponding to chain B of the .sup_atm file of the best aligned PU):
-    with open('results/' + PU_max_name + '.sup_atm', 'r') as sup_max:
-        set_to_discard = set()
+    pool.close()
+    pool.join()
+    for block in list_blocks:
+        block.close()
+        block.unlink()
 
-        for line in sup_max:
+
+def PU_memo_key(peeled_pdb_id, bounds, ref_pdb_id, set_erased):
+    """
+    Get the key of a PU alignment in the memo shared between levels
+
+    Args:
+        peeled_pdb_id: Name (str) of the PDB that have been peeled
+        bounds: Boundaries [inf_bound, sup_bound] of the PU
+        ref_pdb_id: Name (str) of the reference pdb
+        set_erased: Set of the resIDs (str) erased from the reference
+
+    Returns:
+        A tuple identifying the PU and the state of the reference
+    """
+    return (peeled_pdb_id, tuple(bounds), ref_pdb_id, frozenset(set_erased))
+
+
+def run_levels(list_levels, pool, nb_cpu):
+    """
+    Run the levels of a peeled-TMalignment (generators of peel_calc) on a
+    single pool: the jobs yielded by all the levels are queued together, the
+    jobs of the levels with the most iterations left (then of the biggest
+    PUs) being run first, and each level is resumed (greedy selection of its
+    next PU) as soon as the results of all the jobs of its step are ready
+    A job with the same key than a job of another level is run only once
+    (memo of the alignments shared between the levels)
+
+    Args:
+        list_levels: List of the generators of the levels
+        pool: Pool of processes running the jobs
+        nb_cpu: Number (int) of processes of the pool
+
+    Returns:
+        The list of the values returned by the levels
+    """
+    list_res = [None] * len(list_levels)
+    memo = {}
+    # Steps waiting for a job (by its key), as (level, index of the job):
+    waiting = {}
+    # Results of the current step of each level, and number of missing ones:
+    steps = {}
+    heap_jobs = []
+    counter = itertools.count()
+    done = queue.Queue()
+    nb_running = 0
+
+    def resume(idx_level, values):
+        # Run a level until its next step needs jobs that are not done yet:
+        while True:
+            try:
+                jobs = list_levels[idx_level].send(values)
+            except StopIteration as stop:
+                list_res[idx_level] = stop.value
+                return
+
+            values = [None] * len(jobs)
+            nb_missing = 0
+            for idx_job, (key, priority, func, args) in enumerate(jobs):
+                if key in memo:
+                    values[idx_job] = memo[key]
+                    continue
+                if key is None: # Job proper to this level
+                    key = ("job", next(counter))
+                if key not in waiting:
+                    waiting[key] = []
+                    heapq.heappush(heap_jobs, (-priority[0], -priority[1],
+                                               next(counter), key, func,
+                                               args))
+                waiting[key].append((idx_level, idx_job))
+                nb_missing += 1
+
+            if nb_missing:
+                steps[idx_level] = [values, nb_missing]
+                return
+
+    for idx_level in range(len(list_levels)):
+        resume(idx_level, None)
+
+    while heap_jobs or nb_running:
+        # The pool gets only nb_cpu jobs at once, so the queue keeps its order:
+        while heap_jobs and nb_running < nb_cpu:
+            key, func, args = heapq.heappop(heap_jobs)[3:]
+            pool.apply_async(func, args,
+                             callback=lambda res, key=key:
+                             done.put((key, True, res)),
+                             error_callback=lambda err, key=key:
+                             done.put((key, False, err)))
+            nb_running += 1
+
+        key, success, result = done.get()
+        nb_running -= 1
+        if not success:
+            raise result
+        memo[key] = result
+
+        for idx_level, idx_job in waiting.pop(key):
+            steps[idx_level][0][idx_job] = result
+            steps[idx_level][1] -= 1
+            if not steps[idx_level][1]:
+                resume(idx_level, steps.pop(idx_level)[0])
+
+    return list_res
+
+
+def get_algnd_resIDs(PU_name):
+    """
+    Get the resIDs of the reference pdb that are aligned with a given PU
+    (corresponding to chain B of the .sup_atm file of the PU)
+
+    Args:
+        PU_name: Filename (str) of the aligned PU
+
+    Returns:
+        A set with the resIDs (str) of the aligned residues of the reference
+    """
+    with open('results/' + PU_name + '.sup_atm', 'r') as sup_PU:
+        set_algnd = set()
+
+        for line in sup_PU:
+            resName = line[17:20].strip()
             if (line[0:4] == "ATOM") or ((line[0:6] == "HETATM") and
                ( (resName == "MET") or resName == "MSE") ):
                chain_ID = line[21:22].strip()
 
                if chain_ID == "B":
-                   set_to_discard.add(line[22:26].strip())
+                   set_algnd.add(line[22:26].strip())
 
-    # Now we write the new ref pdb, with aligned atoms erased:
-    with open('results/' + ref_pdb_id + '.pdb', 'w') as pdb_file:
-        resIDs = dict_coord_ref.keys()
+    return set_algnd
+
+
+def get_algnd_dists(PU_name):
+    """
+    Get the distances between the aligned CA atoms of a PU and of the
+    reference (chains A and B of the .sup_atm file of the PU, whose residues
+    are paired in their order)
+
+    Args:
+        PU_name: Filename (str) of the aligned PU
 
-        for resID in resIDs:
-            resID_pdb, res_str = dict_coord_ref[resID]
+    Returns:
+        The array of the distances between the aligned residues
+    """
+    dict_CA = {"A": [], "B": []}
+    with open('results/' + PU_name + '.sup_atm', 'r') as sup_PU:
+        for line in sup_PU:
+            if (line[0:4] == "ATOM" and line[12:16].strip() == "CA" and
+                    line[21:22] in dict_CA):
+                dict_CA[line[21:22]].append([float(line[30:38]),
+                                             float(line[38:46]),
+                                             float(line[46:54])])
 
-            if resID_pdb not in set_to_discard:
-                pdb_file.write(res_str)
+    CA_PU, CA_ref = (np.array(dict_CA[chain_ID], dtype=float).reshape(-1, 3)
+                     for chain_ID in ("A", "B"))
+    return np.linalg.norm(CA_PU - CA_ref, axis=1)
 
 
-def clean_sup_atm(peeled_pdb_id, level, nb_PU):
+def update_PU_cache(PU_cache, set_discarded, mask_ref):
     """
-    Clean .sup_atm and .sup_all_atm files after they have become useless
+    Remove from the cache the PUs whose alignment used an erased residue of
+    the reference, and recompute the TMscores of the other ones (normalized by
+    the length of the reference, d0 included) for the new reference, from the
+    distances of their superposition
 
     Args:
-        peeled_pdb_id: Name (str) of the PDB that have been peeled
-        level: The current level considered (int)
-        nb_PU: Total number of PU at this given level
+        PU_cache: Dict {PU_number:[TMscore, set of aligned ref resIDs,
+        distances between the aligned residues]}
+        set_discarded: Set of the resIDs (str) erased from the reference
+        mask_ref: Boolean array of the residues of the new reference
     """
-    for i in range(nb_PU):
-            PU_name = peeled_pdb_id + "_PU_" + str(level) + '_' + str(i+1)
+    new_size = np.count_nonzero(mask_ref)
+    d0 = tme.get_d0(new_size)
+
+    for nb_PU in list(PU_cache):
+        if PU_cache[nb_PU][1] & set_discarded:
+            del PU_cache[nb_PU]
+        elif new_size:
+            dists = PU_cache[nb_PU][2]
+            PU_cache[nb_PU][0] = float(np.sum(1 / (1 + (dists / d0)**2)) /
+                                       new_size)
+
+
+def get_algnd_lines(PU_name):
+    """
+    Get the lines of the superposed PU (corresponding to chain A of the
+    .sup_all_atm file of the PU), to write them in the file gethering all
+    aligned PUs if it is the best aligned one
+
+    Args:
+        PU_name: Filename (str) of the aligned PU
 
-            if os.path.isfile("results/" + PU_name + ".sup_atm"):
-                os.remove("results/" + PU_name + ".sup_atm")
-            if os.path.isfile("results/" + PU_name + ".sup_all_atm"):
-                os.remove("results/" + PU_name + ".sup_all_atm")
+    Returns:
+        The lines (str) of the superposed PU
+    """
+    list_lines = []
+    with open('results/' + PU_name + '.sup_all_atm', 'r') as sup_all_PU:
+        for line in sup_all_PU:
+            resName = line[17:20].strip()
+            if (line[0:4] == "ATOM") or ((line[0:6] == "HETATM") and
+               ( (resName == "MET") or resName == "MSE") ):
+               chain_ID = line[21:22].strip()
+
+               if chain_ID == "A":
+                   list_lines.append(line)
+
+    return ''.join(list_lines)
+
+
+def erase_algned(struct_ref, ref_pdb_id, mask_ref):
+    """
+    Write a new reference pdb file, by writing only the residues that have not
+    been aligned yet (only needed by the TMalign binary, which reads files)
+
+    Args:
+        struct_ref: Structure of the reference pdb
+        ref_pdb_id: Name (str) of the reference pdb to create
+        mask_ref: Boolean array of the residues of the reference that are
+        kept (see Structure.kept_residues)
+    """
+    # Now we write the new ref pdb, with aligned atoms erased:
+    struct_ref.select(mask_ref).write_pdb('results/' + ref_pdb_id + '.pdb')
 
 
 def get_best_level(res_peel, list_nb_PU):
@@ -269,20 +769,31 @@ def final_alignments(peeled_pdb_id, level, ref_pdb_id, peel_longer, out_peel):
     return (level, TM_gdt, TMscore, nb_tot_PU)
 
 
-def peel_calc(idx, out_peel, dictCoord_peeled, peeled_pdb_id,
-            dictCoord_ref, ref_pdb_id, peel_longer):
+def peel_calc(idx, out_peel, struct_peeled, peeled_pdb_id,
+            struct_ref, ref_pdb_id, peel_longer, incr_mode="off",
+            in_memory=False):
     """
     Process to all the calculation and file manipulations for the
     "peeled-TMalignement"
+    This is a generator, run by run_levels: the alignments (and the final
+    alignments) are yielded as jobs, and the greedy selection of the next PU
+    goes on when their results are sent back
 
     Args:
         idx: The number (int) of the iteration (used to deduce level)
-        dictCoord_peeled: Dict containing the lines of the peeled pdb
+        struct_peeled: Structure of the peeled pdb
         peeled_pdb_id: Name (str) of the PDB that have been peeled
-        dictCoord_ref: Dict containing the lines of the reference pdb
+        struct_ref: Structure of the reference pdb
         ref_pdb_id: Name (str) of the reference pdb to create
         peel_longer: Boolean telling if the peeled protein is longer (or not)
         than the reference protein
+        incr_mode: Mode (str) of selection of the best aligned PUs: "off"
+        (all remaining PUs realigned at each iteration), "fast" (only the PUs
+        whose alignment used erased residues are realigned) or "strict" (same
+        selection as "off", but the incremental one is checked against it)
+        in_memory: Boolean telling if the PUs and the reference are kept in
+        memory (NumPy engine only), only the file of the aligned PUs being
+        written
 
     Returns:
         The current level, the values of gdt-calculated TMscore, the (regular)
@@ -291,106 +802,172 @@ def peel_calc(idx, out_peel, dictCoord_peeled, peeled_pdb_id,
     level = idx + 1
     print("Proceeding peeling level", level)
 
-    # Copy of the "safe" reference pdb, that will be proper to this level
-    os.system("cp results/" + ref_pdb_id + "_safe.pdb results/" +
-              ref_pdb_id + str(level) + '.pdb')
-
     dict_all_PU = peeled_to_dict(out_peel[idx])
     nb_tot_PU = len(dict_all_PU)
 
-    generate_PU_pdbs(dict_all_PU, level, dictCoord_peeled, peeled_pdb_id)
+    if in_memory:
+        # Atoms of the PUs (the reference being loaded in the aligning
+        # processes):
+        mem_data = {"PUs": [struct_peeled.residues(*dict_all_PU[i+1]
+                                                   ).get_atoms()
+                            for i in range(nb_tot_PU)]}
+
+    else:
+        mem_data = None
+        # Copy of the "safe" reference pdb, that will be proper to this level
+        shutil.copyfile("results/" + ref_pdb_id + "_safe.pdb",
+                        "results/" + ref_pdb_id + str(level) + '.pdb')
+        generate_PU_pdbs(dict_all_PU, level, struct_peeled, peeled_pdb_id)
+
     already_selcted = []
+    # Alignments still valid after the erasures (incremental selection):
+    PU_cache = None if incr_mode == "off" else {}
+    set_erased = set()
+    # Lines of the best aligned PUs (same lines than the chains A of the
+    # .sup_all_atm files):
+    list_algnd_PUs = []
+    algnd_filename = (peeled_pdb_id + '-' + ref_pdb_id + '_PUs_' +
+                      str(level) + '.pdb')
 
     # Then we loop on the number of PUs, to repeat the process
     for i in range(nb_tot_PU):
-        nb_bestAlgnd_PU = get_bestAlgnd_PU(nb_tot_PU, already_selcted,
-                                           peeled_pdb_id,
-                                           ref_pdb_id + str(level),
-                                           level)
+        # The reference of this iteration is the whole one minus set_erased:
+        memo_keys = [PU_memo_key(peeled_pdb_id, dict_all_PU[j+1], ref_pdb_id,
+                                 set_erased) for j in range(nb_tot_PU)]
+        # Superpositions of the PUs against this reference:
+        dict_algnd = {}
+        nb_bestAlgnd_PU = yield from get_bestAlgnd_PU(nb_tot_PU,
+                                                      already_selcted,
+                                                      peeled_pdb_id,
+                                                      ref_pdb_id + str(level),
+                                                      level, memo_keys,
+                                                      dict_algnd, PU_cache,
+                                                      incr_mode == "strict",
+                                                      mem_data)
         already_selcted.append(nb_bestAlgnd_PU)
 
-        PUmax_name = (peeled_pdb_id + "_PU_" + str(level) + '_' +
-                      str(nb_bestAlgnd_PU))
-        algnd_filename = (peeled_pdb_id + '-' + ref_pdb_id + '_PUs_' +
-                          str(level) + '.pdb')
+        algnd_PU = dict_algnd[nb_bestAlgnd_PU-1]
+        set_erased = algnd_PU[-1]
+        # The reference is updated as a mask of its residues:
+        mask_ref = struct_ref.kept_residues(set_erased)
+        if mem_data is not None:
+            atoms_PU, coords_PU = mem_data["PUs"][nb_bestAlgnd_PU-1]
+            sup_coords = tme.transform(coords_PU, algnd_PU[0], algnd_PU[1])
+            list_algnd_PUs.append(mio.format_atoms(atoms_PU, sup_coords,
+                                                   "A"))
+        else:
+            list_algnd_PUs.append(algnd_PU[0])
+            erase_algned(struct_ref, ref_pdb_id + str(level), mask_ref)
+        if PU_cache is not None:
+            update_PU_cache(PU_cache, set_erased, mask_ref)
+
+    with open('results/' + algnd_filename, 'w') as aligned_PU:
+        aligned_PU.write(''.join(list_algnd_PUs))
+
+    if mem_data is None:
+        # Remove pdb files of the PUs of the current level:
+        for i in range(nb_tot_PU):
+            os.remove("results/" + peeled_pdb_id + "_PU_" + str(level) + '_' +
+                      str(i+1) + '.pdb')
+        os.remove("results/" + ref_pdb_id + str(level) + '.pdb')
+
+    # The final alignments are run by the pool as well (after the
+    # alignments of the PUs of the levels with iterations left):
+    res_level = yield [(None, (0, 0), final_alignments,
+                        (peeled_pdb_id, level, ref_pdb_id, peel_longer,
+                         out_peel))]
+    return res_level[0]
+
+
+def peeled_TMaligns(list_directions, nb_cpu=None):
+    """
+    Process several "peeled-TMalignments" (e.g. both senses of a pair), whose
+    levels are run together by a single pool of aligning processes (see
+    run_levels and open_pool)
+    The directions writing the same files (same peeled or reference pdb) are
+    run one after the other, each batch of directions having its own pool
 
-        write_algnd_PUs(PUmax_name, algnd_filename, i)
-        erase_algned(dictCoord_ref, ref_pdb_id + str(level), PUmax_name)
-        clean_sup_atm(peeled_pdb_id, level, nb_tot_PU)
+    Args:
+        list_directions: List of the tuples (ref_pdb_path, ref_pdb_id,
+        struct_ref, peeled_pdb_path, peeled_pdb_id, struct_peeled,
+        peel_longer, incr_mode, in_memory, out_peel) of the directions: paths
+        (str) and names (str) of the reference pdb and of the peeled pdb,
+        with their Structures, boolean telling if the peeled protein is
+        longer than the reference protein, mode (str) of selection of the
+        best aligned PUs and boolean telling if the PUs are kept in memory
+        (see peel_calc), and output of the peeling of the peeled pdb (see
+        peeling, None if it was not run yet)
+        nb_cpu: Number (int) of processes aligning the PUs, all the CPUs but
+        one if None
 
-    # Remove pdb files of the PUs of the current level:
-    for i in range(nb_tot_PU):
-        os.remove("results/" + peeled_pdb_id + "_PU_" + str(level) + '_' +
-                  str(i+1) + '.pdb')
-    os.remove("results/" + ref_pdb_id + str(level) + '.pdb')
+    Returns:
+        The list of the results of the directions (three lists containing
+        the TMscores, the numbers of PUs and the gdt TMscores of the levels)
+    """
+    if nb_cpu is None:
+        nb_cpu = max(mp.cpu_count() - 1, 1)
+    # Batches of directions that can be run together:
+    list_batches = []
+    for direction in list_directions:
+        ref_pdb_id, peeled_pdb_id = direction[1], direction[4]
+        if not list_batches or any(
+                ref_pdb_id == other[1] or peeled_pdb_id == other[4]
+                for other in list_batches[-1]):
+            list_batches.append([])
+        list_batches[-1].append(direction)
+
+    list_res = []
+    for batch in list_batches:
+        list_levels, list_nb_levels = [], []
+        dict_structs = {}
+        for (ref_pdb_path, ref_pdb_id, struct_ref, peeled_pdb_path,
+             peeled_pdb_id, struct_peeled, peel_longer, incr_mode, in_memory,
+             out_peel) in batch:
+            # We need a safe copy of the ref pdb, to reset it at each level:
+            shutil.copyfile(ref_pdb_path,
+                            "results/" + ref_pdb_id + "_safe.pdb")
+
+            # Peeling:
+            if out_peel is None:
+                out_peel = peeling(peeled_pdb_path, peeled_pdb_id)
+            list_nb_levels.append(len(out_peel))
+            list_levels += [peel_calc(idx, out_peel, struct_peeled,
+                                      peeled_pdb_id, struct_ref, ref_pdb_id,
+                                      peel_longer, incr_mode, in_memory)
+                            for idx in range(len(out_peel))]
+            dict_structs[peeled_pdb_id] = struct_peeled
+            dict_structs[ref_pdb_id] = struct_ref
+
+        # Parallelized version: the alignments of the PUs of all the levels
+        # of the batch are run by the same pool (see run_levels)
+        pool, list_blocks = open_pool(nb_cpu, dict_structs)
+        try:
+            res_batch = run_levels(list_levels, pool, nb_cpu)
+        finally:
+            close_pool(pool, list_blocks)
+
+        # Serial version:
+        # res_batch = run_levels(list_levels, mp.Pool(1), 1)
 
-    return final_alignments(peeled_pdb_id, level, ref_pdb_id, peel_longer,
-                            out_peel)
+        for direction, nb_levels in zip(batch, list_nb_levels):
+            res_tot_peel, res_batch = (res_batch[:nb_levels],
+                                       res_batch[nb_levels:])
+            list_res.append(collect_levels(res_tot_peel, direction[1]))
 
+    return list_res
 
-def peeled_TMalign(ref_pdb_path, ref_pdb_id, dictCoord_ref,
-                   peeled_pdb_path, peeled_pdb_id, dictCoord_peeled,
-                   peel_longer):
+
+def collect_levels(res_tot_peel, ref_pdb_id):
     """
-    Function gethering the whole process of "peeled-TMalignment"
+    Put the results of the levels of a peeled-TMalignment in proper lists
 
     Args:
-        ref_pdb_path: Path (str) to the PDB to align against
-        ref_pdb_id: Name (str) of the reference pdb to create
-        dictCoord_ref: Dict containing the lines of the reference pdb
-        peeled_pdb_path: Path (str) to pdb that has been peeled
-        peeled_pdb_id: Name (str) of the PDB that have been peeled
-        dictCoord_peeled: Dict containing the lines of the peeled pdb
-        peel_longer: Boolean telling if the peeled protein is longer (or not)
-        than the reference protein
+        res_tot_peel: List of the results of the levels (see peel_calc)
+        ref_pdb_id: Name (str) of the reference pdb
 
     Returns:
         Three lists containing the different results
     """
-    # We need a safe copy of the ref pdb, to reset it at each level:
-    os.system("cp " + ref_pdb_path + " results/" + ref_pdb_id + "_safe.pdb")
-
-    # Creation of dssp file (needed for peeling):
-    if not os.path.isfile("data/" + peeled_pdb_id + ".dss"):
-        os.system("bin/dssp64 -i " + peeled_pdb_path + " > data/" +
-                  peeled_pdb_id + ".dss")
-
-    # Peeling:
-    out_peel = peeling(peeled_pdb_path, peeled_pdb_id)
-    nb_tot_levels = len(out_peel)
-
-    if True:
-    # if not os.path.isfile("results/" + peeled_pdb_id + '_PUs_algnd_' +
-    #                       str(nb_tot_levels) + '.pdb'):
-        # Parallelized version (TO TIME):
-        nb_cpu = mp.cpu_count() - 1
-        # nb_cpu = 1
-        my_pool = mp.Pool(nb_cpu)
-        partial_func = ftls.partial(peel_calc,
-                                      out_peel=out_peel,
-                                      dictCoord_peeled=dictCoord_peeled,
-                                      peeled_pdb_id=peeled_pdb_id,
-                                      dictCoord_ref=dictCoord_ref,
-                                      ref_pdb_id=ref_pdb_id,
-                                      peel_longer=peel_longer)
-
-        res_tot_peel = my_pool.map(partial_func, range(len(out_peel)))
-        my_pool.close()
-
-        # Serial version:
-        # res_tot_peel = []
-        # for idx in range(nb_tot_levels):
-        #     res_tot_peel.append(peel_calc(idx, out_peel, dictCoord_peeled, peeled_pdb_id,
-        #                          dictCoord_ref, ref_pdb_id, peel_longer))
-
-    else:
-        print("Found files of aligned PUs ! Skipping...")
-        res_tot_peel = []
-        for level in range(1, nb_tot_levels+1):
-            res_tot_peel.append(final_alignments(peeled_pdb_id, level, ref_pdb_id,
-                                          peel_longer, out_peel))
-
-    # Putting outputs in proper lists:
     nb_levels = len(res_tot_peel)
     res_levels = [0.0] * nb_levels
     list_nb_PU = [0] * nb_levels
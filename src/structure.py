@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+
+"""
+Module defining the Structure class: a chain of a pdb stored in NumPy arrays
+(one row per atom, the atoms of a residue being contiguous), which is written
+back to pdb text only when needed
+"""
+
+import json
+import numpy as np
+from multiprocessing import shared_memory
+
+
+# Arrays of a Structure (the other ones being derived from them):
+ARRAY_FIELDS = ("coords", "atom_names", "altlocs", "serials", "hetatm",
+                "occupancies", "bfactors", "label_idx", "labels", "tail_idx",
+                "tails", "res_offsets")
+# Version of the format of the structure files (see to_bytes), written in
+# their header, to change with the fields or with the parsing of the pdb:
+FILE_VERSION = 1
+
+
+def _parse_numbers(fields, dtype, default):
+    """
+    Convert text fields of pdb lines to numbers, leniently: the blank fields
+    (e.g. lines ending after the coordinates) and the fields that are not
+    numbers (e.g. hybrid-36 atom serials) take the default values
+
+    Args:
+        fields: Array (n) of the fields (bytes)
+        dtype: Type of the numbers
+        default: Default value (or array (n) of the default values)
+
+    Returns:
+        The array (n) of the numbers
+    """
+    values = np.broadcast_to(np.asarray(default, dtype=dtype),
+                             fields.shape).copy()
+    filled = np.char.strip(fields) != b""
+    try:
+        values[filled] = fields[filled].astype(np.float64)
+    except ValueError: # Some fields are not numbers, read one by one
+        for idx in np.flatnonzero(filled):
+            try:
+                values[idx] = float(fields[idx])
+            except ValueError:
+                pass
+
+    return values
+
+
+def _fixed_columns(values, width, decimals=0):
+    """
+    Format numbers as right-justified text columns, like "{:width.decimalsf}"
+    (the values being read from columns of the same width, they always fit)
+
+    Args:
+        values: Array (n) of the numbers to format
+        width: Width (int) of the columns
+        decimals: Number (int) of decimals (0 for integers, without point)
+
+    Returns:
+        An array (n, width) of the characters (uint8) of the columns
+    """
+    values = np.asarray(values, dtype=np.float64)
+    # The float32 values are exact in float64, as their product by 10**3:
+    digits = np.abs(np.rint(values * 10**decimals)).astype(np.int64)
+    columns = np.full((len(values), width), ord(' '), dtype=np.uint8)
+    pos = np.full(len(values), width - 1)
+    rows = np.arange(len(values))
+
+    for i in range(width):
+        # Digits are written from the right, until the integer part is done:
+        to_write = (digits > 0) | (i <= decimals)
+        if not to_write.any():
+            break
+        if decimals and i == decimals:
+            columns[rows, pos] = ord('.')
+            pos -= 1
+        columns[rows[to_write], pos[to_write]] = (ord('0') +
+                                                  digits[to_write] % 10)
+        digits //= 10
+        pos[to_write] -= 1
+
+    # "-0.000" is written for the negative values rounded to zero, as Python:
+    negative = np.signbit(values)
+    columns[rows[negative], pos[negative]] = ord('-')
+
+    return columns
+
+
+class Structure:
+    """
+    Atoms of a pdb chain, stored in arrays
+
+    Attributes:
+        coords: Array (n_atoms, 3) of the coordinates (float32)
+        atom_names: Array of the atom names (4 columns, as in the pdb)
+        altlocs: Array of the alternative location indicators
+        serials: Array of the atom numbers
+        hetatm: Boolean array telling if the atom is an HETATM
+        occupancies: Array of the occupancies
+        bfactors: Array of the temperature factors
+        label_idx: Index of the residue label (residue name, chain ID, residue
+        number and insertion code) of each atom in labels
+        labels: Array of the distinct residue labels
+        tail_idx: Index of the end of line (columns 67-80) of each atom in
+        tails
+        tails: Array of the distinct ends of lines
+        res_offsets: Array (n_res+1) of the index of the 1st atom of each
+        residue (the atoms of residue i being res_offsets[i]:res_offsets[i+1])
+        first_res: Number (int) of the 1st residue (0 if atoms were read before
+        the 1st "N" atom, else 1)
+        atom_res: Index of the residue of each atom
+        resIDs_pdb: Array (str) of the residue numbers of the pdb (stripped)
+    """
+
+    def __init__(self, coords, atom_names, altlocs, serials, hetatm,
+                 occupancies, bfactors, label_idx, labels, tail_idx, tails,
+                 res_offsets, first_res=1):
+        self.coords = coords
+        self.atom_names = atom_names
+        self.altlocs = altlocs
+        self.serials = serials
+        self.hetatm = hetatm
+        self.occupancies = occupancies
+        self.bfactors = bfactors
+        self.label_idx = label_idx
+        self.labels = labels
+        self.tail_idx = tail_idx
+        self.tails = tails
+        self.res_offsets = res_offsets
+        self.first_res = first_res
+        self._set_residues()
+
+    def _set_residues(self):
+        # Arrays derived from the offsets (not pickled):
+        self.atom_res = np.repeat(np.arange(len(self), dtype=np.int32),
+                                  np.diff(self.res_offsets))
+        res_labels = self.labels[self.label_idx[self.res_offsets[:-1]]]
+        self.resIDs_pdb = np.char.strip(np.char.decode(
+            res_labels.view('S1').reshape(-1, 10)[:, 5:9].copy().view('S4')
+            .ravel()))
+
+    @classmethod
+    def from_columns(cls, columns):
+        """
+        Build a Structure from lines of a pdb given as an array of columns,
+        without reading them one by one (the lines being already selected:
+        ATOM lines, and HETATM lines of MET/MSE, see mio.select_chain), a new
+        residue starting at each "N" atom
+
+        Args:
+            columns: Array (n_atoms, 80) of the characters (uint8) of the
+            lines, padded with spaces
+
+        Returns:
+            The Structure of the atoms read
+        """
+        def field(first, last):
+            return columns[:, first:last].copy().view(
+                'S' + str(last - first)).ravel()
+
+        atom_names = field(12, 16)
+        # Suppose that 1st = "N" (atoms read before are residue 0):
+        list_offsets = np.flatnonzero(np.char.strip(atom_names) == b"N")
+        first_res = 1
+        if len(columns) and (not len(list_offsets) or list_offsets[0]):
+            list_offsets = np.concatenate(([0], list_offsets))
+            first_res = 0
+
+        labels, label_idx = np.unique(field(17, 27), return_inverse=True)
+        tails, tail_idx = np.unique(field(66, 80), return_inverse=True)
+        coords = np.stack([field(first, first + 8).astype(np.float64)
+                           for first in (30, 38, 46)], axis=1)
+
+        # The serials that are not numbers are replaced by the positions of
+        # the atoms:
+        serials = _parse_numbers(field(6, 11), np.int32,
+                                 np.arange(1, len(columns) + 1))
+
+        return cls(coords.astype(np.float32), atom_names, field(16, 17),
+                   serials, field(0, 6) == b"HETATM",
+                   _parse_numbers(field(54, 60), np.float32, 0),
+                   _parse_numbers(field(60, 66), np.float32, 0),
+                   label_idx.astype(np.uint32), labels,
+                   tail_idx.astype(np.uint16), tails,
+                   np.append(list_offsets, len(columns)).astype(np.int64),
+                   first_res)
+
+    def __len__(self):
+        """
+        Returns:
+            The number of residues of the structure
+        """
+        return len(self.res_offsets) - 1
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["atom_res"], state["resIDs_pdb"]
+        # The arrays of a structure attached to a shared block are copied:
+        state.pop("_shm", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_residues()
+
+    def to_shared(self):
+        """
+        Copy the arrays of the structure into a block of shared memory, so
+        that other processes can attach them without copy (see from_shared)
+        The block has to be closed and unlinked by the caller when no process
+        uses it anymore
+
+        Returns:
+            The SharedMemory block and the descriptor (tuple of the name of
+            the block, of the list of the field, dtype, shape and offset of
+            each array, and of first_res) given to from_shared
+        """
+        list_fields, size = self._layout()
+        block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for field, dtype, shape, offset in list_fields:
+            np.ndarray(shape, dtype, buffer=block.buf, offset=offset)[...] = \
+                getattr(self, field)
+
+        return block, (block.name, list_fields, self.first_res)
+
+    @classmethod
+    def from_shared(cls, descriptor):
+        """
+        Build a Structure whose arrays are read-only views on a block of
+        shared memory (see to_shared), which stays attached as long as the
+        structure exists
+
+        Args:
+            descriptor: Descriptor of the block returned by to_shared
+
+        Returns:
+            The Structure of the block
+        """
+        name, list_fields, first_res = descriptor
+        block = shared_memory.SharedMemory(name=name)
+        arrays = {}
+        for field, dtype, shape, offset in list_fields:
+            arrays[field] = np.ndarray(shape, dtype, buffer=block.buf,
+                                       offset=offset)
+            arrays[field].flags.writeable = False
+
+        struct = cls(first_res=first_res, **arrays)
+        struct._shm = block
+        return struct
+
+    def _layout(self):
+        # Field, dtype, shape and offset of the arrays packed in one buffer
+        # (offsets aligned on 8 bytes), and size of the buffer:
+        list_fields = []
+        size = 0
+        for field in ARRAY_FIELDS:
+            array = getattr(self, field)
+            list_fields.append((field, array.dtype.str, array.shape, size))
+            size += -(-array.nbytes // 8) * 8
+
+        return (list_fields, size)
+
+    def to_bytes(self):
+        """
+        Pack the arrays of the structure into the content of a structure
+        file: a header (JSON line, padded to 64 bytes) describing the arrays,
+        followed by the arrays (see from_file)
+
+        Returns:
+            The content (bytes) of the file
+        """
+        list_fields, size = self._layout()
+        header = json.dumps({"version": FILE_VERSION,
+                             "first_res": self.first_res,
+                             "fields": list_fields}).encode()
+        header = header.ljust(-(-(len(header) + 1) // 64) * 64 - 1) + b'\n'
+
+        content = np.zeros(len(header) + size, dtype=np.uint8)
+        content[:len(header)] = np.frombuffer(header, dtype=np.uint8)
+        for field, dtype, shape, offset in list_fields:
+            np.ndarray(shape, dtype, buffer=content,
+                       offset=len(header) + offset)[...] = getattr(self, field)
+
+        return content.tobytes()
+
+    @classmethod
+    def from_file(cls, file_path):
+        """
+        Build a Structure whose arrays are read-only views on a structure
+        file (see to_bytes) mapped in memory, so that nothing is parsed
+
+        Args:
+            file_path: Path (str) of the structure file
+
+        Returns:
+            The Structure of the file
+        """
+        with open(file_path, 'rb') as struct_file:
+            header = struct_file.readline()
+        dict_header = json.loads(header)
+
+        content = np.memmap(file_path, dtype=np.uint8, mode='r')
+        arrays = {}
+        for field, dtype, shape, offset in dict_header["fields"]:
+            arrays[field] = np.ndarray(shape, dtype, buffer=content,
+                                       offset=len(header) + offset)
+
+        return cls(first_res=dict_header["first_res"], **arrays)
+
+    def residues(self, inf_bound, sup_bound):
+        """
+        Get the residues between two bounds (numbered as the keys of the
+        peeling output, i.e. from first_res), without copy of the arrays
+
+        Args:
+            inf_bound: Number (int) of the 1st residue to keep
+            sup_bound: Number (int) of the last residue to keep (included)
+
+        Returns:
+            A Structure, whose arrays are views on the ones of this structure
+        """
+        res_start = min(max(inf_bound - self.first_res, 0), len(self))
+        res_stop = min(max(sup_bound - self.first_res + 1, res_start),
+                       len(self))
+        atoms = slice(self.res_offsets[res_start], self.res_offsets[res_stop])
+
+        return Structure(self.coords[atoms], self.atom_names[atoms],
+                         self.altlocs[atoms], self.serials[atoms],
+                         self.hetatm[atoms], self.occupancies[atoms],
+                         self.bfactors[atoms], self.label_idx[atoms],
+                         self.labels, self.tail_idx[atoms], self.tails,
+                         self.res_offsets[res_start:res_stop+1] -
+                         self.res_offsets[res_start],
+                         self.first_res + res_start)
+
+    def select(self, mask_res):
+        """
+        Get the residues selected by a boolean mask
+
+        Args:
+            mask_res: Boolean array (n_res) of the residues to keep
+
+        Returns:
+            A Structure with the selected residues only
+        """
+        mask_atoms = mask_res[self.atom_res]
+        nb_atoms_res = np.diff(self.res_offsets)[mask_res]
+
+        return Structure(self.coords[mask_atoms],
+                         self.atom_names[mask_atoms],
+                         self.altlocs[mask_atoms], self.serials[mask_atoms],
+                         self.hetatm[mask_atoms],
+                         self.occupancies[mask_atoms],
+                         self.bfactors[mask_atoms], self.label_idx[mask_atoms],
+                         self.labels, self.tail_idx[mask_atoms], self.tails,
+                         np.concatenate(([0], np.cumsum(nb_atoms_res))))
+
+    def kept_residues(self, set_erased):
+        """
+        Get the mask of the residues that are not erased, the erased residues
+        being given by their residue numbers (a mask of the residues is
+        updated instead of the structure being rewritten)
+
+        Args:
+            set_erased: Set of the residue numbers (str, stripped as in
+            resIDs_pdb) of the erased residues
+
+        Returns:
+            Boolean array (n_res) of the residues to keep
+        """
+        return ~np.isin(self.resIDs_pdb, list(set_erased))
+
+    def get_atoms(self):
+        """
+        Get the atoms as read by the TM programs (ATOM lines only, alternative
+        locations of an already read atom being skipped), as done by
+        manage_io.get_atoms for a pdb file
+
+        Returns:
+            The list of the atoms (tuples of the atom number, atom name,
+            residue name, residue number and insertion code) and the array
+            (float32) of their coordinates
+        """
+        list_atoms, arr_idx = self.index_atoms()
+
+        return (list_atoms, self.coords[arr_idx])
+
+    def index_atoms(self):
+        """
+        Get the atoms read by the TM programs (see get_atoms) with their
+        indexes in the arrays of the structure, so that a subset of residues
+        can be taken from them without reading the atoms again
+
+        Returns:
+            The list of the atoms (see get_atoms) and the array of their
+            indexes
+        """
+        labels = self.labels.astype(str)
+        list_atoms, list_idx = [], []
+        seen_atoms = set()
+
+        for idx, (name, altloc, serial, hetatm, label) in enumerate(zip(
+                self.atom_names.astype(str), self.altlocs.astype(str),
+                self.serials.tolist(), self.hetatm.tolist(),
+                self.label_idx.tolist())):
+            if hetatm:
+                continue
+            label = labels[label]
+            resID = (int(label[5:9]), label[9:10])
+            # Alternative location of an already read atom:
+            if altloc.strip() and (resID, name) in seen_atoms:
+                continue
+
+            seen_atoms.add((resID, name))
+            list_atoms.append((serial, name, label[0:3], resID[0], resID[1]))
+            list_idx.append(idx)
+
+        return (list_atoms, np.array(list_idx, dtype=np.int64))
+
+    def to_pdb(self):
+        """
+        Returns:
+            The pdb text (str) of the atoms of the structure (80 columns)
+        """
+        nb_atoms = len(self.serials)
+        lines = np.full((nb_atoms, 81), ord(' '), dtype=np.uint8)
+
+        lines[:, 0:6] = np.where(self.hetatm[:, None],
+                                 np.frombuffer(b"HETATM", dtype=np.uint8),
+                                 np.frombuffer(b"ATOM  ", dtype=np.uint8))
+        lines[:, 6:11] = _fixed_columns(self.serials, 5)
+        lines[:, 12:16] = self.atom_names.view(np.uint8).reshape(-1, 4)
+        lines[:, 16] = self.altlocs.view(np.uint8)
+        lines[:, 17:27] = self.labels.view(np.uint8).reshape(-1, 10)[
+                                                            self.label_idx]
+        for i in range(3):
+            lines[:, 30+8*i:38+8*i] = _fixed_columns(self.coords[:, i], 8, 3)
+        lines[:, 54:60] = _fixed_columns(self.occupancies, 6, 2)
+        lines[:, 60:66] = _fixed_columns(self.bfactors, 6, 2)
+        lines[:, 66:80] = self.tails.view(np.uint8).reshape(-1, 14)[
+                                                            self.tail_idx]
+        lines[:, 80] = ord('\n')
+
+        return lines.tobytes().decode()
+
+    def write_pdb(self, pdb_path):
+        """
+        Write the atoms of the structure into a pdb file
+
+        Args:
+            pdb_path: Path (str) of the pdb file to write
+        """
+        with open(pdb_path, 'w') as pdb_file:
+            pdb_file.write(self.to_pdb())
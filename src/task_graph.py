@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Module running a graph of tasks (the independent stages of a run), each one
+in its own process, as soon as the tasks it depends on are done, within a
+budget of CPUs
+"""
+
+import sys
+import traceback
+import multiprocessing as mp
+import multiprocessing.connection as mpc
+
+
+def _run_task(conn, func, args, kwargs):
+    """
+    Run a task in the child process and send back its result (or the
+    traceback of its error)
+
+    Args:
+        conn: Connection (write end of a pipe) to the parent process
+        func: Function of the task
+        args: Tuple of its positional arguments
+        kwargs: Dict of its keyword arguments
+    """
+    try:
+        conn.send((True, func(*args, **kwargs)))
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+    conn.close()
+
+
+def run_tasks(tasks, nb_cpu):
+    """
+    Run a graph of tasks, each one in its own process (so a task can have its
+    own pool of processes): a task is started as soon as the tasks it depends
+    on are done and a CPU is free, the ready tasks being started in the order
+    of the dict
+    The program stops if a task fails (the running tasks being terminated)
+
+    Args:
+        tasks: Dict {name: task}, where a task is a dict with the keys "func"
+        (function to run) and "args" (tuple of its positional arguments), and
+        optionally "deps" (list of the names of the tasks that must be done
+        before), "inputs" (dict {keyword: name of a task} of the arguments
+        given by the results of other tasks, which are also dependencies) and
+        "nb_cpu" (number of CPUs that the task can use, given to the function
+        as its nb_cpu keyword, less CPUs being given if less are free)
+        The CPUs of a task are set when it starts, for its whole life: the
+        CPUs freed later by other tasks are not given back to it
+        nb_cpu: Number (int) of CPUs shared by the tasks
+
+    Returns:
+        The dict {name: result} of the results of the tasks
+    """
+    results = {}
+    # Running tasks, by the connection receiving their result:
+    running = {}
+    pending = list(tasks)
+    free_cpu = nb_cpu
+
+    try:
+        while pending or running:
+            for name in list(pending):
+                task = tasks[name]
+                inputs = task.get("inputs", {})
+                deps = set(task.get("deps", ())) | set(inputs.values())
+                if free_cpu < 1 or not deps.issubset(results):
+                    continue
+
+                kwargs = {key: results[dep] for key, dep in inputs.items()}
+                task_cpu = 1
+                if "nb_cpu" in task:
+                    # Share set at launch (the function sizes its pool with
+                    # it):
+                    task_cpu = min(task["nb_cpu"], free_cpu)
+                    kwargs["nb_cpu"] = task_cpu
+                conn_recv, conn_send = mp.Pipe(duplex=False)
+                process = mp.Process(target=_run_task,
+                                     args=(conn_send, task["func"],
+                                           task["args"], kwargs))
+                process.start()
+                conn_send.close()
+
+                running[conn_recv] = (name, process, task_cpu)
+                pending.remove(name)
+                free_cpu -= task_cpu
+                print("Task " + name + " started (" + str(task_cpu) +
+                      " CPU)")
+
+            if not running:
+                print("ERROR! Tasks depending on unknown tasks (or on each "
+                      "other): " + ", ".join(pending))
+                sys.exit(1)
+
+            for conn in mpc.wait(list(running)):
+                name, process, task_cpu = running.pop(conn)
+                try:
+                    success, result = conn.recv()
+                except EOFError:
+                    success, result = False, None
+                process.join()
+                free_cpu += task_cpu
+
+                if not success:
+                    print("ERROR! The task " + name + " failed" +
+                          (":\n" + result if result else " (exit code " +
+                           str(process.exitcode) + ")"))
+                    sys.exit(1)
+                results[name] = result
+                print("Task " + name + " done")
+
+    finally:
+        # Tasks still running after an error:
+        for name, process, task_cpu in running.values():
+            process.terminate()
+            process.join()
+
+    return results
@@ -0,0 +1,1276 @@
+#!/usr/bin/env python3
+
+"""
+In-process NumPy engine reproducing the TMscore and TMalign binaries (search
+of the superposition, initial alignments and DP of TMalign) and the scores of
+the gdt.pl script
+
+All the computations are done directly on arrays of CA coordinates, so no
+process is launched and no file is written
+It is a fallback for the machines where the binaries can not be run: a single
+alignment is about 3 to 5 times slower than with the binaries
+"""
+
+import numpy as np
+
+
+# Maximum number of rows (superpositions x residues) processed at once, to
+# keep the memory footprint of the vectorized search bounded:
+MAX_CHUNK = 2000000
+
+
+def kabsch(coords_1, coords_2, weights):
+    """
+    Batched (weighted) Kabsch superposition, equivalent to the u3b
+    subroutine of the TM programs
+
+    Args:
+        coords_1: Array (B, N, 3) of the coordinates to move
+        coords_2: Array (B, N, 3) of the fixed coordinates
+        weights: Array (B, N) of the weight of each pair of atoms (0 to
+        ignore a pair)
+
+    Returns:
+        The rotation matrices (B, 3, 3) and the translation vectors (B, 3),
+        such that coords_1 @ rot.T + trans is superposed onto coords_2
+    """
+    coords_1 = np.asarray(coords_1, dtype=np.float64)
+    coords_2 = np.asarray(coords_2, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    sum_w = weights.sum(axis=1)
+    sum_w[sum_w == 0] = 1 # Avoid dividing by zero for empty superpositions
+    center_1 = np.matmul(weights[:, np.newaxis], coords_1)[:, 0] / \
+               sum_w[:, np.newaxis]
+    center_2 = np.matmul(weights[:, np.newaxis], coords_2)[:, 0] / \
+               sum_w[:, np.newaxis]
+
+    # Weighted covariance matrix, from the raw moments:
+    covar = np.matmul((coords_1 * weights[:, :, np.newaxis]
+                       ).transpose(0, 2, 1), coords_2)
+    covar -= (sum_w[:, np.newaxis, np.newaxis] *
+              center_1[:, :, np.newaxis] * center_2[:, np.newaxis, :])
+
+    svd_u, _, svd_vt = np.linalg.svd(covar)
+    # Correction of the improper rotations (reflections):
+    sign = np.sign(np.linalg.det(np.matmul(svd_u, svd_vt)))
+    sign[sign == 0] = 1
+    svd_vt[:, 2, :] *= sign[:, np.newaxis]
+    rot = np.matmul(svd_u, svd_vt).transpose(0, 2, 1)
+    trans = center_2 - np.matmul(rot, center_1[..., np.newaxis])[..., 0]
+
+    return (rot, trans)
+
+
+def transform(coords, rot, trans):
+    """
+    Apply a rotation and a translation to (a batch of) coordinates
+
+    Args:
+        coords: Array (B, N, 3) or (N, 3) of coordinates
+        rot: Rotation matrices (B, 3, 3) or (3, 3)
+        trans: Translation vectors (B, 3) or (3)
+
+    Returns:
+        The array of the transformed coordinates
+    """
+    return (np.matmul(coords, np.swapaxes(rot, -1, -2)) +
+            np.expand_dims(trans, -2))
+
+
+def _pair_dist2(coords_1, coords_2, rot, trans):
+    """
+    Squared distances between the pairs of atoms, once the structure 1 is
+    superposed (computed in place, with the same values than
+    ((transform(coords_1, rot, trans) - coords_2)**2).sum(axis=2))
+
+    Args:
+        coords_1: Array (B, N, 3) of the coordinates to move
+        coords_2: Array (B, N, 3) of the fixed coordinates
+        rot: Rotation matrices (B, 3, 3)
+        trans: Translation vectors (B, 3)
+
+    Returns:
+        The array (B, N) of the squared distances
+    """
+    diff = transform(coords_1, rot, trans)
+    diff -= coords_2
+    diff *= diff
+    dist2 = diff[:, :, 0] + diff[:, :, 1]
+    dist2 += diff[:, :, 2]
+    return dist2
+
+
+def _pair_scores(dist2, d0_2, mask):
+    """
+    Sum the scores 1 / (1 + dij^2/d0^2) of the selected pairs
+
+    Args:
+        dist2: Array (B, N) of the squared distances between pairs
+        d0_2: Array (B, 1) of the squared d0 scales
+        mask: Boolean array (B, N) of the pairs counted in the score
+
+    Returns:
+        The array (B) of the (not normalized) scores
+    """
+    score = dist2 / d0_2
+    score += 1
+    np.divide(1, score, out=score)
+    score *= mask
+    return score.sum(axis=1)
+
+
+def get_d0(length, d0_min=0.5, min_len=15):
+    """
+    Compute the d0 scale of the TMscore, for a given normalization length
+
+    Args:
+        length: Length (int or array) used to normalize the TMscore
+        d0_min: Minimum value (float) allowed for d0
+        min_len: Length (int) under which d0 is set to d0_min
+
+    Returns:
+        The value(s) of d0
+    """
+    length = np.asarray(length, dtype=np.float64)
+    d0 = 1.24 * np.cbrt(np.maximum(length - 15, 0)) - 1.8
+    d0 = np.where(length > min_len, d0, d0_min)
+    return np.maximum(d0, d0_min)
+
+
+def _select_close(dist2, mask, cutoff, n_ali, squared=False):
+    """
+    Select the pairs with a distance below the cutoff, increasing the cutoff
+    (by 0.5) for the rows having less than 3 selected pairs (like score_fun)
+
+    Args:
+        dist2: Array (W, N) of the squared distances between pairs
+        mask: Boolean array (W, N) of the valid pairs
+        cutoff: Array (W) of the initial distance cutoffs
+        n_ali: Array (W) of the number of valid pairs of each row
+        squared: Boolean telling if the cutoff applies to the squared
+        distances, the pairs at the cutoff being selected (like get_GL)
+
+    Returns:
+        The boolean array (W, N) of the selected pairs
+    """
+    def is_close(dist2, cutoff):
+        """Compare the distances to the cutoffs (one per row)"""
+        if squared:
+            return dist2 <= cutoff[:, np.newaxis]
+        return dist2 < (cutoff**2)[:, np.newaxis]
+
+    cutoff = np.array(cutoff, dtype=np.float64)
+    selected = is_close(dist2, cutoff) & mask
+    too_few = (selected.sum(axis=1) < 3) & (n_ali > 3)
+
+    while too_few.any():
+        cutoff[too_few] += 0.5
+        selected[too_few] = (is_close(dist2[too_few], cutoff[too_few]) &
+                             mask[too_few])
+        too_few = (selected.sum(axis=1) < 3) & (n_ali > 3)
+
+    return selected
+
+
+def _windows(n_ali, step=1):
+    """
+    Get the initial fragments used to seed the TMscore search, in the same
+    order than the TM programs (decreasing length, then increasing start)
+
+    Args:
+        n_ali: Number (int) of aligned pairs
+        step: Step (int) between 2 starting positions (40 in the simplified
+        search of TMalign)
+
+    Returns:
+        A list of tuples (start, length)
+    """
+    L_ini_min = 4 if n_ali >= 4 else n_ali
+    L_ini = []
+    for i in range(5):
+        L_init = n_ali // 2**i
+        if L_init <= L_ini_min:
+            break
+        L_ini.append(L_init)
+    L_ini.append(L_ini_min)
+
+    list_windows = []
+    for L_init in L_ini:
+        iL_max = n_ali - L_init
+        starts = list(range(0, iL_max + 1, step))
+        if starts[-1] < iL_max:
+            starts.append(iL_max)
+        list_windows.extend((start, L_init) for start in starts)
+
+    return list_windows
+
+
+def tm_search(coords_1, coords_2, mask, d0, norm_len, d8=None, step=1,
+              n_iter=20):
+    """
+    Vectorized version of the heuristic search of the TM programs: each
+    fragment of aligned pairs is superposed, then the superposition is
+    iteratively extended to the pairs closer than d0_search
+
+    Args:
+        coords_1: Array (B, N, 3) of the coordinates of the aligned residues
+        of the structure to move (valid pairs first, then padding)
+        coords_2: Array (B, N, 3) of the coordinates of the aligned residues
+        of the fixed structure
+        mask: Boolean array (B, N) of the valid pairs
+        d0: Array (B) of the d0 scale for each problem
+        norm_len: Array (B) of the lengths used to normalize the TMscores
+        d8: Array (B) of distance cutoffs above which pairs do not count in
+        the score (None for the regular TMscore)
+        step: Step (int) between 2 starting positions of the fragments
+        n_iter: Maximum number (int) of extension iterations
+
+    Returns:
+        The best TMscore of each problem (B), and the associated rotations
+        (B, 3, 3) and translations (B, 3)
+    """
+    nb_prob, nb_pairs = mask.shape
+    n_ali = mask.sum(axis=1)
+    d0 = np.broadcast_to(np.asarray(d0, dtype=np.float64), (nb_prob,))
+    norm_len = np.broadcast_to(np.asarray(norm_len, dtype=np.float64),
+                               (nb_prob,))
+    d0_search = np.clip(d0, 4.5, 8)
+    if d8 is None:
+        d8_2 = np.full(nb_prob, np.inf)
+    else:
+        d8_2 = np.broadcast_to(np.asarray(d8, dtype=np.float64),
+                               (nb_prob,))**2
+
+    best_score = np.full(nb_prob, -1.0)
+    best_rot = np.tile(np.eye(3), (nb_prob, 1, 1))
+    best_trans = np.zeros((nb_prob, 3))
+
+    # All the starting fragments of all problems, in the order of the search:
+    list_rows = []
+    for prob in range(nb_prob):
+        if n_ali[prob]:
+            list_rows.extend((prob, start, length) for start, length in
+                             _windows(n_ali[prob], step))
+    if not list_rows:
+        return (best_score, best_rot, best_trans)
+    all_rows = np.array(list_rows)
+
+    chunk_size = max(1, MAX_CHUNK // max(nb_pairs, 1))
+    idx_pairs = np.arange(nb_pairs)
+
+    for chunk_start in range(0, len(all_rows), chunk_size):
+        rows = all_rows[chunk_start:chunk_start+chunk_size]
+        prob, start, length = rows[:, 0], rows[:, 1], rows[:, 2]
+        x1 = coords_1[prob].astype(np.float64)
+        x2 = coords_2[prob].astype(np.float64)
+        valid = mask[prob]
+        d0_2 = (d0[prob]**2)[:, np.newaxis]
+        max_2 = d8_2[prob][:, np.newaxis]
+        norm = norm_len[prob]
+        cutoff, n_valid = d0_search[prob], n_ali[prob]
+
+        def score_rows(selection):
+            """Superpose the working rows on the selection and score them"""
+            rot, trans = kabsch(x1, x2, selection)
+            dist2 = _pair_dist2(x1, x2, rot, trans)
+            in_score = valid & (dist2 <= max_2)
+            score = _pair_scores(dist2, d0_2, in_score)
+            return (score / norm, rot, trans, dist2)
+
+        # Superposition on the initial fragments:
+        seeds = ((idx_pairs >= start[:, np.newaxis]) &
+                 (idx_pairs < (start + length)[:, np.newaxis]))
+        row_score, row_rot, row_trans, dist2 = score_rows(seeds)
+        selected = _select_close(dist2, valid, cutoff - 1, n_valid)
+
+        # Iterative extension, the working arrays being compacted each time
+        # some rows converge:
+        active = np.arange(len(rows))
+        for it in range(n_iter):
+            score, rot, trans, dist2 = score_rows(selected)
+            better = score > row_score[active]
+            row_score[active[better]] = score[better]
+            row_rot[active[better]] = rot[better]
+            row_trans[active[better]] = trans[better]
+
+            new_selected = _select_close(dist2, valid, cutoff + 1, n_valid)
+            going_on = (new_selected != selected).any(axis=1)
+            if not going_on.any():
+                break
+            selected = new_selected
+            if not going_on.all():
+                active, selected = active[going_on], selected[going_on]
+                x1, x2, valid = x1[going_on], x2[going_on], valid[going_on]
+                d0_2, max_2 = d0_2[going_on], max_2[going_on]
+                norm, cutoff = norm[going_on], cutoff[going_on]
+                n_valid = n_valid[going_on]
+
+        # Keep the 1st best superposition of each problem:
+        for pb in np.unique(prob):
+            idx_pb = np.flatnonzero(prob == pb)
+            idx_max = idx_pb[np.argmax(row_score[idx_pb])]
+            if row_score[idx_max] > best_score[pb]:
+                best_score[pb] = row_score[idx_max]
+                best_rot[pb] = row_rot[idx_max]
+                best_trans[pb] = row_trans[idx_max]
+
+    return (best_score, best_rot, best_trans)
+
+
+def TM_score_coords(coords_1, resIDs_1, coords_2, resIDs_2):
+    """
+    Calculate the TMscore between 2 structures, without alignment (the
+    residues are matched through their residue IDs), like the TMscore binary
+
+    Args:
+        coords_1: Array (L1, 3) of the CA coordinates of the model
+        resIDs_1: Residue IDs (list of L1 elements) of the model
+        coords_2: Array (L2, 3) of the CA coordinates of the native
+        resIDs_2: Residue IDs (list of L2 elements) of the native
+
+    Returns:
+        The value of the TMscore, normalized by the length of the native (or
+        -1 if no matching residues)
+    """
+    # Pick up the common residues (1st occurrence in the native):
+    first_idx_2 = {}
+    for idx, resID in enumerate(resIDs_2):
+        first_idx_2.setdefault(resID, idx)
+    pairs = [(i, first_idx_2[resID]) for i, resID in enumerate(resIDs_1)
+             if resID in first_idx_2]
+
+    if not pairs:
+        return -1
+    idx_1, idx_2 = np.array(pairs).T
+
+    x1 = np.asarray(coords_1, dtype=np.float32)[idx_1][np.newaxis]
+    x2 = np.asarray(coords_2, dtype=np.float32)[idx_2][np.newaxis]
+    mask = np.ones((1, len(pairs)), dtype=bool)
+    len_2 = len(resIDs_2)
+
+    score = tm_search(x1, x2, mask, get_d0(len_2), len_2)[0]
+    return float(score[0])
+
+
+# Gap penalties of the iterative refinement of the TMalign search:
+GAP_OPENS = (-0.6, 0)
+
+
+def _invmap_pairs(invmap):
+    """
+    Get the aligned pairs of alignments, packed at the beginning of each row
+    (in the order of the structure 2)
+
+    Args:
+        invmap: Array (C, N2) of the index in structure 1 aligned with each
+        residue of the structure 2 (-1 if not aligned)
+
+    Returns:
+        The indices (C, W) of the aligned residues in the structures 1 and 2,
+        and the boolean array (C, W) of the valid pairs (W being the largest
+        number of aligned pairs)
+    """
+    valid = invmap >= 0
+    # Only the columns holding at least one valid pair are kept:
+    width = max(1, valid.sum(axis=1).max(initial=0))
+    idx_2 = np.argsort(~valid, axis=1, kind='stable')[:, :width]
+    mask = np.take_along_axis(valid, idx_2, axis=1)
+    idx_1 = np.where(mask, np.take_along_axis(invmap, idx_2, axis=1), 0)
+
+    return (idx_1, idx_2, mask)
+
+
+def _pack_pairs(coords_1, coords_2, invmap):
+    """
+    Gather the coordinates of the aligned residues, the valid pairs being
+    packed at the beginning of each row (in the order of the structure 2)
+
+    Args:
+        coords_1: Array (C, N1, 3) of the coordinates of the structure 1
+        coords_2: Array (N2, 3) of the coordinates of the structure 2
+        invmap: Array (C, N2) of the index in structure 1 aligned with each
+        residue of the structure 2 (-1 if not aligned)
+
+    Returns:
+        The aligned coordinates of both structures (C, W, 3), the boolean
+        array (C, W) of the valid pairs and the indices (C, W) of the
+        aligned residues in each structure (see _invmap_pairs)
+    """
+    idx_1, idx_2, mask = _invmap_pairs(invmap)
+    rows = np.arange(len(invmap))[:, np.newaxis]
+
+    return (coords_1[rows, idx_1], coords_2[idx_2], mask, idx_1, idx_2)
+
+
+def _get_GL(coords_1, coords_2, mask, d0, d002):
+    """
+    Quick evaluation of an alignment, with 3 superpositions (all the pairs,
+    then the pairs closer than d00 and d00 + 1), like get_GL
+
+    Args:
+        coords_1: Array (C, N, 3) of the aligned coordinates to move
+        coords_2: Array (C, N, 3) of the fixed aligned coordinates
+        mask: Boolean array (C, N) of the valid pairs
+        d0: Array (C) of the d0 scale of the search
+        d002: Array (C) of the squared cutoffs used to select the pairs
+
+    Returns:
+        The array (C) of the best (not normalized) scores
+    """
+    d0_2 = (d0**2)[:, np.newaxis]
+    n_al = mask.sum(axis=1)
+    GL = np.zeros(len(mask))
+
+    selection = mask
+    for cutoff in (None, d002, d002 + 1):
+        if cutoff is not None:
+            selection = _select_close(dist2, mask, cutoff, n_al, squared=True)
+        rot, trans = kabsch(coords_1, coords_2, selection)
+        dist2 = _pair_dist2(coords_1, coords_2, rot, trans)
+        GL = np.maximum(GL, _pair_scores(dist2, d0_2, mask))
+
+    return GL
+
+
+def _score_matrix(coords_1, coords_2, rot, trans, d0):
+    """
+    Compute the matrices of the scores 1 / (1 + (dij/d0)^2) between all the
+    residues of both structures, once the structure 1 is superposed
+
+    Args:
+        coords_1: Array (C, N1, 3) of the coordinates of the structure 1
+        coords_2: Array (N2, 3) of the coordinates of the structure 2
+        rot: Rotation matrices (C, 3, 3)
+        trans: Translation vectors (C, 3)
+        d0: Array (C) of the d0 scales
+
+    Returns:
+        The array (C, N1, N2) of the scores (float32)
+    """
+    moved = transform(coords_1, rot, trans)
+    # The operations are done in place (same values than the expression
+    # 1 / (1 + max(|x1|^2 + |x2|^2 - 2 x1.x2, 0) / d0^2)):
+    cross = np.matmul(moved, coords_2.T)
+    cross *= 2
+    dist2 = np.add((moved**2).sum(axis=2)[:, :, np.newaxis],
+                   (coords_2**2).sum(axis=1))
+    dist2 -= cross
+    np.maximum(dist2, 0, out=dist2)
+    dist2 /= (d0**2)[:, np.newaxis, np.newaxis]
+    dist2 += 1
+    np.divide(1, dist2, out=dist2)
+
+    return dist2.astype(np.float32)
+
+
+def _dp_values(score):
+    """
+    Values of the DP without gap penalty: the horizontal moves are then free,
+    so each row of the matrix is a running maximum and the rows can be
+    computed one at a time
+
+    Args:
+        score: Array (C, N1, N2) of the score matrices
+
+    Returns:
+        The array (C, N1+1, N2+1) of the values of the cells
+    """
+    nb, n1, n2 = score.shape
+    # The sums keep the precision of the scores:
+    val = np.zeros((nb, n1 + 1, n2 + 1), dtype=score.dtype)
+
+    for i in range(1, n1 + 1):
+        row = val[:, i, 1:]
+        np.add(val[:, i-1, :-1], score[:, i-1], out=row)
+        np.maximum(row, val[:, i-1, 1:], out=row)
+        np.maximum.accumulate(row, axis=1, out=row)
+        np.maximum(row, 0, out=row)
+
+    return val
+
+
+def _dp_rows(score):
+    """
+    Forward pass of the DP without gap penalty: only the values are computed
+    row by row (see _dp_values), along the shortest structure (the values
+    being the same in both directions, max being exact), the moves being
+    deduced from them for the whole matrices at once
+
+    Args:
+        score: Array (C, N1, N2) of the score matrices
+
+    Returns:
+        The boolean arrays (C, N1+1, N2+1) telling, for each cell (i, j), if
+        the path is diagonal, and else if it goes left (j-1) or up (i-1)
+    """
+    nb, n1, n2 = score.shape
+    if n1 > n2:
+        val = _dp_values(np.ascontiguousarray(score.transpose(0, 2, 1))
+                         ).transpose(0, 2, 1)
+    else:
+        val = _dp_values(score)
+
+    diag = val[:, :-1, :-1] + score
+    up = val[:, :-1, 1:]
+    left = val[:, 1:, :-1]
+    is_diag = np.zeros((nb, n1 + 1, n2 + 1), dtype=bool)
+    go_left = np.zeros((nb, n1 + 1, n2 + 1), dtype=bool)
+    np.greater_equal(diag, np.maximum(up, left), out=is_diag[:, 1:, 1:])
+    np.greater_equal(left, up, out=go_left[:, 1:, 1:])
+
+    return (is_diag, go_left)
+
+
+def _dp_diagonals(score, gap):
+    """
+    Forward pass of the DP, along the anti-diagonals of the matrices (each
+    anti-diagonal only depends on the 2 previous ones)
+
+    Args:
+        score: Array (C, N1, N2) of the score matrices
+        gap: Array (C, 1) of the gap penalties (float32)
+
+    Returns:
+        The boolean arrays (C, N1+N2+1, N1+1) telling, for each cell (i, j)
+        stored at [i+j, i], if the path is diagonal, and else if it goes left
+        (j-1) or up (i-1)
+    """
+    nb, n1, n2 = score.shape
+    width = n1 + 1
+
+    skewed = np.zeros((nb, n1 + n2 + 1, width), dtype=np.float32)
+    idx_i, idx_j = np.meshgrid(np.arange(1, n1 + 1), np.arange(1, n2 + 1),
+                               indexing='ij')
+    skewed[:, idx_i + idx_j, idx_i] = score
+    val = np.zeros_like(skewed)
+    # Values penalized by the gap penalty where the path is diagonal:
+    val_gap = np.zeros_like(skewed)
+    is_diag = np.zeros(skewed.shape, dtype=bool)
+
+    for k in range(2, n1 + n2 + 1):
+        low, high = max(1, k - n2), min(n1, k - 1)
+        diag = np.add(val[:, k-2, low-1:high], skewed[:, k, low:high+1],
+                      out=skewed[:, k, low:high+1])
+        best_gap = np.maximum(val_gap[:, k-1, low-1:high],
+                              val_gap[:, k-1, low:high+1])
+
+        diag_k = np.greater_equal(diag, best_gap,
+                                  out=is_diag[:, k, low:high+1])
+        val_k = np.maximum(diag, best_gap, out=val[:, k, low:high+1])
+        gap_k = val_gap[:, k, low:high+1]
+        np.copyto(gap_k, val_k)
+        np.add(val_k, gap, out=gap_k, where=diag_k)
+
+    # Left (j-1) and up (i-1) neighbours of (i, j) are at [k-1, i], [k-1, i-1]:
+    go_left = np.zeros(skewed.shape, dtype=bool)
+    np.greater_equal(val_gap[:, :-1, 1:], val_gap[:, :-1, :-1],
+                     out=go_left[:, 1:, 1:])
+
+    return (is_diag, go_left)
+
+
+def _dp(score, len_1, gap_open):
+    """
+    Batched version of the dynamic programming of TMalign (the recursion and
+    the ties are the ones of the DP subroutine, which differs slightly from a
+    Needleman-Wunsch)
+
+    Args:
+        score: Array (C, N1, N2) of the score matrices
+        len_1: Array (C) of the lengths of the structures 1 (the rows beyond
+        are padding)
+        gap_open: Gap penalty (float, or array (C))
+
+    Returns:
+        The array (C, N2) of the index in structure 1 aligned with each
+        residue of the structure 2 (-1 if not aligned)
+    """
+    nb, n1, n2 = score.shape
+    gap = np.broadcast_to(np.asarray(gap_open, dtype=np.float32),
+                          (nb,))[:, np.newaxis]
+
+    # Position of the cell (i, j) in the flattened path of each problem:
+    if not gap.any():
+        is_diag, go_left = _dp_rows(score)
+        stride_i, stride_j = n2 + 1, 1
+    else:
+        is_diag, go_left = _dp_diagonals(score, gap)
+        stride_i, stride_j = n1 + 2, n1 + 1
+
+    # Traceback, from the end of both structures:
+    invmap = np.full((nb, n2), -1, dtype=np.int64)
+    for row in range(nb):
+        path_diag = is_diag[row].tobytes()
+        path_left = go_left[row].tobytes()
+        i, j = int(len_1[row]), n2
+        list_i, list_j = [], []
+        while i > 0 and j > 0:
+            cell = i * stride_i + j * stride_j
+            if path_diag[cell]:
+                i, j = i - 1, j - 1
+                list_i.append(i)
+                list_j.append(j)
+            elif path_left[cell]:
+                j -= 1
+            else:
+                i -= 1
+        invmap[row, list_j] = list_i
+
+    return invmap
+
+
+def _sec_struct(coords, length):
+    """
+    Assign the secondary structure of each residue from the CA distances
+    (1: coil, 2: helix, 3: turn, 4: strand), like make_sec
+
+    Args:
+        coords: Array (N, 3) of the CA coordinates (possibly padded)
+        length: Number (int) of residues of the structure
+
+    Returns:
+        The array (N) of the secondary structures
+    """
+    sec = np.ones(len(coords), dtype=np.int64)
+    if length < 5:
+        return sec
+
+    coords = coords[:length].astype(np.float32)
+    idx = np.arange(2, length - 2)
+
+    def dist(shift_1, shift_2):
+        """Distances between residues idx + shift_1 and idx + shift_2"""
+        return np.sqrt(((coords[idx + shift_1] -
+                         coords[idx + shift_2])**2).sum(axis=1))
+
+    dis13, dis14, dis15 = dist(-2, 0), dist(-2, 1), dist(-2, 2)
+    dis24, dis25, dis35 = dist(-1, 1), dist(-1, 2), dist(0, 2)
+
+    def close_to(ref_15, ref_14, ref_13, delta):
+        """Test the distances against the ones of a regular element"""
+        return ((np.abs(dis15 - ref_15) < delta) &
+                (np.abs(dis14 - ref_14) < delta) &
+                (np.abs(dis25 - ref_14) < delta) &
+                (np.abs(dis13 - ref_13) < delta) &
+                (np.abs(dis24 - ref_13) < delta) &
+                (np.abs(dis35 - ref_13) < delta))
+
+    sec[idx] = np.where(close_to(6.37, 5.18, 5.45, 2.1), 2,
+                        np.where(close_to(13, 10.4, 6.1, 1.42), 4,
+                                 np.where(dis15 < 8, 3, 1)))
+    return sec
+
+
+def _largest_fragment(coords, resnums, length):
+    """
+    Find the largest continuous fragment of a structure (consecutive residue
+    numbers and CA-CA distances below 4.25, this cutoff being relaxed if no
+    fragment is long enough), like get_initial4
+
+    Args:
+        coords: Array (N, 3) of the CA coordinates (possibly padded)
+        resnums: Residue numbers (list of int) of the structure
+        length: Number (int) of residues of the structure
+
+    Returns:
+        The array of the indices of the residues of the fragment
+    """
+    dcu0 = np.float32(4.25)
+    r_min = min(length / 3.0, 4)
+    coords = coords[:length].astype(np.float32)
+    dist = np.sqrt(((coords[1:] - coords[:-1])**2).sum(axis=1))
+    consecutive = np.diff(np.asarray(resnums[:length])) == 1
+
+    dcu = dcu0
+    while True:
+        if dcu > dcu0:
+            contin = dist < dcu
+        else:
+            contin = consecutive & (dist < dcu)
+        starts = np.concatenate(([0], np.flatnonzero(~contin) + 1))
+        lengths = np.diff(np.append(starts, length))
+        best = np.argmax(lengths)
+        if lengths[best] >= r_min:
+            return np.arange(starts[best], starts[best] + lengths[best])
+        dcu = np.float32(dcu + np.float32(0.01))
+
+
+def _threading_pairs(len_1, len_2, idel, frag_1=None, frag_2=None):
+    """
+    Get all the gapless threadings of the structures 1 and 2 (or of a
+    fragment of one of them) with an overlap of at least idel residues
+
+    Args:
+        len_1: Length (int) of the structure 1
+        len_2: Length (int) of the structure 2
+        idel: Minimum number (int) of aligned residues
+        frag_1: Indices (array) of the threaded fragment of the structure 1
+        frag_2: Indices (array) of the threaded fragment of the structure 2
+
+    Returns:
+        The aligned pairs of each threading (see _invmap_pairs), as arrays
+        (S, W)
+    """
+    if frag_1 is None:
+        frag_1 = np.arange(len_1)
+    if frag_2 is None:
+        frag_2 = np.arange(len_2)
+    nb_1, nb_2 = len(frag_1), len(frag_2)
+
+    # The residue j of the fragment 2 faces the residue j + shift of the
+    # fragment 1, the overlap being a single run of pairs:
+    shifts = np.arange(-nb_2 + idel, nb_1 - idel + 1)
+    start_2 = np.maximum(0, -shifts)
+    nb_pairs = np.minimum(nb_2, nb_1 - shifts) - start_2
+    kept = nb_pairs >= idel
+    shifts, start_2, nb_pairs = shifts[kept], start_2[kept], nb_pairs[kept]
+
+    idx_pair = np.arange(max(1, nb_pairs.max(initial=0)))
+    mask = idx_pair < nb_pairs[:, np.newaxis]
+    pos_2 = np.where(mask, start_2[:, np.newaxis] + idx_pair, 0)
+    pos_1 = np.where(mask, pos_2 + shifts[:, np.newaxis], 0)
+
+    return (np.where(mask, frag_1[pos_1], 0), np.where(mask, frag_2[pos_2], 0),
+            mask)
+
+
+def _concat_pairs(list_pairs):
+    """
+    Concatenate several sets of packed aligned pairs (see _invmap_pairs),
+    padding them to the same width
+
+    Args:
+        list_pairs: List of the tuples (idx_1, idx_2, mask) to concatenate
+
+    Returns:
+        The concatenated arrays idx_1, idx_2 and mask
+    """
+    width = max(pairs[0].shape[1] for pairs in list_pairs)
+    return tuple(np.concatenate(
+        [np.pad(pairs[k], ((0, 0), (0, width - pairs[k].shape[1])))
+         for pairs in list_pairs]) for k in range(3))
+
+
+class _AlignState:
+    """
+    Data of a batch of TMalign problems (several structures 1 against the
+    same structure 2), advanced in lockstep through the steps of the search
+    """
+
+    def __init__(self, coords_1, len_1, resnums_1, coords_2, resnums_2):
+        """
+        Args:
+            coords_1: Array (B, N1, 3) of the stacked CA coordinates of the
+            structures 1 (see stack_structures)
+            len_1: Array (B) of the lengths of the structures 1
+            resnums_1: Array (B, N1) of the residue numbers of the structures 1
+            coords_2: Array (L2, 3) of the CA coordinates of the structure 2
+            resnums_2: Residue numbers (list of int) of the structure 2
+        """
+        self.nb = len(coords_1)
+        self.len_1 = np.asarray(len_1)
+        self.len_2 = len(coords_2)
+        self.coords_1 = np.asarray(coords_1, dtype=np.float32).astype(
+            np.float64)
+        self.coords_2 = np.asarray(coords_2, dtype=np.float32).astype(
+            np.float64)
+        self.resnums_1 = np.asarray(resnums_1)
+        self.resnums_2 = np.asarray(resnums_2)
+
+        # Parameters of the search, based on the shortest structure:
+        self.anseq = np.minimum(self.len_1, self.len_2)
+        self.d8 = 1.5 * self.anseq**0.3 + 3.5
+        self.d0 = get_d0(self.anseq, 0.168, 19) + 0.8
+        self.d002 = np.clip(self.d0, 4.5, 8)**2
+        self.ddcc = np.where(self.anseq <= 40, 0.1, 0.4)
+
+        self.sec_1 = np.array([_sec_struct(self.coords_1[idx],
+                                           self.len_1[idx])
+                               for idx in range(self.nb)])
+        self.sec_2 = _sec_struct(self.coords_2, self.len_2)
+
+        # Current alignments, scores and score matrices, and best alignments:
+        self.invmap = np.full((self.nb, self.len_2), -1, dtype=np.int64)
+        self.TM = np.zeros(self.nb)
+        self.TM_old = np.zeros(self.nb)
+        self.score = np.zeros((self.nb, self.coords_1.shape[1], self.len_2),
+                              dtype=np.float32)
+        self.TMmax = np.zeros(self.nb)
+        self.invmap0 = np.full((self.nb, self.len_2), -1, dtype=np.int64)
+        # Gap penalty of the last DP (used by the DP of get_initial5):
+        self.gap_open = np.zeros(self.nb, dtype=np.float32)
+
+    def best_GL(self, items, pairs, fallback):
+        """
+        Pick up, for each problem, the 1st alignment with the best positive
+        GL score (processing the candidates by chunks)
+
+        Args:
+            items: Array (C) of the problem of each candidate alignment
+            pairs: Tuple of the arrays (C, W) of the packed aligned pairs of
+            the candidates (see _invmap_pairs)
+            fallback: Array (nb, L2) of the alignments kept when no
+            candidate has a positive score
+
+        Returns:
+            The array (nb, L2) of the selected alignments
+        """
+        idx_1, idx_2, mask = pairs
+        chunk_size = max(1, MAX_CHUNK // (8 * idx_1.shape[1]))
+        list_GL = []
+        for start in range(0, len(items), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            list_GL.append(_get_GL(
+                self.coords_1[items[chunk, np.newaxis], idx_1[chunk]],
+                self.coords_2[idx_2[chunk]], mask[chunk],
+                self.d0[items[chunk]], self.d002[items[chunk]]))
+        GL = np.concatenate(list_GL or [np.zeros(0)])
+
+        best_invmap = fallback.copy()
+        for item in np.unique(items):
+            idx_item = np.flatnonzero(items == item)
+            idx_max = idx_item[np.argmax(GL[idx_item])]
+            if GL[idx_max] > 0:
+                best_invmap[item] = -1
+                valid = mask[idx_max]
+                best_invmap[item, idx_2[idx_max, valid]] = \
+                    idx_1[idx_max, valid]
+        return best_invmap
+
+    def dp(self, items, score, gap_open):
+        """
+        Run the DP on score matrices of some problems, by chunks
+
+        Args:
+            items: Array (C) of the problem of each score matrix
+            score: Array (C, N1, L2) of the score matrices
+            gap_open: Gap penalty (float or array (C))
+
+        Returns:
+            The array (C, L2) of the alignments
+        """
+        gap_open = np.broadcast_to(np.asarray(gap_open, dtype=np.float32),
+                                   (len(items),))
+        n1 = score.shape[1]
+        chunk_size = max(1, 4 * MAX_CHUNK // ((n1 + self.len_2) * (n1 + 1)))
+        return np.concatenate([_dp(score[start:start+chunk_size],
+                                   self.len_1[items[start:start+chunk_size]],
+                                   gap_open[start:start+chunk_size])
+                               for start in range(0, len(items), chunk_size)])
+
+    def get_score(self, items):
+        """
+        Compute the TMscores of the current alignments of some problems
+        (simplified search, pairs further than d8 ignored), and the score
+        matrices from the best superpositions, like get_score
+
+        Args:
+            items: Array of the indices of the problems
+        """
+        x1, x2, mask, _, _ = _pack_pairs(self.coords_1[items], self.coords_2,
+                                         self.invmap[items])
+        TM, rot, trans = tm_search(x1, x2, mask, self.d0[items],
+                                   self.anseq[items], self.d8[items],
+                                   step=40)
+        self.TM[items] = np.where(mask.any(axis=1), TM, 0)
+        self.score[items] = _score_matrix(self.coords_1[items],
+                                          self.coords_2, rot, trans,
+                                          self.d0[items])
+
+    def record(self, items):
+        """
+        Keep the current alignments of the problems that improved their best
+        TMscore
+
+        Args:
+            items: Array of the indices of the problems
+        """
+        better = items[self.TM[items] > self.TMmax[items]]
+        self.TMmax[better] = self.TM[better]
+        self.invmap0[better] = self.invmap[better]
+
+    def start(self, invmap, ratio=None):
+        """
+        Score new initial alignments and select the problems for which the
+        initial alignment is worth refining
+
+        Args:
+            invmap: Array (nb, L2) of the initial alignments
+            ratio: Array (nb) (or float) of the fraction of the best TMscore
+            to exceed (None to refine all the problems)
+
+        Returns:
+            The array of the indices of the selected problems
+        """
+        items = np.arange(self.nb)
+        self.invmap = invmap
+        self.get_score(items)
+        self.record(items)
+        if ratio is None:
+            return items
+        return items[self.TM > self.TMmax * ratio]
+
+    def refine(self, items, gap_opens, n_iter, check_conv=True):
+        """
+        Iterative refinement of the alignments (DP on the score matrix of
+        the previous superposition, for each gap penalty)
+
+        Args:
+            items: Array of the indices of the problems to refine
+            gap_opens: Gap penalties (list of float) to use in turn
+            n_iter: Maximum number (int) of iterations for each penalty
+            check_conv: Boolean telling if the refinement stops when the
+            TMscore does not change anymore
+        """
+        for gap_open in gap_opens:
+            running = items
+            self.gap_open[items] = gap_open
+            for it in range(n_iter):
+                if not len(running):
+                    break
+                self.invmap[running] = self.dp(running, self.score[running],
+                                               gap_open)
+                self.get_score(running)
+                self.record(running)
+                if check_conv:
+                    if it > 0:
+                        running = running[np.abs(self.TM[running] -
+                                                 self.TM_old[running]) >=
+                                          0.000001]
+                    self.TM_old[running] = self.TM[running]
+
+    def initial1(self):
+        """
+        Initial alignments from the gapless threadings (get_initial1)
+
+        Returns:
+            The array (nb, L2) of the initial alignments
+        """
+        list_items, list_pairs = [], []
+        for item in range(self.nb):
+            idel = max(int(self.anseq[item] / 2.0), 5)
+            pairs = _threading_pairs(self.len_1[item], self.len_2, idel)
+            list_items.append(np.full(len(pairs[0]), item))
+            list_pairs.append(pairs)
+
+        return self.best_GL(np.concatenate(list_items),
+                            _concat_pairs(list_pairs),
+                            np.full((self.nb, self.len_2), -1))
+
+    def initial2(self):
+        """
+        Initial alignments from the DP on the secondary structures
+        (get_initial2)
+
+        Returns:
+            The array (nb, L2) of the initial alignments
+        """
+        items = np.arange(self.nb)
+        score = (self.sec_1[:, :, np.newaxis] ==
+                 self.sec_2[np.newaxis, np.newaxis, :]).astype(np.float32)
+        self.gap_open[:] = -1.0
+        return self.dp(items, score, -1.0)
+
+    def initial5(self, fallback):
+        """
+        Initial alignments from the superposition of local fragments, the
+        DP being run on the score matrix of each superposition
+        (get_initial5)
+
+        Args:
+            fallback: Array (nb, L2) of the alignments kept when no
+            candidate is positive
+
+        Returns:
+            The array (nb, L2) of the initial alignments
+        """
+        def n_jump(length):
+            """Step between the starts of 2 fragments"""
+            jump = (15 if length <= 150 else 25 if length <= 200 else
+                    35 if length <= 250 else 45)
+            return max(1, min(jump, length // 3))
+
+        list_seeds = []
+        for item in range(self.nb):
+            len_1, a_len = self.len_1[item], int(self.anseq[item])
+            for n_frag in (min(20, a_len // 3), min(100, a_len // 2)):
+                if n_frag < 1:
+                    continue
+                for start_1 in range(0, len_1 - n_frag + 1, n_jump(len_1)):
+                    for start_2 in range(0, self.len_2 - n_frag + 1,
+                                         n_jump(self.len_2)):
+                        list_seeds.append((item, start_1, start_2, n_frag))
+        if not list_seeds:
+            return fallback
+        seeds = np.array(list_seeds)
+
+        n1 = self.coords_1.shape[1]
+        chunk_size = max(1, MAX_CHUNK // (n1 * self.len_2))
+        list_invmap = []
+        for chunk_start in range(0, len(seeds), chunk_size):
+            items, start_1, start_2, n_frag = \
+                seeds[chunk_start:chunk_start+chunk_size].T
+            idx_frag = np.arange(n_frag.max())
+            in_frag = idx_frag < n_frag[:, np.newaxis]
+            idx_1 = np.where(in_frag, start_1[:, np.newaxis] + idx_frag, 0)
+            idx_2 = np.where(in_frag, start_2[:, np.newaxis] + idx_frag, 0)
+
+            x1 = self.coords_1[items]
+            rot, trans = kabsch(np.take_along_axis(x1, idx_1[..., np.newaxis],
+                                                   axis=1),
+                                self.coords_2[idx_2], in_frag)
+            score = _score_matrix(x1, self.coords_2, rot, trans,
+                                  self.d0[items] + 1.5)
+            list_invmap.append(self.dp(items, score, self.gap_open[items]))
+
+        return self.best_GL(seeds[:, 0],
+                            _invmap_pairs(np.concatenate(list_invmap)),
+                            fallback)
+
+    def initial3(self):
+        """
+        Initial alignments from the DP on the score matrix of the best
+        alignments (superposition of all the aligned pairs), plus a bonus for
+        the identical secondary structures (get_initial3)
+
+        Returns:
+            The array (nb, L2) of the initial alignments
+        """
+        items = np.arange(self.nb)
+        x1, x2, mask, _, _ = _pack_pairs(self.coords_1, self.coords_2,
+                                         self.invmap0)
+        rot, trans = kabsch(x1, x2, mask)
+        score = _score_matrix(self.coords_1, self.coords_2, rot, trans,
+                              self.d0 + 1.5)
+        score += np.where(self.sec_1[:, :, np.newaxis] ==
+                          self.sec_2[np.newaxis, np.newaxis, :],
+                          np.float32(0.5), np.float32(0))
+        self.gap_open[:] = -1.0
+        return self.dp(items, score, -1.0)
+
+    def initial4(self, fallback):
+        """
+        Initial alignments from the gapless threading of the largest
+        continuous fragment of each structure (get_initial4)
+
+        Args:
+            fallback: Array (nb, L2) of the alignments kept when no
+            candidate is positive
+
+        Returns:
+            The array (nb, L2) of the initial alignments
+        """
+        def trimmed(frag, length):
+            """Shorten a fragment covering the whole structure"""
+            if len(frag) == length:
+                start = int(np.float32(length) * np.float32(0.1))
+                end = int(np.float32(length) * np.float32(0.89))
+                return frag[start:end+1]
+            return frag
+
+        frag_2 = trimmed(_largest_fragment(self.coords_2, self.resnums_2,
+                                           self.len_2), self.len_2)
+        list_items, list_pairs = [], []
+        for item in range(self.nb):
+            len_1 = self.len_1[item]
+            idel = max(int(min(len_1, len(frag_2)) / 2.5), 3)
+            pairs_2 = _threading_pairs(len_1, self.len_2, idel, frag_2=frag_2)
+
+            frag_1 = trimmed(_largest_fragment(self.coords_1[item],
+                                               self.resnums_1[item], len_1),
+                             len_1)
+            idel = max(int(min(len(frag_1), self.len_2) / 2.5), 3)
+            pairs_1 = _threading_pairs(len_1, self.len_2, idel, frag_1=frag_1)
+
+            list_pairs.extend((pairs_2, pairs_1))
+            list_items.append(np.full(len(pairs_2[0]) + len(pairs_1[0]),
+                                      item))
+
+        return self.best_GL(np.concatenate(list_items),
+                            _concat_pairs(list_pairs), fallback)
+
+    def finalize(self):
+        """
+        Refine the best alignments by removing the pairs further than d8
+        after superposition, then compute the final TMscores (normalized by
+        both structures), like the end of the main program of TMalign
+
+        Returns:
+            The arrays (B) of the TMscores normalized by the structures 1 and
+            by the structure 2, the rotations (B, 3, 3) and translations
+            (B, 3), and the list of the arrays of aligned pairs
+        """
+        x1, x2, mask, idx_1, idx_2 = _pack_pairs(self.coords_1, self.coords_2,
+                                                 self.invmap0)
+        _, rot, trans = tm_search(x1, x2, mask, self.d0, 1, self.d8)
+        dist = np.sqrt(((transform(x1, rot, trans) - x2)**2).sum(axis=2))
+        kept = mask & (dist <= self.d8[:, np.newaxis])
+
+        order = np.argsort(~kept, axis=1, kind='stable')
+        x1 = np.take_along_axis(x1, order[..., np.newaxis], axis=1)
+        x2 = np.take_along_axis(x2, order[..., np.newaxis], axis=1)
+        mask = np.take_along_axis(kept, order, axis=1)
+        idx_1 = np.take_along_axis(idx_1, order, axis=1)
+        idx_2 = np.take_along_axis(idx_2, order, axis=1)
+
+        # TMscores normalized by both structures, in a single search:
+        norm_len = np.concatenate((self.len_1,
+                                   np.full(self.nb, self.len_2)))
+        TM, rot, trans = tm_search(np.concatenate((x1, x1)),
+                                   np.concatenate((x2, x2)),
+                                   np.concatenate((mask, mask)),
+                                   get_d0(norm_len, 0.5, 21), norm_len)
+        TM = np.where(np.concatenate((mask, mask)).any(axis=1), TM, 0)
+
+        n8_al = mask.sum(axis=1)
+        list_pairs = [np.stack((idx_1[item, :n8_al[item]],
+                                idx_2[item, :n8_al[item]]), axis=1)
+                      for item in range(self.nb)]
+        return (TM[:self.nb], TM[self.nb:], rot[self.nb:], trans[self.nb:],
+                list_pairs)
+
+
+# Distance cutoffs (in Angstroms) of the GDT-TS and GDT-HA scores:
+GDT_TS_CUTOFFS = (1.0, 2.0, 4.0, 8.0)
+GDT_HA_CUTOFFS = (0.5, 1.0, 2.0, 4.0)
+
+
+def _gdt_d0(length):
+    """
+    Compute the d0 scale used by the gdt.pl script (same expression, with a
+    power instead of a cubic root, for the same rounding)
+
+    Args:
+        length: Length (int) used to normalize the TMscore
+
+    Returns:
+        The value of d0
+    """
+    # The script fails under 15 residues (d0 is then set to its minimum):
+    if length < 15:
+        return 0.5
+    return max(1.24 * (length - 15)**(1 / 3) - 1.8, 0.5)
+
+
+def gdt_scores(coords_1, coords_2):
+    """
+    Compare 2 structures already superposed, like the gdt.pl script: the
+    residues are aligned by a DP without gap penalty (and without new
+    superposition) maximizing the TMscore of their distances, and the scores
+    are computed on the aligned pairs, all the GDT cutoffs at once
+
+    Args:
+        coords_1: Array (L1, 3) of the CA coordinates of the structure 1
+        coords_2: Array (L2, 3) of the CA coordinates of the structure 2
+
+    Returns:
+        The TMscores normalized by the length of the structure 1 and by the
+        length of the structure 2, and the GDT-TS and GDT-HA scores (in %,
+        normalized by the length of the smallest structure), all 0 if no
+        residue is aligned
+    """
+    coords_1 = np.asarray(coords_1, dtype=np.float64)
+    coords_2 = np.asarray(coords_2, dtype=np.float64)
+    len_1, len_2 = len(coords_1), len(coords_2)
+    min_len = min(len_1, len_2)
+    if not min_len:
+        return (0.0, 0.0, 0.0, 0.0)
+
+    diff = coords_1[:, np.newaxis] - coords_2[np.newaxis]
+    dist = np.sqrt(diff[..., 0]**2 + diff[..., 1]**2 + diff[..., 2]**2)
+
+    # d0 of the search (normalized by the smallest structure, as in TMalign):
+    d0_search = _gdt_d0(min_len) + 0.8
+    score = 1 / (1 + (dist / d0_search)**2)
+    invmap = _dp(score[np.newaxis], [len_1], 0)[0]
+
+    # Distances of the aligned pairs, from the end of the structures (order
+    # of the sums of the script):
+    idx_2 = np.flatnonzero(invmap >= 0)[::-1]
+    dist_ali = dist[invmap[idx_2], idx_2]
+    if not len(dist_ali):
+        return (0.0, 0.0, 0.0, 0.0)
+
+    list_TM = []
+    for length in (len_1, len_2):
+        terms = 1 / (1 + (dist_ali / _gdt_d0(length))**2)
+        list_TM.append(1 / length * np.cumsum(terms)[-1])
+
+    cutoffs = np.array(GDT_TS_CUTOFFS + GDT_HA_CUTOFFS)
+    nb_below = np.count_nonzero(dist_ali[:, np.newaxis] <= cutoffs, axis=0)
+    nb_TS = len(GDT_TS_CUTOFFS)
+    GDT_TS = 100 * (nb_below[:nb_TS].sum() / (nb_TS * min_len))
+    GDT_HA = 100 * (nb_below[nb_TS:].sum() / (len(GDT_HA_CUTOFFS) * min_len))
+
+    return (float(list_TM[0]), float(list_TM[1]), float(GDT_TS),
+            float(GDT_HA))
+
+
+def stack_structures(list_coords, list_resnums):
+    """
+    Stack the CA coordinates of several structures into a single array,
+    padded up to the length of the longest structure
+
+    Args:
+        list_coords: List of the arrays (L, 3) of CA coordinates
+        list_resnums: List of the residue numbers (list of int) of each
+        structure
+
+    Returns:
+        The array (B, L_max, 3) of the coordinates, the array (B) of the
+        lengths and the array (B, L_max) of the residue numbers
+    """
+    lengths = np.array([len(coords) for coords in list_coords])
+    coords = np.zeros((len(lengths), lengths.max(), 3), dtype=np.float32)
+    resnums = np.zeros((len(lengths), lengths.max()), dtype=np.int64)
+    for idx, length in enumerate(lengths):
+        coords[idx, :length] = list_coords[idx]
+        resnums[idx, :length] = list_resnums[idx]
+
+    return (coords, lengths, resnums)
+
+
+def TM_align_batch(coords_1, len_1, resnums_1, coords_2, resnums_2):
+    """
+    Align a set of structures (e.g. all the PUs of a level) against the same
+    structure, in a single vectorized run of the TMalign search: all the
+    structures go through the same steps together, so the cost of each step
+    is shared by the whole batch
+
+    Args:
+        coords_1: Array (B, N1, 3) of the stacked CA coordinates of the
+        structures to move (see stack_structures)
+        len_1: Array (B) of the lengths of the structures to move
+        resnums_1: Array (B, N1) of their residue numbers
+        coords_2: Array (L2, 3) of the CA coordinates of the fixed structure
+        resnums_2: Residue numbers (list of int) of the fixed structure
+
+    Returns:
+        The arrays (B) of the TMscores normalized by the length of each
+        structure 1 and by the length of the structure 2, the rotations
+        (B, 3, 3) and the translations (B, 3) superposing each structure 1
+        onto the structure 2, and the list of the arrays (L_ali, 2) of
+        aligned pairs (indices in structures 1 and 2)
+    """
+    state = _AlignState(coords_1, len_1, resnums_1, coords_2, resnums_2)
+
+    # Gapless threading:
+    items = state.start(state.initial1())
+    state.refine(items, GAP_OPENS, 30)
+    # Secondary structure alignment:
+    invmap_ss = state.initial2()
+    items = state.start(invmap_ss, 0.2)
+    state.refine(items, GAP_OPENS, 30)
+    # Local superpositions:
+    items = state.start(state.initial5(invmap_ss), state.ddcc)
+    state.refine(items, GAP_OPENS, 2)
+    # Best alignment + secondary structures:
+    invmap_best = state.initial3()
+    items = state.start(invmap_best, state.ddcc)
+    state.refine(items, GAP_OPENS, 30)
+    # Gapless threading of the largest continuous fragments:
+    items = state.start(state.initial4(invmap_best), state.ddcc)
+    state.refine(items, GAP_OPENS[1:], 2, check_conv=False)
+
+    return state.finalize()
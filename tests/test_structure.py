@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+"""
+Tests of the reading of the chains into Structures (see mio.parse_chain)
+"""
+
+import numpy as np
+import src.manage_io as mio
+
+
+# Lines of a pdb ending after the coordinates (no occupancy, no B-factor),
+# the last atom having a hybrid-36 serial:
+TRUNCATED_LINES = [
+    "ATOM      1  N   ALA A   1      11.104   6.134  -6.504",
+    "ATOM      2  CA  ALA A   1      11.639   6.071  -5.147",
+    "ATOM      3  C   ALA A   1      13.147   5.882  -5.168",
+    "ATOM      4  N   GLY A   2      13.756   5.912  -6.352",
+    "ATOM  A0000  CA  GLY A   2      15.199   5.750  -6.470",
+]
+
+
+def test_parse_truncated_columns(tmp_path):
+    pdb_path = tmp_path / "truncated.pdb"
+    pdb_path.write_text("\n".join(TRUNCATED_LINES) + "\nEND\n")
+
+    structure = mio.parse_chain(str(pdb_path))
+
+    assert len(structure) == 2
+    assert structure.serials.tolist() == [1, 2, 3, 4, 5]
+    assert not structure.occupancies.any()
+    assert not structure.bfactors.any()
+    np.testing.assert_allclose(structure.coords[1], [11.639, 6.071, -5.147],
+                               atol=1e-3)
+    # The blank columns are written back as zeros:
+    lines = structure.to_pdb().splitlines()
+    assert lines[0][54:66] == "  0.00  0.00"